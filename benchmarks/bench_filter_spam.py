@@ -0,0 +1,76 @@
+"""
+Compare the vectorized filter_spam with the previous Python loop over every distinct url and phrase.
+
+The example logs are replicated ``--copies`` times, with a distinct query string on every request as
+a month of logs has many. Run from the repo root:
+
+    python benchmarks/bench_filter_spam.py --copies 20
+"""
+
+import argparse
+import time
+from collections import Counter
+from pathlib import Path
+
+import polars as pl
+
+from erddaplogs.logparse import ErddapLogParser
+
+example_logs = Path(__file__).parent.parent / "example_data" / "nginx_example_logs"
+
+spam_strings = (
+    ".env",
+    "env.",
+    ".php",
+    ".git",
+    "robots.txt",
+    "phpinfo",
+    "/config",
+    "aws",
+    ".xml",
+)
+
+
+def _filter_spam_loop(df, spam_strings):
+    """The Python loop that filter_spam used before, kept as a baseline."""
+    bad_pages = []
+    for page, count in Counter(list(df.select("url").to_numpy()[:, 0])).most_common():
+        for phrase in spam_strings:
+            if phrase in page:
+                bad_pages.append(page)
+    return df.filter(~pl.col("url").is_in(bad_pages))
+
+
+def make_frame(copies):
+    """The example logs replicated copies times, with a distinct query string on every url."""
+    parser = ErddapLogParser()
+    parser.load_nginx_logs(example_logs)
+    return pl.concat([parser.df] * copies).with_columns(
+        url=pl.col("url") + "?page=" + pl.int_range(pl.len()).cast(pl.String)
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--copies", type=int, default=20)
+    args = arg_parser.parse_args()
+    df = make_frame(args.copies)
+    print(f"frame: {len(df)} rows")
+
+    start = time.perf_counter()
+    expected = _filter_spam_loop(df, spam_strings)
+    loop_time = time.perf_counter() - start
+
+    parser = ErddapLogParser()
+    parser.df = df
+    start = time.perf_counter()
+    parser.filter_spam(spam_strings)
+    vectorized_time = time.perf_counter() - start
+
+    for name, elapsed in (("loop", loop_time), ("vectorized", vectorized_time)):
+        print(f"{name:>12}: {elapsed:7.2f} s  {len(df) / elapsed:12,.0f} rows/s")
+    assert parser.df.equals(expected)
+
+
+if __name__ == "__main__":
+    main()
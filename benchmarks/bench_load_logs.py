@@ -0,0 +1,109 @@
+"""
+Compare log ingestion throughput of the vectorized engine with the previous per-line regex loop.
+
+The example logs are replicated ``--scale`` times into a temporary directory so that the timings are
+dominated by parsing rather than start-up. Run from the repo root:
+
+    python benchmarks/bench_load_logs.py --scale 50
+"""
+
+import argparse
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import polars as pl
+
+from erddaplogs.logparse import _load_nginx_logs
+
+example_logs = Path(__file__).parent.parent / "example_data" / "nginx_example_logs"
+
+
+def _load_nginx_logs_regex(nginx_logs_dir, wildcard_fname):
+    """The per-line re.search implementation that _load_nginx_logs replaced, kept as a baseline."""
+    lineformat = re.compile(
+        r"""(?P<ipaddress>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) - - \[(?P<dateandtime>\d{2}/[a-z]{3}/\d{4}:\d{2}:\d{2}:\d{2} ([+\-])\d{4})] ((\"(GET|POST|HEAD|PUT|DELETE) )(?P<url>.+)(http/(1\.1|2\.0)")) (?P<statuscode>\d{3}) (?P<bytessent>\d+) (?P<refferer>-|"([^"]+)") (["](?P<useragent>[^"]+)["])""",
+        re.IGNORECASE,
+    )
+    ip, datetimestring, url, bytessent, referer, useragent, status = (
+        [],
+        [],
+        [],
+        [],
+        [],
+        [],
+        [],
+    )
+    for f in Path(nginx_logs_dir).glob(wildcard_fname):
+        with open(f) as logfile:
+            for line in logfile.readlines():
+                data = re.search(lineformat, line)
+                if data:
+                    datadict = data.groupdict()
+                    ip.append(datadict["ipaddress"])
+                    datetimestring.append(datadict["dateandtime"])
+                    url.append(datadict["url"].strip())
+                    bytessent.append(datadict["bytessent"])
+                    referer.append(datadict["refferer"])
+                    useragent.append(datadict["useragent"])
+                    status.append(datadict["statuscode"])
+    df = pl.DataFrame(
+        {
+            "ip": ip,
+            "datetime": datetimestring,
+            "url": url,
+            "user_agent": useragent,
+            "status_code": status,
+            "bytes_sent": bytessent,
+            "referer": referer,
+        }
+    )
+    df = df.with_columns(
+        pl.col("status_code").cast(pl.Int64),
+        pl.col("bytes_sent").cast(pl.Int64),
+        pl.col("datetime")
+        .str.strptime(pl.Datetime, format="%d/%b/%Y:%H:%M:%S %z")
+        .dt.replace_time_zone(None),
+    )
+    return df.sort(by="datetime")
+
+
+def make_corpus(target_dir, scale):
+    """Copy the example logs scale times into target_dir, returning the total number of lines."""
+    total_lines = 0
+    for i in range(scale):
+        for log_file in example_logs.glob("*access.log*"):
+            out = Path(target_dir) / f"{log_file.name}.{i}"
+            shutil.copy(log_file, out)
+            with open(log_file) as f:
+                total_lines += sum(1 for _ in f)
+    return total_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scale", type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        total_lines = make_corpus(tmp, args.scale)
+        print(f"corpus: {total_lines} lines")
+        results = {}
+        for name, loader in (
+            ("regex loop", _load_nginx_logs_regex),
+            ("vectorized", _load_nginx_logs),
+        ):
+            start = time.perf_counter()
+            df = loader(tmp, "*access.log*")
+            elapsed = time.perf_counter() - start
+            results[name] = df
+            print(
+                f"{name:>12}: {elapsed:7.2f} s  {total_lines / elapsed:12,.0f} lines/s  {len(df)} requests"
+            )
+        cols = results["regex loop"].columns
+        assert results["regex loop"].sort(cols).equals(results["vectorized"].sort(cols))
+
+
+if __name__ == "__main__":
+    main()
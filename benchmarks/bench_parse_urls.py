@@ -0,0 +1,322 @@
+"""
+Compare the single-pass url decomposition of parse_columns with the previous chain of column passes.
+
+Request urls from the example logs are sampled into a frame of ``--rows`` rows. Run from the repo root:
+
+    python benchmarks/bench_parse_urls.py --rows 10000000
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import polars as pl
+
+from erddaplogs.logparse import _column_names, _load_nginx_logs, _parse_columns
+
+example_logs = Path(__file__).parent.parent / "example_data" / "nginx_example_logs"
+
+
+def _parse_columns_chain(df):
+    """The per-column chain that _parse_columns used before _parse_urls, kept as a baseline."""
+    df = df.with_columns(pl.col("country").fill_null("unknown"))
+    df = df.with_columns(pl.col("url").str.replace(" ", ""))
+    df = df.with_columns(
+        pl.col("url")
+        .str.split_exact("?", 2)
+        .struct.rename_fields(["base_url", "request_kwargs"])
+        .alias("fields")
+    ).unnest("fields")
+    df = df.with_columns(
+        pl.col("base_url")
+        .str.split_exact("/", 3)
+        .struct.rename_fields(["blank", "root", "first_unsplit", "dataset_id_filetype"])
+        .alias("fields")
+    ).unnest("fields")
+
+    df = df.with_columns(
+        pl.col("first_unsplit")
+        .str.split_exact(".", 2)
+        .struct.rename_fields(["first", "postdot"])
+        .alias("fields")
+    ).unnest("fields")
+
+    request_types = [
+        "tabledap",
+        "subscriptions",
+        "info",
+        "files",
+        "legal",
+        "convert",
+        "griddap",
+        "categorize",
+        "index",
+        "dataProviderForm",
+        "metadata",
+        "information",
+        "status",
+        "search",
+        "slidesorter",
+        "rest",
+        "sos",
+        "wcs",
+        "wms",
+        "dataProviderForm",
+        "rss",
+        "outOfDateDatasets",
+        "sitemap",
+        "download",
+        "images",
+        "public",
+        "opensearch1",
+        "logout",
+        "setDatasetFlag",
+    ]
+
+    df = df.with_columns(erddap_request_type=pl.lit(None))
+    for protocol in request_types:
+        df = df.with_columns(
+            erddap_request_type=pl.when(pl.col("first") == protocol)
+            .then(pl.col("first"))
+            .otherwise(pl.col("erddap_request_type"))
+        )
+    df = df.with_columns(
+        erddap_request_type=pl.when(pl.col("first").str.slice(0, 5) == "login")
+        .then(pl.lit("login"))
+        .otherwise(pl.col("erddap_request_type"))
+    )
+    df = df.with_columns(
+        erddap_request_type=pl.when(pl.col("first").str.slice(0, 7) == "version")
+        .then(pl.lit("version"))
+        .otherwise(pl.col("erddap_request_type"))
+    )
+    df = df.with_columns(
+        erddap_request_type=pl.when(
+            pl.col("first").str.slice(0, 16) == "dataProviderForm"
+        )
+        .then(pl.lit("dataProviderForm"))
+        .otherwise(pl.col("erddap_request_type"))
+    )
+
+    # get file type and dataset id
+    df = df.with_columns(
+        pl.col("dataset_id_filetype")
+        .str.split_exact(".", 2)
+        .struct.rename_fields(["dataset_id", "file_type"])
+        .alias("fields")
+    ).unnest("fields")
+
+    # extract grouped ip addresses
+    df = df.with_columns(
+        pl.col("ip")
+        .str.split_exact(".", 2, inclusive=True)
+        .struct.rename_fields(["ip_0", "ip_1", "ip_2", "ip_3"])
+        .alias("fields")
+    ).unnest("fields")
+
+    df = df.with_columns(
+        pl.col("ip")
+        .str.split_exact(".", 2)
+        .struct.rename_fields(["ip_0_nodot", "ip_1_nodot", "ip_2_nodot", "ip_3_nodot"])
+        .alias("fields")
+    ).unnest("fields")
+
+    df = df.with_columns(
+        pl.concat_str(["ip_0", "ip_1", "ip_2_nodot"]).alias("ip_subnet")
+    )
+    df = df.with_columns(pl.concat_str(["ip_0", "ip_1_nodot"]).alias("ip_group"))
+
+    # remove junk columns and sortby time
+    junk_columns = [
+        "blank",
+        "root",
+        "first",
+        "first_unsplit",
+        "dot",
+        "rest",
+        "postdot",
+        "junk",
+        "ip_0",
+        "ip_1",
+        "ip_2",
+        "ip_3",
+        "ip_0_nodot",
+        "ip_1_nodot",
+        "ip_2_nodot",
+        "ip_3_nodot",
+        "dataset_id_filetype",
+    ]
+    df = df.drop([col for col in junk_columns if col in _column_names(df)])
+
+    df = df.sort(by="datetime")
+
+    return df
+
+
+def _parse_language_data_chain(df):
+    """The language parsing that ran before _parse_columns_chain, kept as a baseline."""
+    # langauge codes taken from the ERDDAP source code WEB-INF/classes/gov/noaa/pfel/erddap/util/TranslateMessages.java
+
+    language_codes = [
+        "en",
+        "bn",
+        "zh-CN",
+        "zh-TW",
+        "cs",
+        "da",
+        "nl",
+        "fi",
+        "fr",
+        "de",
+        "el",
+        "gu",
+        "hi",
+        "hu",
+        "id",
+        "ga",
+        "it",
+        "ja",
+        "ko",
+        "mr",
+        "no",
+        "pl",
+        "pt",
+        "pa",
+        "ro",
+        "ru",
+        "es",
+        "sw",
+        "sv",
+        "tl",
+        "th",
+        "tr",
+        "uk",
+        "ur",
+        "vi",
+    ]
+
+    language_names = [
+        "English",
+        "Bengali",
+        "Chinese-CN",
+        "Chinese-TW",
+        "Czech",
+        "Danish",
+        "Dutch",
+        "Finnish",
+        "French",
+        "German",
+        "Greek",
+        "Gujarati",
+        "Hindi",
+        "Hungarian",
+        "Indonesian",
+        "Irish",
+        "Italian",
+        "Japanese",
+        "Korean",
+        "Marathi",
+        "Norwegian",
+        "Polish",
+        "Portuguese",
+        "Punjabi",
+        "Romanian",
+        "Russian",
+        "Spanish",
+        "Swahili",
+        "Swedish",
+        "Tagalog",
+        "Thai",
+        "Turkish",
+        "Ukrainian",
+        "Urdu",
+        "Vietnamese",
+    ]
+    langauge_names_by_code = {
+        code: name for code, name in zip(language_codes, language_names)
+    }
+
+    df = df.with_columns(
+        pl.col("url")
+        .str.split_exact("/", 3, inclusive=True)
+        .struct.rename_fields(["blank", "root", "first", "rest"])
+        .alias("fields")
+    ).unnest("fields")
+    df = df.with_columns(
+        pl.col("url")
+        .str.split_exact("/", 3)
+        .struct.rename_fields(
+            ["blank_noslash", "root_noslash", "first_noslash", "rest_noslash"]
+        )
+        .alias("fields")
+    ).unnest("fields")
+    df = df.with_columns(
+        pl.col("url")
+        .str.splitn("/", 4)
+        .struct.rename_fields(["blank_n", "root_n", "first_n", "rest_n"])
+        .alias("fields")
+    ).unnest("fields")
+
+    is_language = pl.col("first_noslash").is_in(language_codes)
+    df = df.with_columns(
+        language_code=pl.when(is_language)
+        .then(pl.col("first_noslash"))
+        .otherwise(pl.lit("en"))
+    )
+    df = df.with_columns(
+        language=pl.col("language_code").replace_strict(
+            langauge_names_by_code, return_dtype=pl.String
+        ),
+        first=pl.when(is_language).then(pl.lit("")).otherwise(pl.col("first")),
+    )
+
+    df = df.with_columns(
+        erddap_request_type=pl.when(pl.col("rest_n").is_not_null())
+        .then(pl.lit("/") + pl.col("rest_n"))
+        .otherwise(pl.col("rest_n"))
+    )
+
+    df = df.with_columns(
+        pl.concat_str(["blank", "root", "first", "rest_n"], ignore_nulls=True).alias(
+            "url"
+        )
+    )
+
+    columns = _column_names(df)
+    if "rest" in columns:
+        df = df.drop(["blank", "root", "first", "rest"])
+    if "rest_noslash" in columns:
+        df = df.drop(["blank_noslash", "root_noslash", "first_noslash", "rest_noslash"])
+    if "rest_n" in columns:
+        df = df.drop(["blank_n", "root_n", "first_n", "rest_n"])
+    return df
+
+
+def make_frame(rows):
+    """Sample rows requests, with their urls, ips and datetimes, from the example logs."""
+    df = _load_nginx_logs(example_logs, "*access.log*").select(
+        "datetime", "ip", "url", country=pl.lit(None, pl.String)
+    )
+    return df.sample(rows, with_replacement=True, seed=0).sort("datetime")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    args = parser.parse_args()
+    df = make_frame(args.rows)
+    print(f"frame: {len(df)} rows")
+    results = {}
+    for name, parse in (
+        ("chain", lambda df: _parse_columns_chain(_parse_language_data_chain(df))),
+        ("single pass", _parse_columns),
+    ):
+        start = time.perf_counter()
+        results[name] = parse(df)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>12}: {elapsed:7.2f} s  {len(df) / elapsed:12,.0f} rows/s")
+    assert results["chain"].equals(results["single pass"])
+
+
+if __name__ == "__main__":
+    main()
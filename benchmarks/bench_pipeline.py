@@ -0,0 +1,248 @@
+"""
+Time each stage of the parser pipeline on synthetic logs, with its peak memory.
+
+Logs are written by generate_logs.py, at ``--lines`` lines, into a temporary directory or into
+``--logs-dir`` where they are kept for later runs. Every stage, from load_nginx_logs through each
+filter_ method, get_ip_info, parse_columns and anonymize_requests to export_data, is timed and the
+resident memory of the process sampled while it runs. ip addresses are looked up in a local
+GeoIpDatabase of synthetic ranges, so that no network is needed. export_data anonymizes the
+requests again, so its time includes that of anonymize_requests.
+
+Results can be saved with ``--output`` and compared with those of a previous run with
+``--compare``. Stages slower by more than ``--threshold`` are reported as regressions, and the
+script then exits with status 1. Run from the benchmarks directory:
+
+    python bench_pipeline.py --lines 1000000 --output baseline.json
+    python bench_pipeline.py --lines 1000000 --compare baseline.json
+"""
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import polars as pl
+
+from erddaplogs.ipinfo import GeoIpDatabase
+from erddaplogs.logparse import ErddapLogParser, _date_format_dict
+from generate_logs import example_data, generate_logs
+
+# filters not given a rule here run with their default arguments
+_filters_before_ip = [
+    "filter_non_erddap",
+    "filter_spam",
+    "filter_locales",
+    "filter_user_agents",
+    "filter_common_strings",
+    "filter_files",
+]
+_filters_after_ip = ["filter_organisations"]
+
+
+def _rss_bytes():
+    """Resident memory of this process, or its peak so far where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakMemory:
+    """Context manager sampling the resident memory of the process in a thread, keeping the peak."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def __enter__(self):
+        self.start = self.peak = _rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+
+def geoip_stub():
+    """A GeoIpDatabase of one range per first octet, with some ranges owned by crawlers."""
+    countries = ["SE", "NO", "DK", "FI", "DE", "GB", "US", "FR", "CN", "AU"]
+    cities = ["Gothenburg", "Oslo", "Copenhagen", "Helsinki", "Kiel"]
+    orgs = ["SMHI", "University", "ISP", "Google", "Cloud", "Crawlers", "ISP"]
+    return GeoIpDatabase(
+        pl.DataFrame(
+            {
+                "network": [f"{octet}.0.0.0/8" for octet in range(256)],
+                "countryCode": [countries[i % len(countries)] for i in range(256)],
+                "city": [cities[i % len(cities)] for i in range(256)],
+                "org": [orgs[i % len(orgs)] for i in range(256)],
+            }
+        )
+    )
+
+
+def anonymize_requests(parser):
+    """anonymize_requests, after adding the time period column as export_data does."""
+    parser.df = parser.df.with_columns(
+        pl.col("datetime")
+        .dt.strftime(_date_format_dict[parser.temporal_resolution])
+        .alias(parser.temporal_resolution)
+    )
+    parser.anonymize_requests()
+
+
+def pipeline_stages(logs_dir, work_dir, export_format="csv"):
+    """The stages of the pipeline, as (name, function of an ErddapLogParser) pairs."""
+    backend = geoip_stub()
+    stages = [("load_nginx_logs", lambda parser: parser.load_nginx_logs(logs_dir))]
+    stages += [
+        (name, lambda parser, name=name: getattr(parser, name)())
+        for name in _filters_before_ip
+    ]
+    stages.append(
+        (
+            "get_ip_info",
+            lambda parser: parser.get_ip_info(
+                ip_info_csv=work_dir / "ip.csv", num_ips=None, backend=backend
+            ),
+        )
+    )
+    stages += [
+        (name, lambda parser, name=name: getattr(parser, name)())
+        for name in _filters_after_ip
+    ]
+    stages += [
+        ("parse_columns", lambda parser: parser.parse_columns()),
+        ("anonymize_requests", anonymize_requests),
+        (
+            "export_data",
+            lambda parser: parser.export_data(
+                output_dir=work_dir / "export",
+                export_all=True,
+                export_format=export_format,
+            ),
+        ),
+    ]
+    return stages
+
+
+def run_stages(logs_dir, work_dir, export_format="csv"):
+    """Run the pipeline on logs_dir, returning the time, rows left and memory of each stage."""
+    parser = ErddapLogParser()
+    parser.parse_datasets_xml(example_data / "datasets.xml")
+    results = {}
+    for name, stage in pipeline_stages(logs_dir, Path(work_dir), export_format):
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            stage(parser)
+            seconds = time.perf_counter() - start
+        results[name] = {
+            "seconds": seconds,
+            "rows": len(parser.df),
+            "peak_rss_mb": memory.peak / 2**20,
+            "rss_increase_mb": (memory.peak - memory.start) / 2**20,
+        }
+    return results
+
+
+def compare(results, baseline, threshold=0.2, min_seconds=0.05):
+    """Names of the stages slower than in baseline by more than threshold, ignoring tiny timings."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None or max(result["seconds"], before["seconds"]) < min_seconds:
+            continue
+        if result["seconds"] > before["seconds"] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--lines", type=int, default=1_000_000)
+    arg_parser.add_argument("--files", type=int, default=10)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument(
+        "--logs-dir", help="directory to generate logs in, or reuse them from"
+    )
+    arg_parser.add_argument("--export-format", default="csv")
+    arg_parser.add_argument("--output", help="json file to save the results to")
+    arg_parser.add_argument("--compare", help="json results of a previous run")
+    arg_parser.add_argument("--threshold", type=float, default=0.2)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        logs_dir = Path(args.logs_dir or Path(tmp) / "logs")
+        if not any(logs_dir.glob("*access.log*")):
+            start = time.perf_counter()
+            generate_logs(logs_dir, lines=args.lines, files=args.files, seed=args.seed)
+            print(
+                f"generated {args.lines} lines in {time.perf_counter() - start:.1f} s"
+            )
+        lines = 0
+        for log_file in logs_dir.glob("*access.log*"):
+            opener = gzip.open if log_file.suffix == ".gz" else open
+            with opener(log_file, "rb") as f:
+                lines += sum(
+                    chunk.count(b"\n") for chunk in iter(lambda: f.read(2**24), b"")
+                )
+        results = run_stages(logs_dir, tmp, args.export_format)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["stages"]
+    regressions = compare(results, baseline, threshold=args.threshold)
+    print(f"{lines} lines, polars {pl.__version__}, python {platform.python_version()}")
+    print(
+        f"{'stage':>22} {'seconds':>9} {'lines/s':>12} {'rows':>10} {'peak MB':>9} {'+MB':>8}  change"
+    )
+    for name, result in results.items():
+        change = ""
+        if name in baseline:
+            ratio = result["seconds"] / max(baseline[name]["seconds"], 1e-9)
+            change = f"{ratio - 1:+.0%}" + (
+                "  REGRESSION" if name in regressions else ""
+            )
+        print(
+            f"{name:>22} {result['seconds']:9.3f} {lines / max(result['seconds'], 1e-9):12,.0f} "
+            f"{result['rows']:10d} {result['peak_rss_mb']:9.0f} {result['rss_increase_mb']:8.0f}  {change}"
+        )
+    total = sum(result["seconds"] for result in results.values())
+    print(f"{'total':>22} {total:9.3f} {lines / total:12,.0f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "lines": lines,
+                    "polars": pl.__version__,
+                    "python": platform.python_version(),
+                    "stages": results,
+                },
+                f,
+                indent=1,
+            )
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
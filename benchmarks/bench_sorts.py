@@ -0,0 +1,101 @@
+"""
+Count and time the sorts by datetime made by a full parser pipeline, from loading logs to export.
+
+The example logs are replicated ``--scale`` times, as in bench_load_logs.py. Every call to
+DataFrame.sort or LazyFrame.sort on the datetime column is counted, with the time spent in the
+eager ones. Run from the repo root:
+
+    python benchmarks/bench_sorts.py --scale 20
+"""
+
+import argparse
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import polars as pl
+
+from bench_load_logs import make_corpus
+from erddaplogs.ipinfo import GeoIpDatabase
+from erddaplogs.logparse import ErddapLogParser
+
+example_data = Path(__file__).parent.parent / "example_data"
+
+
+def count_sorts(calls, seconds):
+    """Wrap the polars sort methods to record sorts by datetime in calls and seconds."""
+    # DataFrame.sort runs a LazyFrame.sort, which should not be counted again
+    active = []
+    for cls in (pl.DataFrame, pl.LazyFrame):
+        original = cls.sort
+
+        def sort(self, by, *more_by, _original=original, _cls=cls.__name__, **kwargs):
+            by_all = by if isinstance(by, list) else [by, *more_by]
+            if active or "datetime" not in by_all:
+                return _original(self, by, *more_by, **kwargs)
+            active.append(True)
+            start = time.perf_counter()
+            try:
+                return _original(self, by, *more_by, **kwargs)
+            finally:
+                calls[_cls] += 1
+                seconds[_cls] += time.perf_counter() - start
+                active.pop()
+
+        cls.sort = sort
+
+
+def run_pipeline(logs_dir, output_dir, ip_info_csv, lazy=False):
+    backend = GeoIpDatabase(
+        pl.DataFrame(
+            {
+                "network": ["0.0.0.0/1", "128.0.0.0/1"],
+                "countryCode": ["SE", "NO"],
+                "city": ["Gothenburg", "Oslo"],
+                "org": ["SMHI", "Google"],
+            }
+        )
+    )
+    parser = ErddapLogParser()
+    parser.lazy = lazy
+    parser.load_nginx_logs(logs_dir)
+    parser.parse_datasets_xml(example_data / "datasets.xml")
+    parser.filter_non_erddap()
+    parser.filter_spam()
+    parser.filter_locales()
+    parser.filter_user_agents()
+    parser.filter_common_strings()
+    parser.get_ip_info(num_ips=None, ip_info_csv=ip_info_csv, backend=backend)
+    parser.filter_organisations()
+    parser.parse_columns()
+    parser.export_data(output_dir=output_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scale", type=int, default=20)
+    args = parser.parse_args()
+    calls, seconds = Counter(), Counter()
+    count_sorts(calls, seconds)
+    with tempfile.TemporaryDirectory() as tmp:
+        logs_dir = Path(tmp) / "logs"
+        logs_dir.mkdir()
+        total_lines = make_corpus(logs_dir, args.scale)
+        print(f"corpus: {total_lines} lines")
+        for lazy in (False, True):
+            calls.clear()
+            seconds.clear()
+            start = time.perf_counter()
+            run_pipeline(
+                logs_dir, Path(tmp) / f"out_{lazy}", Path(tmp) / "ip.csv", lazy=lazy
+            )
+            elapsed = time.perf_counter() - start
+            print(
+                f"lazy={lazy!s:>5}: {elapsed:6.2f} s total, {calls['DataFrame']} eager sorts by "
+                f"datetime taking {seconds['DataFrame']:.2f} s, {calls['LazyFrame']} lazy sorts"
+            )
+
+
+if __name__ == "__main__":
+    main()
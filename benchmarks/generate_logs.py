@@ -0,0 +1,438 @@
+"""
+Generate synthetic ERDDAP access logs, deterministically, at any scale.
+
+Lines are in the combined log format written by nginx, apache and the tomcat access log valve of
+ERDDAP servers. Requests are drawn from distributions modelled on the example logs: dataset ids
+and types from a datasets.xml, a Zipf distribution of dataset and url popularity, a small number
+of ips making most requests, each with its own user agent, and a share of spam, crawler, metadata
+and malformed requests. The same arguments always give the same files. Run from the repo root:
+
+    python benchmarks/generate_logs.py /tmp/synthetic_logs --lines 10000000
+"""
+
+import argparse
+import gzip
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+example_data = Path(__file__).parent.parent / "example_data"
+
+# log file names of each server, logrotate appends .1, .2, ...
+_server_file_names = {
+    "tomcat": "tomcat-access.log",
+    "nginx": "access.log",
+    "apache": "other_vhosts_access.log",
+}
+
+# variables requested when datasets.xml does not list them, those of the example glider datasets
+_default_variables = [
+    "time",
+    "latitude",
+    "longitude",
+    "depth",
+    "pressure",
+    "temperature",
+    "salinity",
+    "conductivity",
+    "density",
+    "potential_density",
+    "potential_temperature",
+    "chlorophyll",
+    "oxygen_concentration",
+    "backscatter_scaled",
+    "profile_index",
+    "profile_direction",
+    "profile_num",
+    "dive_num",
+]
+
+# user agents, with the share of ips using them
+_user_agents = {
+    "curl/7.54.0": 10,
+    "curl/8.5.0": 4,
+    "python-requests/2.31.0": 12,
+    "python-requests/2.28.1": 6,
+    "Python-urllib/3.12": 4,
+    "python-httpx/0.27.0": 4,
+    "Python/3.11 aiohttp/3.9.5": 2,
+    "Wget/1.21.4": 3,
+    "libwww-perl/6.05": 1,
+    "R (4.3.2 x86_64-pc-linux-gnu x86_64 linux-gnu)": 3,
+    "MATLAB R2023b": 2,
+    "xpublish-erddap": 1,
+    "Mozilla/5.0 ERDDAP/2.23": 2,
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36": 16,
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15": 8,
+    "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0": 6,
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1": 3,
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)": 3,
+    "Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)": 2,
+    "Mozilla/5.0 (compatible; SemrushBot/7~bl; +http://www.semrush.com/bot.html)": 1,
+    "Friendly_Crawler/Nutch-1.20-SNAPSHOT": 1,
+    "Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Mobile Safari/537.36": 2,
+    "kmdjdheyytgebfghehhenegsdfsdf": 1,
+    "-": 1,
+}
+
+# kinds of request, with their share of the urls
+_request_kinds = {
+    "tabledap": 40,
+    "tabledap_metadata": 12,
+    "griddap": 4,
+    "subscriptions": 10,
+    "version": 6,
+    "files": 6,
+    "info": 4,
+    "metadata": 1,
+    "page": 5,
+    "search": 1,
+    "images": 2,
+    "locale": 1,
+    "spam": 4,
+    "other": 4,
+}
+
+_tabledap_types = ["csv", "nc", "json", "htmlTable", "csvp", "ncCF", "mat", "geoJson"]
+_griddap_types = ["nc", "csv", "json", "htmlTable", "png", "graph"]
+_pages = [
+    "/erddap/index.html",
+    "/erddap/categorize/index.html",
+    "/erddap/legal.html",
+    "/erddap/dataProviderForm.html",
+    "/erddap/outOfDateDatasets.html",
+    "/erddap/convert/index.html",
+    "/erddap/information.html",
+    "/erddap/slidesorter.html",
+    "/erddap/wms/documentation.html",
+    "/erddap/rest.html",
+]
+_images = [
+    "/erddap/images/erddap.css",
+    "/erddap/images/erddapStart2.css",
+    "/erddap/images/noaab.png",
+    "/erddap/images/fish.gif",
+    "/erddap/images/favicon.ico",
+    "/favicon.ico",
+    "/erddap/images/jquery.js",
+]
+_spam = [
+    "/.env",
+    "/.git/config",
+    "/wp-login.php",
+    "/vendor/phpunit/phpunit/src/Util/PHP/eval-stdin.php",
+    "/phpinfo.php",
+    "/aws/credentials",
+    "/config.json",
+    "/sitemap.xml",
+    "/robots.txt",
+    "/cdn-cgi/trace",
+]
+_other = ["/", "/erddap/", "/erddap/tabledap/allDatasets.csv", "/erddap/status.html"]
+_locales = ["zh-CN", "de", "fr", "es", "ZH"]
+
+_status_codes = {200: 900, 404: 50, 304: 15, 499: 12, 301: 8, 302: 4, 400: 3, 500: 2}
+_referers = ["-", "https://erddap.example.org/erddap/index.html"]
+_malformed_fraction = 0.001
+
+
+def _read_datasets(datasets_xml):
+    """Dataset ids of the table and grid datasets of a datasets.xml, and the variables it lists."""
+    root = ET.parse(datasets_xml).getroot()
+    tables, grids, variables = [], [], set()
+    for child in root:
+        if "datasetID" not in child.keys():
+            continue
+        if child.get("type", "").startswith("EDDGrid"):
+            grids.append(child.get("datasetID"))
+        else:
+            tables.append(child.get("datasetID"))
+        for name in child.iter("destinationName"):
+            if name.text:
+                variables.add(name.text.strip())
+    variables = sorted(variables) or _default_variables
+    return tables or ["allDatasets"], grids or tables or ["allDatasets"], variables
+
+
+def _zipf_weights(n, a=1.1):
+    """Probabilities proportional to 1 / rank ** a, for n items."""
+    weights = 1.0 / np.arange(1, n + 1) ** a
+    return weights / weights.sum()
+
+
+def _choice(rng, items, weights=None, size=None):
+    """rng.choice over a list of strings, normalising weights."""
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        weights = weights / weights.sum()
+    index = rng.choice(len(items), p=weights, size=size)
+    return items[index] if size is None else [items[i] for i in index]
+
+
+def _make_url(rng, kind, tables, grids, variables, table_weights, grid_weights):
+    """One request url of a kind of request."""
+    if kind in ("tabledap", "tabledap_metadata", "files", "info", "metadata"):
+        dataset_id = _choice(rng, tables, table_weights)
+    elif kind == "griddap":
+        dataset_id = _choice(rng, grids, grid_weights)
+    if kind == "tabledap":
+        n_vars = min(len(variables), int(rng.integers(1, 12)))
+        names = list(rng.choice(variables, size=n_vars, replace=False))
+        separator = "%2C" if rng.random() < 0.5 else ","
+        query = separator.join(names)
+        if rng.random() < 0.6:
+            day = datetime(2024, 1, 1) + timedelta(days=int(rng.integers(0, 365)))
+            query += (
+                f"&time%3E={day:%Y-%m-%d}T00:00:00Z&time%3C={day:%Y-%m-%d}T23:59:59Z"
+            )
+        if rng.random() < 0.1:
+            query += "&distinct()"
+        return f"/erddap/tabledap/{dataset_id}.{_choice(rng, _tabledap_types)}?{query}"
+    if kind == "tabledap_metadata":
+        return f"/erddap/tabledap/{dataset_id}.{_choice(rng, ['nccsvMetadata', 'das', 'dds', 'html', 'graph'])}"
+    if kind == "griddap":
+        index = int(rng.integers(0, 200000))
+        url = f"/erddap/griddap/{dataset_id}.{_choice(rng, _griddap_types)}"
+        return url + (f"?time%5B{index}%5D" if rng.random() < 0.5 else "")
+    if kind == "subscriptions":
+        dataset_id = _choice(rng, tables, table_weights)
+        return (
+            f"/erddap/subscriptions/add.html?datasetID={dataset_id}&email=fake%40example.com"
+            f"&emailIfAlreadyValid=false&showErrors=false"
+        )
+    if kind == "version":
+        return "/erddap/version"
+    if kind == "files":
+        return f"/erddap/files/{dataset_id}/{dataset_id}.nc"
+    if kind == "info":
+        return (
+            f"/erddap/info/{dataset_id}/index.{_choice(rng, ['html', 'json', 'csv'])}"
+        )
+    if kind == "metadata":
+        return f"/erddap/metadata/iso19115/xml/{dataset_id}_iso19115.xml"
+    if kind == "page":
+        return _choice(rng, _pages)
+    if kind == "search":
+        term = _choice(rng, ["glider", "temperature", "oxygen", "baltic", "turbidity"])
+        return f"/erddap/search/index.html?page=1&itemsPerPage=1000&searchFor={term}"
+    if kind == "images":
+        return _choice(rng, _images)
+    if kind == "locale":
+        return f"/erddap/{_choice(rng, _locales)}/index.html"
+    if kind == "spam":
+        return _choice(rng, _spam)
+    return _choice(rng, _other)
+
+
+def _url_pool(rng, size, datasets_xml):
+    """Distinct urls to draw requests from, and their popularity."""
+    tables, grids, variables = _read_datasets(datasets_xml)
+    # dataset popularity follows a Zipf law, in a random order of the datasets
+    tables = list(rng.permutation(tables))
+    grids = list(rng.permutation(grids))
+    table_weights = _zipf_weights(len(tables))
+    grid_weights = _zipf_weights(len(grids))
+    kinds = _choice(rng, list(_request_kinds), list(_request_kinds.values()), size=size)
+    urls = [
+        _make_url(rng, kind, tables, grids, variables, table_weights, grid_weights)
+        for kind in kinds
+    ]
+    # a few urls, like the metadata polled by harvesters, are requested very often
+    return pl.Series("url", urls), rng.permutation(_zipf_weights(size, a=0.9))
+
+
+def _ip_pool(rng, size):
+    """Random public looking ipv4 addresses, their user agents and their share of requests."""
+    octets = rng.integers(1, 255, size=(size, 4))
+    octets[:, 0] = rng.choice(
+        [o for o in range(1, 224) if o not in (10, 127, 172, 192)], size=size
+    )
+    ips = pl.Series(
+        "ip", [".".join(map(str, row)) for row in octets.tolist()], dtype=pl.String
+    )
+    user_agents = pl.Series(
+        "user_agent",
+        _choice(rng, list(_user_agents), list(_user_agents.values()), size=size),
+    )
+    return ips, user_agents, _zipf_weights(size, a=1.2)
+
+
+def _log_block(rng, pools, lines, start, end):
+    """lines log lines with sorted times between the epoch seconds start and end."""
+    urls, url_weights, ips, user_agents, ip_weights = pools
+    seconds = np.sort(rng.integers(start, end, size=lines))
+    url_index = rng.choice(len(urls), p=url_weights, size=lines)
+    ip_index = rng.choice(len(ips), p=ip_weights, size=lines)
+    status = rng.choice(
+        list(_status_codes),
+        p=np.array(list(_status_codes.values())) / sum(_status_codes.values()),
+        size=lines,
+    )
+    df = pl.DataFrame(
+        {
+            "ip": ips.gather(ip_index),
+            "time": pl.from_epoch(pl.Series(seconds), time_unit="s"),
+            "method": np.where(rng.random(lines) < 0.01, "HEAD", "GET"),
+            "url": urls.gather(url_index),
+            "protocol": np.where(rng.random(lines) < 0.2, "HTTP/2.0", "HTTP/1.1"),
+            "status": status,
+            "bytes": rng.lognormal(9, 2.5, size=lines).astype(np.int64),
+            "referer": np.where(rng.random(lines) < 0.05, _referers[1], _referers[0]),
+            "user_agent": user_agents.gather(ip_index),
+            "malformed": rng.random(lines) < _malformed_fraction,
+        }
+    )
+    spam = pl.col("url").is_in(_spam)
+    request = (
+        pl.when(pl.col("malformed"))
+        .then(pl.lit("\\x16\\x03\\x01\\x02\\x00\\x01\\x00\\x01\\xFC\\x03\\x03"))
+        .otherwise(pl.concat_str("method", "url", "protocol", separator=" "))
+    )
+    return df.select(
+        line=pl.concat_str(
+            pl.col("ip"),
+            pl.lit(" - - ["),
+            pl.col("time").dt.strftime("%d/%b/%Y:%H:%M:%S +0000"),
+            pl.lit('] "'),
+            request,
+            pl.lit('" '),
+            pl.when(pl.col("malformed"))
+            .then(400)
+            .when(spam)
+            .then(404)
+            .otherwise(pl.col("status"))
+            .cast(pl.String),
+            pl.lit(" "),
+            pl.col("bytes").cast(pl.String),
+            pl.lit(' "'),
+            pl.col("referer"),
+            pl.lit('" "'),
+            pl.col("user_agent"),
+            pl.lit('"'),
+        )
+    )
+
+
+def generate_logs(
+    output_dir,
+    lines=1_000_000,
+    files=10,
+    days=30,
+    start="2024-01-01",
+    seed=0,
+    server="tomcat",
+    datasets_xml=example_data / "datasets.xml",
+    compress=False,
+    block_lines=1_000_000,
+):
+    """
+    Write synthetic ERDDAP access logs to output_dir.
+
+    Parameters
+    ----------
+    output_dir: str or Path
+        directory to write the logs to. It is created if needed
+    lines: int, default=1_000_000
+        total number of log lines
+    files: int, default=10
+        number of log files. As rotated by logrotate, file .1 holds the most recent requests
+    days: int, default=30
+        number of days the requests span, from start
+    start: str, default="2024-01-01"
+        ISO date of the first request
+    seed: int, default=0
+        seed of the random generator. The same arguments always write the same files
+    server: str, default="tomcat"
+        one of "tomcat", "nginx" or "apache", for the log file names
+    datasets_xml: str or Path
+        datasets.xml to draw dataset ids and variables from
+    compress: bool, default=False
+        if True, gzip all of the files but the most recent one, as logrotate does
+    block_lines: int, default=1_000_000
+        lines generated at a time, which bounds memory use
+
+    Returns
+    -------
+    list of Path
+        the files written, oldest first
+    """
+    if server not in _server_file_names:
+        raise ValueError(
+            f"server must be one of {list(_server_file_names)}, not {server}"
+        )
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    urls, url_weights = _url_pool(
+        rng, min(max(lines // 20, 100), 100_000), datasets_xml
+    )
+    pools = (urls, url_weights, *_ip_pool(rng, min(max(lines // 40, 50), 1_000_000)))
+    first = int(datetime.fromisoformat(start).replace(tzinfo=timezone.utc).timestamp())
+    span = days * 86400
+    written = []
+    for i in range(files):
+        # file number files holds the oldest requests
+        number = files - i
+        fn = output_dir / f"{_server_file_names[server]}.{number}"
+        if compress and number > 1:
+            fn = fn.with_name(f"{fn.name}.gz")
+        file_lines = lines // files + (i < lines % files)
+        file_start = first + span * i // files
+        file_end = first + span * (i + 1) // files
+        opener = gzip.open if fn.suffix == ".gz" else open
+        with opener(fn, "wb") as f:
+            for j in range(0, file_lines, block_lines):
+                block = min(block_lines, file_lines - j)
+                block_rng = np.random.default_rng([seed, i, j])
+                block_start = file_start + (file_end - file_start) * j // file_lines
+                block_end = (
+                    file_start + (file_end - file_start) * (j + block) // file_lines
+                )
+                _log_block(
+                    block_rng,
+                    pools,
+                    block,
+                    block_start,
+                    max(block_end, block_start + 1),
+                ).write_csv(f, include_header=False, quote_style="never")
+        written.append(fn)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("output_dir")
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--start", default="2024-01-01")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--server", choices=list(_server_file_names), default="tomcat")
+    parser.add_argument("--datasets-xml", default=example_data / "datasets.xml")
+    parser.add_argument("--compress", action="store_true")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    written = generate_logs(
+        args.output_dir,
+        lines=args.lines,
+        files=args.files,
+        days=args.days,
+        start=args.start,
+        seed=args.seed,
+        server=args.server,
+        datasets_xml=args.datasets_xml,
+        compress=args.compress,
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"wrote {args.lines} lines to {len(written)} files in {elapsed:.1f} s, "
+        f"{args.lines / elapsed:,.0f} lines/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+Command line batch driver for erddaplogs.
+
+Runs the load, filter, geolocate, parse and export pipeline on the logs of one server, with the
+options of a json config file, e.g.
+
+    erddaplogs config.json
+
+A minimal config file gives the directory of the logs and the directory to export to:
+
+    {"logs_dir": "/var/log/nginx", "output_dir": "/srv/erddaplogs"}
+
+Relative paths are taken from the directory of the config file. See _default_config for all of
+the options.
+
+Log files are processed in chunks of files_per_chunk files, oldest first. A thread parses the next
+chunk while the previous one is filtered, geolocated and exported, and parsed chunks wait in a
+queue of at most queue_size chunks. Each chunk is exported incrementally, see
+ErddapLogParser.export_data, and the log lines read are recorded in a checkpoint manifest once
+their chunk is exported. A run that is interrupted, or run again by cron, reads only the lines not
+yet recorded in the manifest, so that requests logged late, out of time order, are exported too.
+If it was interrupted after a chunk was exported but before the manifest was saved, that chunk is
+read again, and the export state skips those of its requests already exported within 10 minutes of
+the last one.
+"""
+
+import argparse
+import gzip
+import json
+import queue
+import sys
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import polars as pl
+
+from erddaplogs.ipinfo import GeoIpDatabase, IpApiClient
+from erddaplogs.logparse import (
+    ErddapLogParser,
+    _ensure_sorted,
+    _find_log_files,
+    _load_log_file,
+    _parse_log_lines,
+    _read_log_lines,
+    _read_manifest,
+    _read_new_log_file,
+    _sqlite_suffixes,
+    _write_manifest,
+)
+
+_default_config = {
+    # directory of the nginx or apache access logs, and the log file names
+    "logs_dir": None,
+    "wildcard_fname": "*access.log*",
+    # directory of the exported files and of the export state
+    "output_dir": None,
+    # checkpoint manifest of the log lines read. Defaults to log_manifest.json in output_dir
+    "manifest": None,
+    "datasets_xml": None,
+    # filters, in the order they are applied. Each is the name of a filter_ method, or a list
+    # of the name and a dict of its arguments. organisations is applied after get_ip_info
+    "filters": [
+        "non_erddap",
+        "spam",
+        "locales",
+        "user_agents",
+        "common_strings",
+        "organisations",
+    ],
+    "user_agent_cache": None,
+    # ip information. Ips are looked up in geoip_database, a csv of ip ranges, if given, or
+    # else with ip-api (ip_api_url) at most num_ips at a time. ip_info_max_age is the age in
+    # seconds after which cached entries are fetched again, which needs a SQLite cache, e.g.
+    # "ip_info_csv": "ip.db"
+    "ip_info_csv": "ip.csv",
+    "geoip_database": None,
+    "ip_api_url": "http://ip-api.com",
+    "num_ips": 60,
+    "ip_info_max_age": None,
+    "temporal_resolution": "month",
+    "export_format": "csv",
+    "export_workers": 4,
+    "compact": False,
+    "files_per_chunk": 1,
+    "queue_size": 2,
+}
+
+_path_options = [
+    "logs_dir",
+    "output_dir",
+    "manifest",
+    "datasets_xml",
+    "user_agent_cache",
+    "ip_info_csv",
+    "geoip_database",
+]
+
+# filters that need the ip information
+_ip_filters = ["organisations"]
+
+_head_bytes = 65536
+
+
+def _read_config(config_file, overrides=None):
+    """
+    Read a json config file, filling in the default options.
+
+    Relative paths are resolved from the directory of the config file. overrides are options that
+    replace those of the file, with their paths resolved from the working directory.
+    """
+    config_file = Path(config_file)
+    with open(config_file) as f:
+        config = json.load(f)
+    unknown = set(config) - set(_default_config)
+    if unknown:
+        raise ValueError(f"unknown options in {config_file}: {sorted(unknown)}")
+    for option in _path_options:
+        if config.get(option) is not None:
+            config[option] = config_file.parent / config[option]
+    for option, value in (overrides or {}).items():
+        if value is not None:
+            config[option] = Path(value) if option in _path_options else value
+    config = {**_default_config, **config}
+    for option in ["logs_dir", "output_dir"]:
+        if config[option] is None:
+            raise ValueError(f"{option} must be given in {config_file}")
+    if config["manifest"] is None:
+        config["manifest"] = Path(config["output_dir"]) / "log_manifest.json"
+    max_age = config["ip_info_max_age"]
+    if max_age is not None:
+        if isinstance(max_age, bool) or not isinstance(max_age, (int, float)):
+            raise ValueError(
+                f"ip_info_max_age must be a number of seconds, not {max_age}"
+            )
+        if Path(config["ip_info_csv"]).suffix not in _sqlite_suffixes:
+            raise ValueError(
+                f"ip_info_max_age needs a SQLite ip_info_csv, e.g. ip.db, not {config['ip_info_csv']}"
+            )
+        config["ip_info_max_age"] = timedelta(seconds=max_age)
+    return config
+
+
+def _first_timestamp(log_file):
+    """Time of the first request in a log file, None if it has none."""
+    opener = gzip.open if str(log_file).endswith(".gz") else open
+    with opener(log_file, "rb") as f:
+        head = f.read(_head_bytes)
+    head = head[: head.rfind(b"\n") + 1]
+    return _parse_log_lines(_read_log_lines(head)).collect()["datetime"].min()
+
+
+def _log_chunks(logs_dir, wildcard_fname, manifest, files_per_chunk=1):
+    """
+    Parse the new lines of the log files in logs_dir, oldest file first.
+
+    Yields
+    ------
+    dict
+        with keys df (polars.DataFrame of the parsed requests sorted by datetime, or None if the
+        files had no new lines), files (names of the files), lines (number of requests parsed),
+        seconds (time spent reading and parsing), entries (updated manifest entries of the files)
+        and replaced (paths of the manifest entries they replace)
+    """
+    log_files = _find_log_files(logs_dir, wildcard_fname)
+    # rotated logs are named newest first, so they are ordered by their first request instead
+    first = {log_file: _first_timestamp(log_file) for log_file in log_files}
+    log_files.sort(key=lambda f: (first[f] is None, first[f] or 0, str(f)))
+    unmatched = list(_read_manifest(manifest).values())
+    for i in range(0, len(log_files), files_per_chunk):
+        start = time.perf_counter()
+        chunk = {"files": [], "entries": {}, "replaced": []}
+        dfs = []
+        for log_file in log_files[i : i + files_per_chunk]:
+            before = list(unmatched)
+            data, entry = _read_new_log_file(log_file, unmatched)
+            chunk["replaced"] += [e["path"] for e in before if e not in unmatched]
+            if data:
+                df = _load_log_file(data)
+                if not df.is_empty():
+                    entry["last_timestamp"] = df["datetime"].max().isoformat()
+                dfs.append(df)
+            chunk["files"].append(log_file.name)
+            chunk["entries"][str(log_file)] = entry
+        df = None
+        if dfs:
+            # lines are only nearly in time order, within and across files
+            df = _ensure_sorted(pl.concat(dfs, how="vertical", rechunk=True))
+        chunk["df"] = df
+        chunk["lines"] = 0 if df is None else len(df)
+        chunk["seconds"] = time.perf_counter() - start
+        yield chunk
+
+
+class _Pipeline:
+    """
+    Runs a generator in a thread, handing its items over through a bounded queue.
+
+    The thread blocks when queue_size items are waiting. Exceptions raised in the thread are raised
+    again by the consumer, and the thread stops when the consumer does.
+    """
+
+    _done = object()
+
+    def __init__(self, items, queue_size=2):
+        self.items = items
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.wait_seconds = 0.0
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for item in self.items:
+                if not self._put(item):
+                    return
+        except Exception as err:
+            self._put(err)
+        finally:
+            self._put(self._done)
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self.queue.get()
+                self.wait_seconds += time.perf_counter() - start
+                if item is self._done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stopped.set()
+            self.thread.join()
+
+
+def _filter_calls(filters):
+    """Normalise the filters option to (name, kwargs) pairs, checking that the filters exist."""
+    calls = []
+    for spec in filters:
+        name, kwargs = (spec, {}) if isinstance(spec, str) else spec
+        if not hasattr(ErddapLogParser, f"filter_{name}"):
+            raise ValueError(f"unknown filter {name}")
+        calls.append((name, kwargs))
+    return calls
+
+
+def _make_parser(config, verbose=False):
+    """An ErddapLogParser set up with the options of config, reused for every chunk."""
+    parser = ErddapLogParser()
+    parser.verbose = verbose
+    parser.temporal_resolution = config["temporal_resolution"]
+    parser.user_agent_cache = config["user_agent_cache"]
+    parser.compact = config["compact"]
+    if config["datasets_xml"] is not None:
+        parser.parse_datasets_xml(config["datasets_xml"])
+    return parser
+
+
+def _process_chunk(parser, df, config, filters, backend):
+    """Filter, geolocate, parse and export the requests of one chunk. Returns the number exported."""
+    parser.df = pl.DataFrame()
+    parser._combine_requests(df, presorted=True)
+    for name, kwargs in filters:
+        if name not in _ip_filters:
+            getattr(parser, f"filter_{name}")(**kwargs)
+    parser.get_ip_info(
+        ip_info_csv=config["ip_info_csv"],
+        num_ips=config["num_ips"],
+        backend=backend,
+        max_age=config["ip_info_max_age"],
+    )
+    for name, kwargs in filters:
+        if name in _ip_filters:
+            getattr(parser, f"filter_{name}")(**kwargs)
+    parser.parse_columns()
+    kept = len(parser.df)
+    parser.export_data(
+        output_dir=config["output_dir"],
+        incremental=True,
+        export_format=config["export_format"],
+        workers=config["export_workers"],
+    )
+    return kept
+
+
+def run(config, verbose=False, quiet=False):
+    """
+    Run the pipeline on the new log lines, with the options of a config from _read_config.
+
+    Returns
+    -------
+    dict
+        totals of the run: files, lines parsed, requests kept, seconds, and seconds spent waiting
+        for chunks to be parsed
+    """
+    filters = _filter_calls(config["filters"])
+    if config["geoip_database"] is not None:
+        backend = GeoIpDatabase(config["geoip_database"])
+    else:
+        backend = IpApiClient(base_url=config["ip_api_url"], verbose=verbose)
+    output_dir = Path(config["output_dir"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = str(config["manifest"])
+    entries = _read_manifest(manifest)
+    parser = _make_parser(config, verbose=verbose)
+    totals = {"files": 0, "lines": 0, "kept": 0, "seconds": 0.0, "wait_seconds": 0.0}
+    start = time.perf_counter()
+    pipeline = _Pipeline(
+        _log_chunks(
+            config["logs_dir"],
+            config["wildcard_fname"],
+            manifest,
+            files_per_chunk=config["files_per_chunk"],
+        ),
+        queue_size=config["queue_size"],
+    )
+    for chunk in pipeline:
+        for path in chunk["replaced"]:
+            entries.pop(path, None)
+        entries.update(chunk["entries"])
+        kept = 0
+        if chunk["df"] is None:
+            _write_manifest(manifest, entries)
+        else:
+            # the manifest is saved by export_data, once the chunk has been exported
+            parser._manifest_updates[manifest] = dict(entries)
+            kept = _process_chunk(parser, chunk["df"], config, filters, backend)
+        totals["files"] += len(chunk["files"])
+        totals["lines"] += chunk["lines"]
+        totals["kept"] += kept
+        elapsed = time.perf_counter() - start
+        if not quiet:
+            print(
+                f"{', '.join(chunk['files'])}: {chunk['lines']} new lines, {kept} requests kept. "
+                f"{totals['lines']} lines in {elapsed:.1f} s, "
+                f"{totals['lines'] / max(elapsed, 1e-9):.0f} lines/s"
+            )
+    totals["seconds"] = time.perf_counter() - start
+    totals["wait_seconds"] = pipeline.wait_seconds
+    if not quiet:
+        print(
+            f"processed {totals['lines']} lines from {totals['files']} files in "
+            f"{totals['seconds']:.1f} s, {totals['wait_seconds']:.1f} s of it waiting for parsing. "
+            f"Exported {totals['kept']} requests to {output_dir}"
+        )
+    return totals
+
+
+def main(argv=None):
+    """Entry point of the erddaplogs console script."""
+    arg_parser = argparse.ArgumentParser(
+        prog="erddaplogs",
+        description="Parse, filter, geolocate, anonymize and export ERDDAP access logs.",
+    )
+    arg_parser.add_argument("config", help="json config file")
+    arg_parser.add_argument("--logs-dir", help="overrides logs_dir of the config")
+    arg_parser.add_argument("--output-dir", help="overrides output_dir of the config")
+    arg_parser.add_argument(
+        "-v", "--verbose", action="store_true", help="print the steps of each chunk"
+    )
+    arg_parser.add_argument(
+        "-q", "--quiet", action="store_true", help="print nothing unless it fails"
+    )
+    args = arg_parser.parse_args(argv)
+    try:
+        config = _read_config(
+            args.config,
+            overrides={"logs_dir": args.logs_dir, "output_dir": args.output_dir},
+        )
+        _filter_calls(config["filters"])
+    except (OSError, ValueError) as err:
+        arg_parser.error(str(err))
+    run(config, verbose=args.verbose, quiet=args.quiet)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,427 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import polars as pl
+import requests
+from requests.adapters import HTTPAdapter
+
+# columns of an ip-api.com response, see https://ip-api.com/docs/api:json
+ip_info_schema = {
+    "status": pl.String,
+    "country": pl.String,
+    "countryCode": pl.String,
+    "region": pl.String,
+    "regionName": pl.String,
+    "city": pl.String,
+    "zip": pl.String,
+    "lat": pl.Float64,
+    "lon": pl.Float64,
+    "timezone": pl.String,
+    "isp": pl.String,
+    "org": pl.String,
+    "as": pl.String,
+    "query": pl.String,
+    "message": pl.String,
+}
+
+
+def _ip_info_frame(records):
+    """DataFrame with the columns of ip_info_schema from a list of ip-api style dicts."""
+    return pl.DataFrame(
+        [{key: record.get(key) for key in ip_info_schema} for record in records],
+        schema=ip_info_schema,
+        orient="row",
+    )
+
+
+class _RateLimiter:
+    """
+    Token bucket shared by the threads of an IpApiClient.
+
+    Tokens refill at rate per period seconds. The bucket is also drained to the number of requests
+    the server reports as remaining, and blocked until the server's window resets when that
+    number reaches zero.
+    """
+
+    def __init__(self, rate, period=60.0):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.fill_rate
+                )
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+    def update(self, remaining=None, reset_seconds=None):
+        """Apply the limits reported by the server in its response headers."""
+        with self.lock:
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+                if remaining <= 0 and reset_seconds is not None:
+                    self.blocked_until = max(
+                        self.blocked_until, time.monotonic() + reset_seconds
+                    )
+
+    def block(self, seconds):
+        """Send no requests for the next seconds."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def _header_int(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class IpApiClient:
+    """
+    Fetches ip geolocation from ip-api.com, or a server with the same API.
+
+    Requests are sent from a thread pool over one pooled HTTP session. By default, up to 100 ips
+    are sent per request to the batch endpoint. Requests are rate limited with a token bucket that
+    also follows the X-Rl (requests remaining) and X-Ttl (seconds until reset) headers of the
+    server. Failed requests are retried with exponential backoff. The ips of requests that still
+    fail, or that the server rejects with another error status, are skipped.
+
+    Parameters
+    ----------
+    base_url: str, default="http://ip-api.com"
+        root url of the service, e.g. the address of a local test server
+    batch: bool, default=True
+        if True, POST up to batch_size ips at a time to /batch. Otherwise GET /json/{ip} per ip
+    batch_size: int, default=100
+        ips per batch request. ip-api.com accepts at most 100
+    requests_per_minute: int, default=None
+        rate limit. Defaults to the free ip-api.com limits, 15 for batch and 45 for single requests
+    max_workers: int, default=4
+        number of requests in flight at once
+    max_retries: int, default=5
+        attempts per request after the first before giving up on its ips
+    timeout: float, default=10
+        seconds to wait for a response
+    verbose: bool, default=False
+        if True, print progress
+    """
+
+    def __init__(
+        self,
+        base_url="http://ip-api.com",
+        batch=True,
+        batch_size=100,
+        requests_per_minute=None,
+        max_workers=4,
+        max_retries=5,
+        timeout=10,
+        verbose=False,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.batch = batch
+        self.batch_size = batch_size if batch else 1
+        if requests_per_minute is None:
+            requests_per_minute = 15 if batch else 45
+        self.rate_limiter = _RateLimiter(requests_per_minute)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.verbose = verbose
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._background = None
+
+    def _send(self, ips):
+        if self.batch:
+            return self.session.post(
+                f"{self.base_url}/batch", json=ips, timeout=self.timeout
+            )
+        return self.session.get(f"{self.base_url}/json/{ips[0]}", timeout=self.timeout)
+
+    def _fetch(self, ips):
+        """Fetch info on a list of ips in one request, retrying on errors. Returns a list of dicts."""
+        for attempt in range(self.max_retries + 1):
+            backoff = min(2**attempt, 60)
+            self.rate_limiter.acquire()
+            try:
+                resp = self._send(ips)
+            except requests.RequestException as e:
+                if self.verbose:
+                    print(f"Request failed: {e}. Retrying in {backoff} s")
+                time.sleep(backoff)
+                continue
+            reset_seconds = _header_int(resp.headers, "X-Ttl")
+            self.rate_limiter.update(_header_int(resp.headers, "X-Rl"), reset_seconds)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                if self.verbose:
+                    print(f"Server responded {resp.status_code}, backing off")
+                self.rate_limiter.block(
+                    reset_seconds
+                    if resp.status_code == 429 and reset_seconds
+                    else backoff
+                )
+                continue
+            if resp.status_code >= 400:
+                # e.g. a malformed ip in the batch, which retrying does not fix
+                print(
+                    f"Server responded {resp.status_code} for {len(ips)} ip addresses, skipping"
+                )
+                return []
+            result = resp.json()
+            return result if self.batch else [result]
+        print(f"Issue fetching data for {len(ips)} ip addresses, skipping")
+        return []
+
+    def lookup(self, ips):
+        """
+        Fetch info on ip addresses.
+
+        Parameters
+        ----------
+        ips: list of str
+            ip addresses to look up
+
+        Returns
+        -------
+        polars.DataFrame
+            one row per ip that could be fetched, with the columns of ip_info_schema
+        """
+        ips = list(ips)
+        batches = [
+            ips[i : i + self.batch_size] for i in range(0, len(ips), self.batch_size)
+        ]
+        records = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for i, result in enumerate(pool.map(self._fetch, batches)):
+                records.extend(result)
+                if self.verbose:
+                    print(f"fetched batch {i + 1} of {len(batches)}")
+        return _ip_info_frame(records)
+
+    def submit(self, ips):
+        """Start looking up ips in a background thread. Returns a Future with the result of lookup."""
+        if self._background is None:
+            self._background = ThreadPoolExecutor(max_workers=1)
+        return self._background.submit(self.lookup, ips)
+
+
+def _ipv4_to_int(expr):
+    """Expression converting dotted IPv4 strings to integers. Anything else, e.g. IPv6, becomes null."""
+    octets = expr.str.split_exact(".", 3).struct
+    return (
+        octets.field("field_0").cast(pl.UInt8, strict=False).cast(pl.Int64) * 2**24
+        + octets.field("field_1").cast(pl.UInt8, strict=False).cast(pl.Int64) * 2**16
+        + octets.field("field_2").cast(pl.UInt8, strict=False).cast(pl.Int64) * 2**8
+        + octets.field("field_3").cast(pl.UInt8, strict=False).cast(pl.Int64)
+    )
+
+
+def _ipv4_from_int(expr):
+    """Expression converting integers to dotted IPv4 strings."""
+    return pl.concat_str(
+        *[(expr // 2**shift % 256).cast(pl.String) for shift in (24, 16, 8, 0)],
+        separator=".",
+    )
+
+
+class GeoIpDatabase:
+    """
+    Resolves ip addresses offline from a local database of ip ranges.
+
+    The database is a csv file or DataFrame with one row per range of addresses. Ranges are given
+    either as CIDR blocks in a column "network", e.g. "192.0.2.0/24", or by their first and last
+    addresses in columns "start_ip" and "end_ip". Other columns named as in ip_info_schema, e.g.
+    "country", "countryCode", "city", "lat", "lon" or "org", are returned for ips in the range.
+    Ranges must not overlap. Only IPv4 ranges are used.
+
+    The ranges are kept sorted by their first address, and each ip is matched to the last range
+    starting at or below it with a vectorized join_asof.
+
+    Parameters
+    ----------
+    ranges: str, pathlib.Path or polars.DataFrame
+        path to a csv file of ip ranges, or the ranges themselves
+    columns: dict, default=None
+        mapping of column names in ranges to the names in ip_info_schema, e.g. {"country_name": "country"}
+    """
+
+    def __init__(self, ranges, columns=None):
+        if not isinstance(ranges, pl.DataFrame):
+            ranges = pl.read_csv(ranges, infer_schema_length=0)
+        if columns:
+            ranges = ranges.rename(columns)
+        if "network" in ranges.columns:
+            network = pl.col("network").str.split_exact("/", 1).struct
+            ranges = ranges.filter(pl.col("network").str.contains(".", literal=True))
+            ranges = ranges.with_columns(
+                start=_ipv4_to_int(network.field("field_0")),
+                size=pl.lit(2, pl.Int64).pow(
+                    32 - network.field("field_1").cast(pl.Int64, strict=False)
+                ),
+            ).with_columns(end=pl.col("start") + pl.col("size") - 1)
+        elif {"start_ip", "end_ip"}.issubset(ranges.columns):
+            ranges = ranges.with_columns(
+                start=_ipv4_to_int(pl.col("start_ip")),
+                end=_ipv4_to_int(pl.col("end_ip")),
+            )
+        else:
+            raise ValueError(
+                "ip ranges need a 'network' column, or 'start_ip' and 'end_ip' columns"
+            )
+        info_columns = [
+            col
+            for col in ip_info_schema
+            if col in ranges.columns and col not in ("status", "query", "message")
+        ]
+        self.ranges = (
+            ranges.drop_nulls(["start", "end"])
+            .select(
+                "start",
+                "end",
+                *[pl.col(col).cast(ip_info_schema[col]) for col in info_columns],
+            )
+            .sort("start")
+        )
+
+    def lookup(self, ips):
+        """
+        Find ip addresses in the database.
+
+        Parameters
+        ----------
+        ips: list of str
+            ip addresses to look up
+
+        Returns
+        -------
+        polars.DataFrame
+            one row per ip, with the columns of ip_info_schema. status is "fail" for ips not in the database
+        """
+        found = (
+            pl.DataFrame({"query": list(ips)}, schema={"query": pl.String})
+            .with_row_index("order")
+            .with_columns(ip_int=_ipv4_to_int(pl.col("query")).fill_null(-1))
+            .sort("ip_int")
+            .join_asof(self.ranges, left_on="ip_int", right_on="start")
+            .sort("order")
+        )
+        matched = (pl.col("ip_int") <= pl.col("end")).fill_null(False)
+        columns = {
+            col: pl.when(matched).then(pl.col(col)) for col in self.ranges.columns[2:]
+        }
+        columns["status"] = (
+            pl.when(matched).then(pl.lit("success")).otherwise(pl.lit("fail"))
+        )
+        columns["query"] = pl.col("query")
+        columns["message"] = pl.when(~matched).then(pl.lit("not in database"))
+        return found.select(
+            columns.get(col, pl.lit(None, dtype)).alias(col)
+            for col, dtype in ip_info_schema.items()
+        )
+
+
+class IpInfoCache:
+    """
+    SQLite cache of ip information, indexed by ip address.
+
+    Lookups go through the primary key index, so their cost does not grow with the size of the
+    cache, and new entries are inserted without rewriting the ones already stored. Each entry
+    records when it was fetched. Entries older than max_age are flagged as stale. They are still
+    returned, so that they can be used until they have been fetched again and replaced.
+
+    Parameters
+    ----------
+    path: str or pathlib.Path
+        path to the SQLite database file. Created if it does not exist
+    max_age: datetime.timedelta, default=None
+        age after which entries are refreshed. If None, entries are kept forever
+    """
+
+    def __init__(self, path, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        columns = ", ".join(
+            f'"{col}" {"REAL" if dtype == pl.Float64 else "TEXT"}'
+            + (" PRIMARY KEY" if col == "query" else "")
+            for col, dtype in ip_info_schema.items()
+        )
+        with self._connect() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS ip_info ({columns}, fetched REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, ips):
+        """
+        Cached information on ip addresses.
+
+        Parameters
+        ----------
+        ips: list of str
+            ip addresses to look up
+
+        Returns
+        -------
+        polars.DataFrame
+            one row per cached ip, with the columns of ip_info_schema and a Boolean column stale,
+            True for entries older than max_age
+        """
+        cutoff = (
+            0 if self.max_age is None else time.time() - self.max_age.total_seconds()
+        )
+        columns = ", ".join(f'ip_info."{col}"' for col in ip_info_schema)
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE wanted (ip TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO wanted VALUES (?)", ((ip,) for ip in ips)
+            )
+            rows = conn.execute(
+                f"SELECT {columns}, ip_info.fetched < ? FROM wanted "
+                "JOIN ip_info ON ip_info.query = wanted.ip",
+                (cutoff,),
+            ).fetchall()
+        return pl.DataFrame(
+            rows, schema={**ip_info_schema, "stale": pl.Boolean}, orient="row"
+        )
+
+    def put(self, df_ip):
+        """Store ip information, replacing any older entries for the same ips."""
+        columns = ", ".join(f'"{col}"' for col in ip_info_schema)
+        placeholders = ", ".join("?" for _ in ip_info_schema)
+        fetched = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO ip_info ({columns}, fetched) VALUES ({placeholders}, ?)",
+                (
+                    (*row, fetched)
+                    for row in df_ip.select(list(ip_info_schema)).iter_rows()
+                ),
+            )
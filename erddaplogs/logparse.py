@@ -1,13 +1,26 @@
 import os
-from copy import copy
+import functools
+import hashlib
+import hmac
+import json
+import multiprocessing
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 import polars as pl
-from collections import Counter
 from user_agents import parse
-import requests
 import re
 import gzip
 import xml.etree.ElementTree as ET
+from erddaplogs.ipinfo import (
+    IpApiClient,
+    IpInfoCache,
+    _ipv4_from_int,
+    _ipv4_to_int,
+    ip_info_schema,
+)
+from erddaplogs.sketches import HeavyHitters, VisitorSketches
 
 _date_format_dict = {
     "day": "%Y-%m-%d",
@@ -15,8 +28,250 @@ _date_format_dict = {
     "year": "%Y",
 }
 
+# polars>=1.23 selects its streaming engine with engine="streaming", older versions use streaming=True
+try:
+    pl.LazyFrame().collect(engine="streaming")
+    _streaming_kwargs = {"engine": "streaming"}
+except ValueError:
+    _streaming_kwargs = {"streaming": True}
 
-def _load_nginx_logs(nginx_logs_dir, wildcard_fname):
+
+def _collect_streaming(df):
+    """Runs a polars query plan with the streaming engine. DataFrames are returned unchanged."""
+    if isinstance(df, pl.LazyFrame):
+        return df.collect(**_streaming_kwargs)
+    return df
+
+
+# polars>=1.21 keeps the row order of the left frame in a left join only with
+# maintain_order="left", older versions always keep it
+try:
+    pl.DataFrame({"a": [1]}).join(
+        pl.DataFrame({"a": [1]}), on="a", how="left", maintain_order="left"
+    )
+    _left_join_kwargs = {"maintain_order": "left"}
+except TypeError:
+    _left_join_kwargs = {}
+
+
+def _ensure_sorted(df):
+    """
+    Sorts requests by datetime, unless they are sorted already.
+
+    Requests flagged as sorted are returned as they are. Otherwise the order is checked, which is
+    much faster than sorting, and all of the requests are sorted if any is out of order. Log files
+    are mostly in time order, so most calls do not sort. Query plans are always sorted.
+    """
+    if isinstance(df, pl.LazyFrame):
+        return df.sort("datetime", maintain_order=True)
+    if df["datetime"].is_sorted():
+        return df.set_sorted("datetime")
+    return df.sort("datetime", maintain_order=True)
+
+
+def _keep_sorted(df):
+    """
+    Flags requests as sorted by datetime after an operation that keeps the order of the rows.
+
+    Query plans are not flagged, as the streaming engine may not keep the order of joins. Their
+    order is checked by _ensure_sorted once they are collected.
+    """
+    if isinstance(df, pl.LazyFrame):
+        return df
+    return df.set_sorted("datetime")
+
+
+def _column_names(df):
+    """Column names of a DataFrame or LazyFrame, without running a LazyFrame's query plan."""
+    return df.collect_schema().names()
+
+
+# nginx log format from  Harry Reeder @hreeder https://gist.github.com/hreeder/f1ffe1408d296ce0591d
+_log_line_regex = (
+    r"(?P<ip>[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}) - - "
+    r"\[(?P<datetime>[0-9]{2}/[A-Za-z]{3}/[0-9]{4}:[0-9]{2}:[0-9]{2}:[0-9]{2} [+\-][0-9]{4})\] "
+    r'"(?i:GET|POST|HEAD|PUT|DELETE) (?P<url>.+)(?i:http)/(?:1\.1|2\.0)" '
+    r'(?P<status_code>[0-9]{3}) (?P<bytes_sent>[0-9]+) (?P<referer>-|"[^"]+") "(?P<user_agent>[^"]+)"'
+)
+# pieces of a well-formed line after splitting on '"'
+_log_prefix_regex = r"^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3} - - \[[0-9]{2}/[A-Za-z]{3}/[0-9]{4}:[0-9]{2}:[0-9]{2}:[0-9]{2} [+\-][0-9]{4}\] $"
+_log_request_regex = r"^(?i:GET|POST|HEAD|PUT|DELETE) .+(?i:http)/(?:1\.1|2\.0)$"
+_log_status_regex = r"^ [0-9]{3} [0-9]+ $"
+_log_columns = [
+    "ip",
+    "datetime",
+    "url",
+    "user_agent",
+    "status_code",
+    "bytes_sent",
+    "referer",
+]
+
+
+def _read_log_lines(log_file):
+    """
+    Reads a log file as a single column of raw text lines.
+
+    Parameters
+    ----------
+    log_file: str or Path or bytes
+        path to a plain or gzipped log file, or the raw contents of one
+
+    Returns
+    -------
+    polars.LazyFrame
+        one String column "line". Files are read when it is collected
+    """
+    # the separator is the end of line, which cannot occur within a line, so that every line is
+    # read whole whatever characters it holds
+    kwargs = dict(
+        has_header=False,
+        separator="\n",
+        quote_char=None,
+        schema={"line": pl.String},
+        encoding="utf8-lossy",
+        truncate_ragged_lines=True,
+        raise_if_empty=False,
+    )
+    if isinstance(log_file, bytes):
+        return pl.read_csv(log_file, **kwargs).lazy()
+    if str(log_file).endswith(".gz"):
+        # scan_csv can not read compressed files in older polars versions, so gzipped files are
+        # decompressed by a function of the plan, when it is collected rather than while it is built
+        def read(_):
+            with gzip.open(log_file) as f:
+                return pl.read_csv(f.read(), **kwargs)
+
+        return pl.LazyFrame(schema=kwargs["schema"]).map_batches(
+            read,
+            schema=kwargs["schema"],
+            predicate_pushdown=False,
+            projection_pushdown=False,
+            slice_pushdown=False,
+        )
+    return pl.scan_csv(log_file, **kwargs)
+
+
+def _parse_log_lines(lines):
+    """
+    Extracts request fields from raw log lines with vectorized string operations.
+
+    Well-formed lines are cut apart on their double quotes, which is much cheaper than a regex with
+    capture groups. Anything that does not fit that layout falls back to the full regex, so the
+    lines kept and the values extracted match a per-line re.search with _log_line_regex.
+
+    Parameters
+    ----------
+    lines: polars.LazyFrame
+        raw log lines in column "line", as returned by _read_log_lines
+
+    Returns
+    -------
+    polars.LazyFrame
+        parsed requests information
+    """
+    parts = pl.col("parts")
+    lines = lines.filter(pl.col("line").is_not_null()).with_columns(
+        pl.col("line").str.split('"').alias("parts")
+    )
+    lines = lines.with_columns(
+        *[
+            parts.list.get(i, null_on_oob=True).alias(f"part_{i}")
+            for i in (0, 1, 2, 3, 5)
+        ],
+        well_formed=(parts.list.len() == 7)
+        & (parts.list.get(6, null_on_oob=True) == ""),
+    ).drop("parts")
+    well_formed = (
+        pl.col("well_formed")
+        & pl.col("part_0").str.contains(_log_prefix_regex)
+        & pl.col("part_1").str.contains(_log_request_regex)
+        & pl.col("part_2").str.contains(_log_status_regex)
+        & (pl.col("part_3").str.len_bytes() > 0)
+        & (pl.col("part_5").str.len_bytes() > 0)
+    ).fill_null(False)
+    lines = lines.with_columns(well_formed.alias("well_formed"))
+    # only lines that could possibly match are sent through the (slow) capture group regex
+    lines = lines.with_columns(
+        pl.when(
+            ~pl.col("well_formed") & pl.col("line").str.contains(" - - [", literal=True)
+        )
+        .then(pl.col("line"))
+        .str.extract_groups(_log_line_regex)
+        .alias("fallback")
+    )
+
+    fast_columns = {
+        "ip": pl.col("part_0").str.slice(0, pl.col("part_0").str.len_chars() - 34),
+        "datetime": pl.col("part_0").str.slice(-28, 26),
+        "url": pl.col("part_1")
+        .str.slice(0, pl.col("part_1").str.len_chars() - 8)
+        .str.splitn(" ", 2)
+        .struct.field("field_1"),
+        "user_agent": pl.col("part_5"),
+        "status_code": pl.col("part_2").str.slice(1, 3),
+        "bytes_sent": pl.col("part_2").str.slice(5).str.strip_chars_end(" "),
+        "referer": pl.lit('"') + pl.col("part_3") + pl.lit('"'),
+    }
+    df = lines.select(
+        pl.when(pl.col("well_formed"))
+        .then(fast_columns[name])
+        .otherwise(pl.col("fallback").struct.field(name))
+        .alias(name)
+        for name in _log_columns
+    ).filter(pl.col("ip").is_not_null())
+
+    df = df.with_columns(
+        pl.col("url").str.strip_chars(),
+        pl.col("status_code").cast(pl.Int64),
+        pl.col("bytes_sent").cast(pl.Int64),
+        # convert timestamp to datetime
+        pl.col("datetime")
+        .str.strptime(pl.Datetime, format="%d/%b/%Y:%H:%M:%S %z")
+        .dt.replace_time_zone(None),
+    )
+    return df
+
+
+def _find_log_files(nginx_logs_dir, wildcard_fname):
+    """Sorted list of the log files in nginx_logs_dir matching wildcard_fname."""
+    log_files = sorted(Path(nginx_logs_dir).glob(wildcard_fname))
+    if len(log_files) == 0:
+        raise ValueError(
+            f"Supplied directory {nginx_logs_dir} contains no tomcat-access.log files",
+        )
+    return log_files
+
+
+def _scan_nginx_logs(nginx_logs_dir, wildcard_fname):
+    """
+    Builds a query plan that parses nginx logs.
+
+    Parameters
+    ----------
+    nginx_logs_dir: str
+        dir with nginx log files
+    wildcard_fname: str
+        nginx access logfile name string allowing for wildcard
+    Returns
+    -------
+    polars.LazyFrame
+        parsed requests information
+    """
+    log_files = _find_log_files(nginx_logs_dir, wildcard_fname)
+    # one contiguous chunk of lines keeps the string kernels fast when there are many small files
+    lines = pl.concat(
+        [_read_log_lines(f) for f in log_files], how="vertical", rechunk=True
+    )
+    return _parse_log_lines(lines)
+
+
+def _load_log_file(log_file):
+    """Parses a single log file. Runs in the worker processes of _load_nginx_logs."""
+    return _parse_log_lines(_read_log_lines(log_file)).collect()
+
+
+def _load_nginx_logs(nginx_logs_dir, wildcard_fname, workers=1):
     """
     Parses nginx logs.
 
@@ -26,176 +281,861 @@ def _load_nginx_logs(nginx_logs_dir, wildcard_fname):
         dir with apache log files
     wildcard_fname: str
         nginx access logfile name string allowing for wildcard
+    workers: int, default=1
+        number of processes used to parse files in parallel
     Returns
     -------
     polars.DataFrame
         parsed requests information
     """
-    # nginx log parser from  Harry Reeder @hreeder https://gist.github.com/hreeder/f1ffe1408d296ce0591d
-    csvs = list(Path(nginx_logs_dir).glob(wildcard_fname))
-    if len(csvs) == 0:
+    if workers > 1:
+        log_files = _find_log_files(nginx_logs_dir, wildcard_fname)
+        # spawn rather than fork, as forking a process with polars' thread pool running can deadlock
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(log_files)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            # map returns the frames in the order of log_files, whichever worker finishes first
+            dfs = list(pool.map(_load_log_file, log_files))
+        df_nginx = pl.concat(dfs, how="vertical", rechunk=True)
+    else:
+        df_nginx = _scan_nginx_logs(nginx_logs_dir, wildcard_fname).collect()
+    return _ensure_sorted(df_nginx)
+
+
+_fingerprint_bytes = 1024
+
+
+def _file_fingerprint(log_file, length=_fingerprint_bytes):
+    """sha1 of the first length bytes of the (decompressed) contents of a log file, and their number."""
+    opener = gzip.open if str(log_file).endswith(".gz") else open
+    with opener(log_file, "rb") as f:
+        head = f.read(length)
+    return hashlib.sha1(head).hexdigest(), len(head)
+
+
+def _read_manifest(manifest):
+    """Entries of a checkpoint manifest written by _write_manifest, keyed by file path."""
+    if not Path(manifest).exists():
+        return {}
+    with open(manifest) as f:
+        return {entry["path"]: entry for entry in json.load(f)["files"]}
+
+
+def _write_manifest(manifest, entries):
+    """Atomically replace the checkpoint manifest with entries."""
+    manifest = Path(manifest)
+    tmp = manifest.with_name(f".{manifest.name}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(
+            {"files": sorted(entries.values(), key=lambda e: e["path"])}, f, indent=1
+        )
+    os.replace(tmp, manifest)
+
+
+def _match_manifest_entry(log_file, stat, entries):
+    """
+    Finds the manifest entry recording what has already been read from log_file.
+
+    A file is recognised by its inode while logrotate renames it, and by a fingerprint of its first
+    bytes once it has been compressed to a new file. Returns None for a file not seen before.
+    """
+    for entry in entries:
+        if entry["inode"] == stat.st_ino and entry["compressed"] == str(
+            log_file
+        ).endswith(".gz"):
+            if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                return entry
+            fingerprint, _ = _file_fingerprint(log_file, entry["fingerprint_length"])
+            if fingerprint == entry["fingerprint"]:
+                return entry
+    fingerprints = {}
+    for entry in entries:
+        length = entry["fingerprint_length"]
+        if length not in fingerprints:
+            fingerprints[length] = _file_fingerprint(log_file, length)[0]
+        if fingerprints[length] == entry["fingerprint"]:
+            return entry
+    return None
+
+
+def _read_new_log_data(log_file, entry):
+    """
+    Reads the part of log_file that comes after what entry says has been read before.
+
+    Returns the new bytes and the offset, in decompressed bytes, reached. The trailing partial line
+    of a plain text log that is still being written is left for the next read.
+    """
+    compressed = str(log_file).endswith(".gz")
+    offset = 0 if entry is None else entry["offset"]
+    if not compressed and Path(log_file).stat().st_size < offset:
+        # truncated in place (logrotate copytruncate), start again
+        offset = 0
+    opener = gzip.open if compressed else open
+    with opener(log_file, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    if not compressed and not data.endswith(b"\n"):
+        data = data[: data.rfind(b"\n") + 1]
+    return data, offset + len(data)
+
+
+def _read_new_log_file(log_file, unmatched):
+    """
+    Reads the lines of log_file not recorded in a checkpoint manifest.
+
+    Parameters
+    ----------
+    log_file: Path
+        plain or gzipped log file
+    unmatched: list of dict
+        manifest entries not yet matched to a log file. The entry matching log_file is removed
+
+    Returns
+    -------
+    bytes
+        new log lines, empty if the file has not changed
+    dict
+        updated manifest entry of log_file. Its last_timestamp is that of the previous read
+    """
+    stat = log_file.stat()
+    entry = _match_manifest_entry(log_file, stat, unmatched)
+    if entry is not None:
+        unmatched.remove(entry)
+    unchanged = (
+        entry is not None
+        and entry["inode"] == stat.st_ino
+        and entry["size"] == stat.st_size
+        and entry["mtime"] == stat.st_mtime_ns
+    )
+    if unchanged:
+        data, offset = b"", entry["offset"]
+    else:
+        data, offset = _read_new_log_data(log_file, entry)
+    fingerprint, fingerprint_length = _file_fingerprint(log_file)
+    return data, {
+        "path": str(log_file),
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "offset": offset,
+        "last_timestamp": None if entry is None else entry["last_timestamp"],
+        "fingerprint": fingerprint,
+        "fingerprint_length": fingerprint_length,
+        "compressed": str(log_file).endswith(".gz"),
+    }
+
+
+def _load_new_nginx_logs(nginx_logs_dir, wildcard_fname, manifest, workers=1):
+    """
+    Parses only the log lines not recorded in a checkpoint manifest.
+
+    Parameters
+    ----------
+    nginx_logs_dir: str
+        dir with nginx log files
+    wildcard_fname: str
+        nginx access logfile name string allowing for wildcard
+    manifest: str or Path
+        path to the json checkpoint manifest. It need not exist yet
+    workers: int, default=1
+        number of processes used to parse files in parallel
+    Returns
+    -------
+    polars.DataFrame
+        parsed requests information from new files and new lines of files already seen
+    dict
+        updated manifest entries, to be saved with _write_manifest
+    """
+    log_files = _find_log_files(nginx_logs_dir, wildcard_fname)
+    old_entries = _read_manifest(manifest)
+    unmatched = list(old_entries.values())
+    new_entries = {}
+    chunks = []
+    for log_file in log_files:
+        data, entry = _read_new_log_file(log_file, unmatched)
+        new_entries[str(log_file)] = entry
+        if data:
+            chunks.append((str(log_file), data))
+    # files in the manifest from other directories are kept
+    log_dir = Path(nginx_logs_dir).resolve()
+    for path, entry in old_entries.items():
+        if entry in unmatched and Path(path).resolve().parent != log_dir:
+            new_entries[path] = entry
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(chunks)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            dfs = list(pool.map(_load_log_file, [data for _, data in chunks]))
+    else:
+        dfs = [_load_log_file(data) for _, data in chunks]
+    for (path, _), df in zip(chunks, dfs):
+        if not df.is_empty():
+            new_entries[path]["last_timestamp"] = df["datetime"].max().isoformat()
+    if dfs:
+        df_nginx = pl.concat(dfs, how="vertical", rechunk=True)
+    else:
+        df_nginx = _parse_log_lines(_read_log_lines(b"")).collect()
+    return _ensure_sorted(df_nginx), new_entries
+
+
+_log_formats = ["nginx", "apache"]
+
+
+def _server_source(source):
+    """Normalise a server's entry in the mapping passed to _load_servers to a dict of options."""
+    if not isinstance(source, dict):
+        source = {"logs_dir": source}
+    source = {
+        "format": "nginx",
+        "wildcard_fname": "*access.log*",
+        "manifest": None,
+        **source,
+    }
+    if source["format"] not in _log_formats:
         raise ValueError(
-            f"Supplied directory {nginx_logs_dir} contains no tomcat-access.log files",
+            f"log format must be one of {_log_formats}, not {source['format']}"
         )
-    lineformat = re.compile(
-        r"""(?P<ipaddress>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) - - \[(?P<dateandtime>\d{2}/[a-z]{3}/\d{4}:\d{2}:\d{2}:\d{2} ([+\-])\d{4})] ((\"(GET|POST|HEAD|PUT|DELETE) )(?P<url>.+)(http/(1\.1|2\.0)")) (?P<statuscode>\d{3}) (?P<bytessent>\d+) (?P<refferer>-|"([^"]+)") (["](?P<useragent>[^"]+)["])""",
-        re.IGNORECASE,
+    return source
+
+
+def _load_server_logs(server, logs_dir, wildcard_fname, manifest=None):
+    """
+    Parses the logs of one server. Runs in the worker processes of _load_servers.
+
+    Returns
+    -------
+    polars.DataFrame
+        parsed requests information sorted by datetime, with the server name in a server column
+    dict
+        updated manifest entries, or None if no manifest was given
+    """
+    entries = None
+    if manifest is None:
+        df = _load_nginx_logs(logs_dir, wildcard_fname)
+    else:
+        df, entries = _load_new_nginx_logs(logs_dir, wildcard_fname, manifest)
+    return df.with_columns(server=pl.lit(server, dtype=pl.String)), entries
+
+
+def _merge_sorted(dfs, key="datetime"):
+    """
+    Merges frames that are each sorted by key into one sorted frame.
+
+    Pairs of frames are merged in rounds, a k-way merge in log2(k) rounds, which avoids sorting
+    the combined rows again. Rows with equal keys keep the order of the frames.
+    """
+    dfs = list(dfs)
+    while len(dfs) > 1:
+        merged = [
+            dfs[i].merge_sorted(dfs[i + 1], key) for i in range(0, len(dfs) - 1, 2)
+        ]
+        if len(dfs) % 2:
+            merged.append(dfs[-1])
+        dfs = merged
+    return dfs[0].set_sorted(key)
+
+
+def _merge_manifest_entries(pending, entries, logs_dir):
+    """
+    Merges the manifest entries of a load of logs_dir into those of earlier loads not saved yet.
+
+    A load carries over the saved entries of files in other directories, so for those the pending
+    entries of the earlier loads are kept. The entries of files in logs_dir are those of the load.
+    """
+    log_dir = Path(logs_dir).resolve()
+    merged = dict(pending)
+    for path, entry in entries.items():
+        if path not in merged or Path(path).resolve().parent == log_dir:
+            merged[path] = entry
+    return merged
+
+
+def _load_servers(servers, workers=None, manifest_updates=None):
+    """
+    Parses the logs of several servers, one server per process, and merges them by datetime.
+
+    Parameters
+    ----------
+    servers: dict
+        server name to the directory of its logs, or to a dict with keys logs_dir and optionally
+        format ("nginx" or "apache"), wildcard_fname and manifest, a checkpoint manifest path
+    workers: int, optional
+        number of processes. Defaults to one per server, up to the number of cpus
+    manifest_updates: dict, optional
+        manifest entries by manifest path of earlier loads, not saved yet
+    Returns
+    -------
+    polars.DataFrame
+        parsed requests information of all servers sorted by datetime, with a server column
+    dict
+        manifest_updates with the updated manifest entries of the servers merged in, by manifest
+        path, to be saved with _write_manifest
+    """
+    names = list(servers)
+    sources = [_server_source(servers[name]) for name in names]
+    args = (
+        names,
+        [source["logs_dir"] for source in sources],
+        [source["wildcard_fname"] for source in sources],
+        [source["manifest"] for source in sources],
     )
-    ip, datetimestring, url, bytessent, referer, useragent, status, method = (
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
+    if workers is None:
+        workers = min(len(names), os.cpu_count() or 1)
+    if workers > 1 and len(names) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(names)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            results = list(pool.map(_load_server_logs, *args))
+    else:
+        results = list(map(_load_server_logs, *args))
+    manifests = dict(manifest_updates or {})
+    # servers may share a manifest
+    for source, (_, entries) in zip(sources, results):
+        if source["manifest"] is not None:
+            manifest = str(source["manifest"])
+            manifests[manifest] = _merge_manifest_entries(
+                manifests.get(manifest, {}), entries, source["logs_dir"]
+            )
+    return _merge_sorted([df for df, _ in results]), manifests
+
+
+def _write_parquet_store(df, store_dir, temporal_resolution, verbose=False):
+    """
+    Adds requests to a Parquet store partitioned by time, hive style.
+
+    Each partition is a directory named e.g. month=2024-05 holding one file, data.parquet. Partitions
+    that receive new requests are merged with their existing contents, de-duplicated and replaced
+    atomically. Partitions without new requests are not touched.
+
+    Parameters
+    ----------
+    df: polars.DataFrame
+        requests information, with a datetime column
+    store_dir: str or Path
+        root directory of the store
+    temporal_resolution: str
+        one of the keys of _date_format_dict, used to partition the store
+    verbose: bool, default=False
+        if True, print the partitions written
+    """
+    store_dir = Path(store_dir)
+    df = df.drop(temporal_resolution, strict=False).with_columns(
+        pl.col("datetime")
+        .dt.strftime(_date_format_dict[temporal_resolution])
+        .alias(temporal_resolution)
     )
-    for f in csvs:
-        if str(f).endswith(".gz"):
-            logfile = gzip.open(f)
-        else:
-            logfile = open(f)
-        for line in logfile.readlines():
-            data = re.search(lineformat, line)
-            if data:
-                datadict = data.groupdict()
-                ip.append(datadict["ipaddress"])
-                datetimestring.append(datadict["dateandtime"])
-                url.append(datadict["url"].strip())
-                bytessent.append(datadict["bytessent"])
-                referer.append(datadict["refferer"])
-                useragent.append(datadict["useragent"])
-                status.append(datadict["statuscode"])
-                method.append(data.group(6))
-        logfile.close()
-
-    df = pl.DataFrame(
-        {
-            "ip": ip,
-            "datetime": datetimestring,
-            "url": url,
-            "user_agent": useragent,
-            "status_code": status,
-            "bytes_sent": bytessent,
-            "referer": referer,
-        }
+    for (partition,), df_part in df.partition_by(
+        temporal_resolution, as_dict=True, include_key=False
+    ).items():
+        part_dir = store_dir / f"{temporal_resolution}={partition}"
+        part_dir.mkdir(parents=True, exist_ok=True)
+        fn = part_dir / "data.parquet"
+        if fn.exists():
+            df_part = pl.concat(
+                [pl.read_parquet(fn, hive_partitioning=False), df_part],
+                how="diagonal_relaxed",
+            ).unique(maintain_order=True)
+        tmp = part_dir / ".data.parquet.tmp"
+        df_part.sort("datetime", maintain_order=True).write_parquet(tmp)
+        os.replace(tmp, fn)
+        if verbose:
+            print(f"write file {fn}")
+
+
+def _scan_parquet_store(store_dir, start=None, end=None, columns=None):
+    """
+    Builds a query plan that reads requests back from a store written by _write_parquet_store.
+
+    Parameters
+    ----------
+    store_dir: str or Path
+        root directory of the store
+    start: datetime.datetime, optional
+        only read requests at or after this time
+    end: datetime.datetime, optional
+        only read requests before this time
+    columns: list of str, optional
+        only read these columns
+
+    Returns
+    -------
+    polars.LazyFrame
+        requests information. Partitions and row groups outside of start and end are skipped
+    """
+    store_dir = Path(store_dir)
+    partitions = sorted(store_dir.glob("*=*"))
+    if len(partitions) == 0:
+        raise ValueError(f"Supplied directory {store_dir} contains no partitions")
+    partition_col = partitions[0].name.split("=")[0]
+    date_format = _date_format_dict[partition_col]
+    df = pl.scan_parquet(
+        store_dir / "**" / "*.parquet",
+        hive_partitioning=True,
+        hive_schema={partition_col: pl.String},
     )
+    # partition names sort like the times they hold, so filtering on them prunes whole directories
+    if start is not None:
+        df = df.filter(
+            pl.col(partition_col) >= start.strftime(date_format),
+            pl.col("datetime") >= start,
+        )
+    if end is not None:
+        df = df.filter(
+            pl.col(partition_col) <= end.strftime(date_format),
+            pl.col("datetime") < end,
+        )
+    df = df.drop(partition_col)
+    if columns is not None:
+        df = df.select(columns)
+    return df
 
-    df = df.filter(pl.col("status_code") != "NaN").with_columns(
-        pl.col("status_code").cast(pl.Int64)
+
+def _read_export_state(state_file):
+    """State of an incremental export written by _write_export_state, or a new state."""
+    if state_file is None or not Path(state_file).exists():
+        return {"last_exported": None, "ip_ids": 0, "buckets": {}}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def _write_export_state(state_file, state):
+    """Atomically replace the state file of an incremental export."""
+    state_file = Path(state_file)
+    tmp = state_file.with_name(f".{state_file.name}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, state_file)
+
+
+# raw log fields identifying a request, with the time, in both eager and lazy exports
+_request_key_columns = [
+    "ip",
+    "datetime",
+    "url",
+    "user_agent",
+    "status_code",
+    "bytes_sent",
+]
+
+
+# lines of a log are only nearly in time order. Requests up to this much older than the last one
+# exported are recognised by their digests when they are loaded again, see _export_incremental
+_late_request_window = timedelta(minutes=10)
+
+
+def _request_digests(df):
+    """sha1 of the raw log fields of each request, to recognise requests already exported."""
+    fields = []
+    for col in _request_key_columns:
+        if col not in df.columns:
+            continue
+        field = pl.col(col)
+        if col == "ip" and df.schema[col].is_integer():
+            field = _ipv4_from_int(field)
+        fields.append(field.cast(pl.String).fill_null(""))
+    keys = df.select(pl.concat_str(fields, separator="\x1f")).to_series()
+    return [hashlib.sha1(key.encode()).hexdigest() for key in keys]
+
+
+# file formats of the exported requests and locations. ERDDAP serves parquet files with
+# EDDTableFromParquetFiles and csv or gzipped csv files with EDDTableFromAsciiFiles
+_export_formats = ["csv", "csv.gz", "parquet", "ndjson"]
+
+
+def _write_export(df, fn, export_format="csv"):
+    """Writes df to fn in one of _export_formats."""
+    if export_format == "parquet":
+        df.write_parquet(fn)
+    elif export_format == "ndjson":
+        df.write_ndjson(fn)
+    elif export_format == "csv.gz":
+        with gzip.open(fn, "wb", compresslevel=6) as f:
+            df.write_csv(f)
+    else:
+        df.write_csv(fn)
+
+
+def _read_exports(files, export_format="csv"):
+    """Reads and combines files written by _write_export. csv columns are read as String."""
+    if export_format == "parquet":
+        dfs = [pl.read_parquet(fn) for fn in files]
+    elif export_format == "ndjson":
+        dfs = [pl.read_ndjson(fn, infer_schema_length=None) for fn in files]
+    else:
+        dfs = [pl.read_csv(fn, infer_schema_length=0) for fn in files]
+    return pl.concat(dfs, how="diagonal_relaxed")
+
+
+def _write_partitions(
+    df, time_unit, output_dir, name, export_format="csv", workers=4, verbose=False
+):
+    """
+    Writes the rows of each time period of df to its own file, e.g. 2024-05_name.csv.
+
+    df is split once with partition_by, and the files are written concurrently from a thread
+    pool. polars releases the GIL while it writes, so the writes run in parallel. Each file is
+    written to a temporary file first, then moved into place.
+    """
+    partitions = df.partition_by(time_unit, as_dict=True, maintain_order=True)
+
+    def write(period):
+        fn = Path(output_dir) / f"{period}_{name}.{export_format}"
+        tmp = fn.with_name(f".{fn.name}.tmp")
+        _write_export(partitions[(period,)], tmp, export_format)
+        os.replace(tmp, fn)
+        if verbose:
+            print(f"write file {fn}")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(write, [period for (period,) in sorted(partitions)]))
+
+
+def _append_export(df, fn, export_format="csv", append=True):
+    """
+    Writes the rows of an existing export file followed by those of df to a temporary file.
+
+    The existing rows of csv and ndjson files are copied as bytes, not parsed, so the cost does
+    not depend on their types. Gzipped csv files get a new gzip member, which gzip readers
+    decompress as part of the same file. Parquet files are read and written again. Returns the
+    path of the temporary file, which the caller moves over fn.
+    """
+    fn = Path(fn)
+    tmp = fn.with_name(f".{fn.name}.tmp")
+    if not append or not fn.exists():
+        _write_export(df, tmp, export_format)
+        return tmp
+    if export_format == "parquet":
+        pl.concat([pl.read_parquet(fn), df], how="vertical_relaxed").write_parquet(tmp)
+        return tmp
+    if export_format in ("csv", "csv.gz"):
+        opener = gzip.open if export_format == "csv.gz" else open
+        with opener(fn, "rt") as f:
+            header = f.readline().rstrip("\n")
+        if header != ",".join(df.columns):
+            raise ValueError(
+                f"columns of {fn} differ from the export. Re-export with export_all=True"
+            )
+    shutil.copyfile(fn, tmp)
+    with open(tmp, "ab") as f:
+        if export_format == "ndjson":
+            df.write_ndjson(f)
+        elif export_format == "csv.gz":
+            with gzip.open(f, "wb", compresslevel=6) as member:
+                df.write_csv(member, include_header=False)
+        else:
+            df.write_csv(f, include_header=False)
+    return tmp
+
+
+def _merge_location_counts(df, fn, export_format="csv", merge=True):
+    """
+    Adds the location counts of an existing export file to those in df, writing a temporary file.
+
+    Returns the path of the temporary file, which the caller moves over fn.
+    """
+    fn = Path(fn)
+    tmp = fn.with_name(f".{fn.name}.tmp")
+    if merge and fn.exists():
+        keys = [col for col in df.columns if col != "total_requests"]
+        df_old = _read_exports([fn], export_format).cast(
+            {**dict.fromkeys(keys, pl.String), "total_requests": pl.Int64}
+        )
+        df = (
+            pl.concat([df_old, df], how="diagonal_relaxed")
+            .group_by(keys, maintain_order=True)
+            .agg(pl.col("total_requests").sum())
+        )
+    _write_export(df, tmp, export_format)
+    return tmp
+
+
+_user_agent_schema = {
+    "user_agent": pl.String,
+    "is_bot": pl.Boolean,
+    "BrowserFamily": pl.String,
+    "DeviceFamily": pl.String,
+    "OS": pl.String,
+}
+
+
+@functools.lru_cache(maxsize=100_000)
+def _parse_user_agent(user_agent):
+    """Bot flag, browser, device and os families of a user agent string."""
+    ua = parse(user_agent)
+    return ua.is_bot, ua.browser.family, ua.device.family, ua.os.family
+
+
+def _classify_user_agents(user_agents, known=None, cache_path=None):
+    """
+    Classifies user agents, parsing each distinct user agent only once.
+
+    User agent strings repeat a great deal, so they are parsed after de-duplication. Results are
+    looked up first in known, then in a Parquet cache file that persists between runs.
+
+    Parameters
+    ----------
+    user_agents: polars.Series
+        user agent strings, possibly repeated
+    known: polars.DataFrame, optional
+        user agents already classified, as returned by a previous call
+    cache_path: str or Path, optional
+        Parquet file of classified user agents. Created or extended with any new user agents
+
+    Returns
+    -------
+    polars.DataFrame
+        one row per distinct user agent in known, the cache and user_agents, with columns
+        user_agent, is_bot, BrowserFamily, DeviceFamily and OS
+    """
+    table = pl.DataFrame(schema=_user_agent_schema)
+    if known is not None and not known.is_empty():
+        table = known
+    if cache_path is not None and Path(cache_path).exists():
+        table = pl.concat([table, pl.read_parquet(cache_path)], how="vertical").unique(
+            subset="user_agent", keep="first", maintain_order=True
+        )
+    new = (
+        pl.DataFrame({"user_agent": user_agents.unique().drop_nulls()})
+        .join(table, on="user_agent", how="anti")
+        .get_column("user_agent")
+        .to_list()
     )
-    df = df.filter(pl.col("bytes_sent") != "NaN").with_columns(
-        pl.col("bytes_sent").cast(pl.Int64)
+    if not new:
+        return table
+    parsed = pl.DataFrame(
+        [(ua, *_parse_user_agent(ua)) for ua in new],
+        schema=_user_agent_schema,
+        orient="row",
     )
-    # convert timestamp to datetime
-    df = df.with_columns(
-        pl.col("datetime")
-        .str.strptime(pl.Datetime, format="%d/%b/%Y:%H:%M:%S %z")
-        .dt.replace_time_zone(None)
+    table = pl.concat([table, parsed], how="vertical")
+    if cache_path is not None:
+        tmp = Path(cache_path).with_name(f".{Path(cache_path).name}.tmp")
+        table.write_parquet(tmp)
+        os.replace(tmp, cache_path)
+    return table
+
+
+def _read_ip_info_csv(ip_info_csv, ips):
+    """Rows of an ip info csv file for the ips in a Series, without loading the rest of the file."""
+    if not Path(ip_info_csv).exists():
+        return pl.DataFrame(schema=ip_info_schema)
+    df_ip = pl.scan_csv(ip_info_csv, schema_overrides=ip_info_schema).join(
+        ips.to_frame("query").lazy(), on="query", how="semi"
+    )
+    return df_ip.select(
+        pl.col(col) if col in _column_names(df_ip) else pl.lit(None, dtype).alias(col)
+        for col, dtype in ip_info_schema.items()
+    ).collect()
+
+
+def _append_ip_info_csv(ip_info_csv, df_new):
+    """Append rows to an ip info csv file, creating it if needed, without rewriting existing rows."""
+    if not Path(ip_info_csv).exists():
+        df_new.write_csv(ip_info_csv)
+        return
+    header = pl.read_csv(ip_info_csv, n_rows=0).columns
+    df_new = df_new.select(
+        pl.col(col) if col in df_new.columns else pl.lit(None).alias(col)
+        for col in header
     )
-    df_nginx = df.sort(by="datetime")
-    return df_nginx
+    with open(ip_info_csv, "a") as f:
+        df_new.write_csv(f, include_header=False)
+
 
+# ip info caches with these suffixes are SQLite databases, see IpInfoCache
+_sqlite_suffixes = (".db", ".sqlite", ".sqlite3")
 
-def _get_ip_info(df, ip_info_csv, download_new=True, num_new_ips=60, verbose=False):
+
+def _get_ip_info(
+    df,
+    ip_info_csv,
+    download_new=True,
+    num_new_ips=60,
+    verbose=False,
+    backend=None,
+    max_age=None,
+):
     """
     Add ip-derived information to the requests DataFrame.
 
-    If it exists, read a .csv file with ip-derived info. If said file does
-    not exist, get ip-derived information from requests ip addresses
-    using http://ip-api.com. Add this info to the requests DataFrame and
-    create a csv file with the ip-derived information.
+    Look up the ip addresses of the requests in a cache of ip-derived info. Get ip-derived
+    information on unknown ip addresses using http://ip-api.com, and add it to the cache.
+
+    The cache is a SQLite database if ip_info_csv ends with .db, .sqlite or .sqlite3. Lookups in
+    it use an index, and entries can be refreshed after max_age. Stale entries are used until they
+    are fetched again, after the unknown ips. Otherwise, it is a csv file, to which new entries
+    are appended.
 
     Parameters
     ----------
     df: polars.DataFrame
         parsed requests information
     ip_info_csv: str
-        path to the csv file where ip information will be saved
+        path to the csv file or SQLite database where ip information will be saved
     download_new: bool, default=True
         if True, fetches information for unknown ip addresses
     num_new_ips: int, default=60
-        number of new ip addresses to fetch information for
+        number of new ip addresses to fetch information for. If None, fetch all of them
     verbose: bool, default=False
         if True, info from each newly identified ip address will be displayed on the screen
+    backend: object, default=None
+        object with a lookup(ips) method returning a DataFrame of ip information, like
+        erddaplogs.ipinfo.IpApiClient or erddaplogs.ipinfo.GeoIpDatabase. Defaults to an IpApiClient for
+        http://ip-api.com
+    max_age: datetime.timedelta, default=None
+        fetch information again for ip addresses cached longer ago than this. Needs a SQLite cache
 
     Returns
     -------
     polars.DataFrame
-        ip-derived information
+        ip-derived information on the ip addresses of the requests
     """
-    ip_counts = Counter(df["ip"]).most_common()
-    if Path(ip_info_csv).exists():
-        df_ip = pl.read_csv(ip_info_csv)
-    else:
-        df_ip = pl.DataFrame(
-            {
-                "status": "",
-                "country": "",
-                "countryCode": "",
-                "region": "",
-                "regionName": "",
-                "city": "",
-                "zip": "",
-                "lat": 0.0,
-                "lon": 0.0,
-                "timezone": "",
-                "isp": "",
-                "org": "",
-                "as": "",
-                "query": "",
-                "message": "",
-            }
+    ips = df["ip"].unique()
+    use_sqlite = Path(ip_info_csv).suffix in _sqlite_suffixes
+    stale = pl.DataFrame(schema={"ip": pl.String})
+    if use_sqlite:
+        cache = IpInfoCache(ip_info_csv, max_age=max_age)
+        df_ip = cache.get(ips)
+        stale = df_ip.filter("stale").select(pl.col("query").alias("ip"))
+        df_ip = df_ip.drop("stale")
+    elif max_age is not None:
+        raise ValueError(
+            "max_age needs a SQLite ip info cache, e.g. ip_info_csv='ip.db'"
         )
+    else:
+        df_ip = _read_ip_info_csv(ip_info_csv, ips)
+    df_new = pl.DataFrame(schema=ip_info_schema)
     if download_new:
+        # most active unknown ips first
+        ip_counts = (
+            df.group_by("ip").len().sort(["len", "ip"], descending=[True, False])
+        )
+        unknown = ip_counts.join(
+            df_ip.select(pl.col("query").alias("ip")), on="ip", how="anti"
+        )
         if verbose:
-            unkown_ips = len(
-                set(df["ip"].unique().to_list()).difference(set(df_ip["query"]))
-            )
-            if unkown_ips == 0:
+            if unknown.is_empty() and stale.is_empty():
                 print("No new ips to fetch!")
                 return df_ip
             print(
                 f"We have info on {len(df_ip)} addresses. Dataset contains {len(ip_counts)} address, of which "
-                f"{unkown_ips} are not yet known"
-            )
-        fetched_ips = 0
-        for ip, count in ip_counts:
-            if ip not in df_ip["query"]:
-                if fetched_ips >= num_new_ips:
-                    break
-                resp_raw = requests.get(f"http://ip-api.com/json/{ip}")
-                fetched_ips += 1
-                if resp_raw.status_code == 429:
-                    print("Exceeded API responses. Wait a minute and try again")
-                    break
-                resp = resp_raw.json()
-                if verbose:
-                    if "country" in resp.keys():
-                        print(
-                            f"New ip identified: {ip} in {resp['country']}. Sent {count} requests"
-                        )
-                    else:
-                        print(f"New ip identified: {ip}. Sent {count} requests")
-                try:
-                    df_ip = pl.concat((df_ip, pl.DataFrame(resp)), how="diagonal")
-                except (pl.exceptions.SchemaError, pl.exceptions.ShapeError):
-                    print(f"Issue fetching data for this ip address {ip}, skipping")
-    df_ip.write_csv(ip_info_csv)
+                f"{len(unknown)} are not yet known and {len(stale)} are to be refreshed"
+            )
+        # stale ips are refreshed once all of the unknown ones have been fetched
+        unknown = pl.concat([unknown, ip_counts.join(stale, on="ip", how="semi")])
+        new_ips = unknown if num_new_ips is None else unknown.head(num_new_ips)
+        if not new_ips.is_empty():
+            if backend is None:
+                backend = IpApiClient(verbose=verbose)
+            df_new = backend.lookup(new_ips["ip"].to_list())
+            if verbose:
+                for row in new_ips.join(
+                    df_new, left_on="ip", right_on="query", how="inner"
+                ).iter_rows(named=True):
+                    print(
+                        f"New ip identified: {row['ip']} in {row['country']}. Sent {row['len']} requests"
+                    )
+            # refreshed entries replace the stale ones
+            df_ip = pl.concat(
+                (df_ip.join(df_new.select("query"), on="query", how="anti"), df_new),
+                how="diagonal_relaxed",
+            )
+    if use_sqlite:
+        cache.put(df_new)
+    else:
+        _append_ip_info_csv(ip_info_csv, df_new)
     if verbose:
         print(f"We have info on {len(df_ip)} ip address")
     return df_ip
 
 
-def _parse_columns(df):
+# langauge codes taken from the ERDDAP source code WEB-INF/classes/gov/noaa/pfel/erddap/util/TranslateMessages.java
+_language_names_by_code = {
+    "en": "English",
+    "bn": "Bengali",
+    "zh-CN": "Chinese-CN",
+    "zh-TW": "Chinese-TW",
+    "cs": "Czech",
+    "da": "Danish",
+    "nl": "Dutch",
+    "fi": "Finnish",
+    "fr": "French",
+    "de": "German",
+    "el": "Greek",
+    "gu": "Gujarati",
+    "hi": "Hindi",
+    "hu": "Hungarian",
+    "id": "Indonesian",
+    "ga": "Irish",
+    "it": "Italian",
+    "ja": "Japanese",
+    "ko": "Korean",
+    "mr": "Marathi",
+    "no": "Norwegian",
+    "pl": "Polish",
+    "pt": "Portuguese",
+    "pa": "Punjabi",
+    "ro": "Romanian",
+    "ru": "Russian",
+    "es": "Spanish",
+    "sw": "Swahili",
+    "sv": "Swedish",
+    "tl": "Tagalog",
+    "th": "Thai",
+    "tr": "Turkish",
+    "uk": "Ukrainian",
+    "ur": "Urdu",
+    "vi": "Vietnamese",
+}
+
+_request_types = [
+    "tabledap",
+    "subscriptions",
+    "info",
+    "files",
+    "legal",
+    "convert",
+    "griddap",
+    "categorize",
+    "index",
+    "dataProviderForm",
+    "metadata",
+    "information",
+    "status",
+    "search",
+    "slidesorter",
+    "rest",
+    "sos",
+    "wcs",
+    "wms",
+    "rss",
+    "outOfDateDatasets",
+    "sitemap",
+    "download",
+    "images",
+    "public",
+    "opensearch1",
+    "logout",
+    "setDatasetFlag",
+]
+
+# request types matched by the start of the first path element, e.g. login.html or version.txt
+_request_type_prefixes = ["login", "version", "dataProviderForm"]
+
+
+def _parse_urls(df):
     """
-    Parses the requests and other columns to generate extra columns of data
+    Decompose request urls in a single pass.
 
-    Get base_url, request_kwargs and file_type
-    from the request url. Discard the versions
-    of user_agents and separate ip addresses into
-    groups and subnets.
+    Each string is split once, and all of the new columns are taken from the fields of the
+    splits. The language code, if present, is removed from the url so that it does not affect
+    subsequent classification (e.g. of tabledap vs griddap vs files). The remaining url is split
+    into base_url and request_kwargs, and its path into the erddap request type, dataset_id and
+    file_type.
 
     Parameters
     ----------
@@ -205,149 +1145,280 @@ def _parse_columns(df):
     Returns
     -------
     polars.DataFrame
-        requests DataFrame with additional information, suitable for plotting
+        requests DataFrame with the columns language_code, language, erddap_request_type, base_url,
+        request_kwargs, dataset_id and file_type
     """
-    df = df.with_columns(pl.col("country").fill_null("unknown"))
-    df = df.with_columns(pl.col("url").str.replace(" ", ""))
+    columns = _column_names(df)
+    # split each string once into a temporary struct column, then take fields from it
+    segments = pl.col("_segments").struct
+    df = df.with_columns(_segments=pl.col("url").str.splitn("/", 4))
     df = df.with_columns(
-        pl.col("url")
-        .str.split_exact("?", 2)
-        .struct.rename_fields(["base_url", "request_kwargs"])
-        .alias("fields")
-    ).unnest("fields")
-    df = df.with_columns(
-        pl.col("base_url")
-        .str.split_exact("/", 3)
-        .struct.rename_fields(["blank", "root", "first_unsplit", "dataset_id_filetype"])
-        .alias("fields")
-    ).unnest("fields")
-
+        _is_language=segments.field("field_2").is_in(list(_language_names_by_code))
+    )
     df = df.with_columns(
-        pl.col("first_unsplit")
-        .str.split_exact(".", 2)
-        .struct.rename_fields(["first", "postdot"])
-        .alias("fields")
-    ).unnest("fields")
-
-    request_types = [
-        "tabledap",
-        "subscriptions",
-        "info",
-        "files",
-        "legal",
-        "convert",
-        "griddap",
-        "categorize",
-        "index",
-        "dataProviderForm",
-        "metadata",
-        "information",
-        "status",
-        "search",
-        "slidesorter",
-        "rest",
-        "sos",
-        "wcs",
-        "wms",
-        "dataProviderForm",
-        "rss",
-        "outOfDateDatasets",
-        "sitemap",
-        "download",
-        "images",
-        "public",
-        "opensearch1",
-        "logout",
-        "setDatasetFlag",
-    ]
-
-    df = df.with_columns(erddap_request_type=pl.lit(None))
-    for protocol in request_types:
-        df = df.with_columns(
-            erddap_request_type=pl.when(pl.col("first") == protocol)
-            .then(pl.col("first"))
-            .otherwise(pl.col("erddap_request_type"))
+        language_code=pl.when(pl.col("_is_language"))
+        .then(segments.field("field_2"))
+        .otherwise(pl.lit("en")),
+        url=pl.when(pl.col("_is_language"))
+        .then(
+            pl.concat_str(
+                segments.field("field_0"),
+                pl.lit("/"),
+                segments.field("field_1"),
+                pl.lit("/"),
+                segments.field("field_3").fill_null(""),
+            )
         )
-    df = df.with_columns(
-        erddap_request_type=pl.when(pl.col("first").str.slice(0, 5) == "login")
-        .then(pl.lit("login"))
-        .otherwise(pl.col("erddap_request_type"))
+        .otherwise(pl.col("url"))
+        .str.replace(" ", "", literal=True),
     )
+
+    query = pl.col("_query").struct
+    df = df.with_columns(_query=pl.col("url").str.split_exact("?", 1))
     df = df.with_columns(
-        erddap_request_type=pl.when(pl.col("first").str.slice(0, 7) == "version")
-        .then(pl.lit("version"))
-        .otherwise(pl.col("erddap_request_type"))
+        base_url=query.field("field_0"), request_kwargs=query.field("field_1")
     )
+
+    path = pl.col("_path").struct
+    df = df.with_columns(_path=pl.col("base_url").str.split_exact("/", 3))
     df = df.with_columns(
-        erddap_request_type=pl.when(
-            pl.col("first").str.slice(0, 16) == "dataProviderForm"
-        )
-        .then(pl.lit("dataProviderForm"))
-        .otherwise(pl.col("erddap_request_type"))
+        _first=path.field("field_2").str.split_exact(".", 1).struct.field("field_0"),
+        _dataset=path.field("field_3").str.split_exact(".", 2),
     )
 
-    # get file type and dataset id
+    first = pl.col("_first")
+    erddap_request_type = pl.when(first.is_in(_request_types)).then(first)
+    for prefix in _request_type_prefixes:
+        erddap_request_type = (
+            pl.when(first.str.starts_with(prefix))
+            .then(pl.lit(prefix))
+            .otherwise(erddap_request_type)
+        )
+    dataset = pl.col("_dataset").struct
     df = df.with_columns(
-        pl.col("dataset_id_filetype")
-        .str.split_exact(".", 2)
-        .struct.rename_fields(["dataset_id", "file_type"])
-        .alias("fields")
-    ).unnest("fields")
+        language=pl.col("language_code").replace_strict(
+            _language_names_by_code, return_dtype=pl.String
+        ),
+        erddap_request_type=erddap_request_type,
+        dataset_id=dataset.field("field_0"),
+        file_type=dataset.field("field_1"),
+    )
+    return df.select(
+        *columns,
+        "language_code",
+        "language",
+        "erddap_request_type",
+        "base_url",
+        "request_kwargs",
+        "dataset_id",
+        "file_type",
+    )
+
+
+def _parse_columns(df):
+    """
+    Parses the requests and other columns to generate extra columns of data
+
+    Get language, base_url, request_kwargs, dataset_id and file_type
+    from the request url with _parse_urls and separate ip addresses
+    into groups and subnets.
+
+    Parameters
+    ----------
+    df: polars.DataFrame
+        DataFrame with requests information
+
+    Returns
+    -------
+    polars.DataFrame
+        requests DataFrame with additional information, suitable for plotting
+    """
+    if "country" in _column_names(df):
+        df = df.with_columns(pl.col("country").fill_null("unknown"))
+    df = _parse_urls(df)
 
     # extract grouped ip addresses
+    octets = pl.col("_octets").struct
+    df = df.with_columns(_octets=pl.col("ip").str.split_exact(".", 3))
     df = df.with_columns(
-        pl.col("ip")
-        .str.split_exact(".", 2, inclusive=True)
-        .struct.rename_fields(["ip_0", "ip_1", "ip_2", "ip_3"])
-        .alias("fields")
-    ).unnest("fields")
+        ip_subnet=pl.concat_str(
+            octets.field("field_0"),
+            octets.field("field_1"),
+            octets.field("field_2"),
+            separator=".",
+        ),
+        ip_group=pl.concat_str(
+            octets.field("field_0"), octets.field("field_1"), separator="."
+        ),
+    ).drop("_octets")
 
-    df = df.with_columns(
-        pl.col("ip")
-        .str.split_exact(".", 2)
-        .struct.rename_fields(["ip_0_nodot", "ip_1_nodot", "ip_2_nodot", "ip_3_nodot"])
-        .alias("fields")
-    ).unnest("fields")
+    return df
+
+
+# an email address in a query string, with the & that follows it unless it is the last field
+_email_regex = r"email=[^&]*&?"
+
+
+def _anonymize_query(column):
+    """Expression that removes email= and the address from the query strings in column."""
+    return pl.col(column).cast(pl.String).str.replace_all(_email_regex, "")
+
+
+# percent encoded characters of the ERDDAP query syntax. %26 (&) is left encoded so that it does
+# not split the fields of the query
+_query_escapes = {
+    "%2C": ",",
+    "%3E": ">",
+    "%3C": "<",
+    "%3D": "=",
+    "%21": "!",
+    "%7E": "~",
+    "%22": '"',
+    "%5B": "[",
+    "%5D": "]",
+    "%28": "(",
+    "%29": ")",
+    "%3A": ":",
+    "%20": " ",
+}
+_query_escapes.update({key.lower(): value for key, value in _query_escapes.items()})
+
+_constraint_regex = r'^(?P<variable>[A-Za-z_][A-Za-z0-9_]*)(?P<operator>=~|!=|<=|>=|=|<|>)"?(?P<value>.*?)"?$'
+
+_query_types = ["tabledap", "griddap"]
 
+
+def _query_time(value):
+    """Expression that parses ISO 8601 times from the query, ignoring fractional seconds and the time zone."""
+    value = value.str.strip_suffix("Z").str.slice(0, 19)
+    return pl.coalesce(
+        value.str.to_datetime("%Y-%m-%dT%H:%M:%S", strict=False),
+        value.str.to_datetime("%Y-%m-%dT%H:%M", strict=False),
+        value.str.to_datetime("%Y-%m-%d", strict=False),
+    )
+
+
+def _parse_query(df):
+    """
+    Parse the request_kwargs of tabledap and griddap requests into structured columns.
+
+    The query is percent decoded and split once on &. The first field, unless it is a constraint
+    or a filter like .draw or distinct(), holds the comma separated variables requested, from
+    which griddap dimension brackets are removed. The fields of the form variable operator value
+    are constraints. The requested time range is taken from the constraints on time for tabledap,
+    or from the first dimension of the first griddap variable, e.g. var[(2024-01-01):1:(2024-02-01)].
+    Other request types, and times that are not ISO 8601 like max(time), are left null.
+
+    Parameters
+    ----------
+    df: polars.DataFrame
+        DataFrame with requests information, after _parse_columns
+
+    Returns
+    -------
+    polars.DataFrame
+        requests DataFrame with the additional columns variables (list of strings), constraints
+        (list of structs of variable, operator and value), time_min and time_max
+    """
+    is_query = pl.col("erddap_request_type").cast(pl.String).is_in(_query_types)
+    query = (
+        pl.col("request_kwargs")
+        .cast(pl.String)
+        .str.replace_many(list(_query_escapes), list(_query_escapes.values()))
+    )
+    df = df.with_columns(_fields=pl.when(is_query).then(query.str.split("&")))
+
+    first = pl.col("_fields").list.first()
+    is_variables = ~first.str.contains(_constraint_regex) & ~first.str.contains(
+        r"^\.|\(\)$"
+    )
+    variables = (
+        pl.when(is_variables)
+        .then(first.str.replace_all(r"\[[^\]]*\]", "").str.split(","))
+        .otherwise(pl.lit([], dtype=pl.List(pl.String)))
+        .list.eval(pl.element().filter(pl.element().str.len_chars() > 0))
+    )
+    constraints = pl.col("_fields").list.eval(
+        pl.element()
+        .str.extract_groups(_constraint_regex)
+        .filter(pl.element().str.contains(_constraint_regex))
+    )
     df = df.with_columns(
-        pl.concat_str(["ip_0", "ip_1", "ip_2_nodot"]).alias("ip_subnet")
+        variables=pl.when(is_query).then(variables),
+        constraints=constraints,
+        _grid=pl.when(pl.col("erddap_request_type").cast(pl.String) == "griddap").then(
+            first.str.extract(r"^[^\[]*(\[[^\]]*\])", 1)
+        ),
     )
-    df = df.with_columns(pl.concat_str(["ip_0", "ip_1_nodot"]).alias("ip_group"))
-
-    # remove junk columns and sortby time
-    junk_columns = [
-        "blank",
-        "root",
-        "first",
-        "first_unsplit",
-        "dot",
-        "rest",
-        "postdot",
-        "junk",
-        "ip_0",
-        "ip_1",
-        "ip_2",
-        "ip_3",
-        "ip_0_nodot",
-        "ip_1_nodot",
-        "ip_2_nodot",
-        "ip_3_nodot",
-        "dataset_id_filetype",
-    ]
-    for junk_col in junk_columns:
-        if junk_col in df.columns:
-            df = df.drop([junk_col])
-
-    df = df.sort(by="datetime")
 
-    return df
+    def time_constraint(operators):
+        return pl.col("constraints").list.eval(
+            pl.element()
+            .filter(
+                (pl.element().struct.field("variable") == "time")
+                & pl.element().struct.field("operator").is_in(operators)
+            )
+            .struct.field("value")
+        )
 
+    df = df.with_columns(
+        time_min=_query_time(
+            pl.coalesce(
+                time_constraint([">=", ">"]).list.first(),
+                pl.col("_grid").str.extract(r"^\[\(([^)]*)\)", 1),
+            )
+        ),
+        time_max=_query_time(
+            pl.coalesce(
+                time_constraint(["<=", "<"]).list.first(),
+                pl.col("_grid").str.extract(r"\(([^)]*)\)\]$", 1),
+            )
+        ),
+    )
+    return df.drop("_fields", "_grid")
+
+
+# highly repetitive String columns, stored as Categorical in compact mode. Short codes like
+# countryCode take less space as String than as a 4 byte category. Urls and queries are mostly
+# distinct, so they are left as String
+_categorical_columns = [
+    "user_agent",
+    "referer",
+    "language_code",
+    "status",
+    "country",
+    "regionName",
+    "city",
+    "timezone",
+    "isp",
+    "org",
+    "as",
+    "dataset_id",
+    "dataset_type",
+    "file_type",
+    "ip_subnet",
+    "ip_group",
+    "BrowserFamily",
+    "DeviceFamily",
+    "OS",
+]
+
+# columns with a fixed set of values, stored as Enum in compact mode
+_enum_columns = {
+    "erddap_request_type": pl.Enum(
+        list(dict.fromkeys(_request_types + _request_type_prefixes))
+    ),
+    "language": pl.Enum(list(_language_names_by_code.values())),
+}
 
-def _parse_language_data(df):
+
+def _compact_columns(df):
     """
-    Parses the langauge data from requests urls. Adds two additional columns with the language codes as they
-    appear in the original urls and the named languages. Then, it removes the language section from the original
-    url so that it does not affect subsequent classification (e.g. of tabledap vs griddap vs files)
+    Dictionary encode repetitive columns to reduce memory use.
+
+    String columns with few distinct values are cast to Categorical, or to Enum where all of the
+    possible values are known, and the ip address is stored as a UInt32.
+
     Parameters
     ----------
     df: polars.DataFrame
@@ -356,150 +1427,142 @@ def _parse_language_data(df):
     Returns
     -------
     polars.DataFrame
-        requests DataFrame with parsed language information
-    """
-    # langauge codes taken from the ERDDAP source code WEB-INF/classes/gov/noaa/pfel/erddap/util/TranslateMessages.java
-
-    language_codes = [
-        "en",
-        "bn",
-        "zh-CN",
-        "zh-TW",
-        "cs",
-        "da",
-        "nl",
-        "fi",
-        "fr",
-        "de",
-        "el",
-        "gu",
-        "hi",
-        "hu",
-        "id",
-        "ga",
-        "it",
-        "ja",
-        "ko",
-        "mr",
-        "no",
-        "pl",
-        "pt",
-        "pa",
-        "ro",
-        "ru",
-        "es",
-        "sw",
-        "sv",
-        "tl",
-        "th",
-        "tr",
-        "uk",
-        "ur",
-        "vi",
-    ]
-
-    language_names = [
-        "English",
-        "Bengali",
-        "Chinese-CN",
-        "Chinese-TW",
-        "Czech",
-        "Danish",
-        "Dutch",
-        "Finnish",
-        "French",
-        "German",
-        "Greek",
-        "Gujarati",
-        "Hindi",
-        "Hungarian",
-        "Indonesian",
-        "Irish",
-        "Italian",
-        "Japanese",
-        "Korean",
-        "Marathi",
-        "Norwegian",
-        "Polish",
-        "Portuguese",
-        "Punjabi",
-        "Romanian",
-        "Russian",
-        "Spanish",
-        "Swahili",
-        "Swedish",
-        "Tagalog",
-        "Thai",
-        "Turkish",
-        "Ukrainian",
-        "Urdu",
-        "Vietnamese",
-    ]
-    langauge_names_by_code = {
-        code: name for code, name in zip(language_codes, language_names)
+        requests DataFrame with compact column types
+    """
+    schema = df.collect_schema() if isinstance(df, pl.LazyFrame) else df.schema
+    casts = {
+        col: pl.col(col).cast(pl.Categorical)
+        for col in _categorical_columns
+        if schema.get(col) == pl.String
     }
+    for col, dtype in _enum_columns.items():
+        if schema.get(col) == pl.String:
+            casts[col] = pl.col(col).cast(dtype)
+    if schema.get("ip") == pl.String:
+        casts["ip"] = _ipv4_to_int(pl.col("ip")).cast(pl.UInt32)
+    return df.with_columns(**casts)
+
+
+_cube_dimensions = [
+    "server",
+    "dataset_id",
+    "erddap_request_type",
+    "file_type",
+    "status_code",
+    "country",
+    "countryCode",
+    "regionName",
+    "city",
+]
+
+_cube_measures = ["requests", "bytes_sent"]
+
+
+def _sum_cube(df, keys):
+    """Sum the measures of a cube, or of partial cubes, over the combinations of keys."""
+    return (
+        df.group_by(keys).agg(pl.col(_cube_measures).sum()).sort(keys, nulls_last=True)
+    )
 
+
+def _build_cube(df, dimensions, every="1h"):
+    """
+    Counts requests and sums bytes sent per time bucket and combination of dimensions, in one pass.
+
+    Parameters
+    ----------
+    df: polars.DataFrame or polars.LazyFrame
+        requests information, with datetime and bytes_sent columns
+    dimensions: list of str
+        columns to group by. Those not present in df are skipped
+    every: str, default="1h"
+        width of the time buckets, in the polars duration format
+
+    Returns
+    -------
+    polars.DataFrame or polars.LazyFrame
+        one row per non-empty bucket and combination of dimensions, with the start of the bucket in
+        the datetime column and the measures in requests and bytes_sent. Text dimensions are String
+    """
+    names = _column_names(df)
+    keys = ["datetime"] + [col for col in dimensions if col in names]
     df = df.with_columns(
-        pl.col("url")
-        .str.split_exact("/", 3, inclusive=True)
-        .struct.rename_fields(["blank", "root", "first", "rest"])
-        .alias("fields")
-    ).unnest("fields")
-    df = df.with_columns(
-        pl.col("url")
-        .str.split_exact("/", 3)
-        .struct.rename_fields(
-            ["blank_noslash", "root_noslash", "first_noslash", "rest_noslash"]
-        )
-        .alias("fields")
-    ).unnest("fields")
-    df = df.with_columns(
-        pl.col("url")
-        .str.splitn("/", 4)
-        .struct.rename_fields(["blank_n", "root_n", "first_n", "rest_n"])
-        .alias("fields")
-    ).unnest("fields")
-
-    potential_langauge_col = df["first_noslash"].to_numpy()
-    corrected_language_col = df["first"].to_numpy()
-    languages_present = set(df["first_noslash"].unique().to_numpy()).intersection(
-        language_codes
+        pl.col("datetime").dt.truncate(every),
+        pl.selectors.by_dtype(pl.Categorical, pl.Enum).cast(pl.String),
+    )
+    return (
+        df.group_by(keys)
+        .agg(pl.len().cast(pl.Int64).alias("requests"), pl.col("bytes_sent").sum())
+        .sort(keys, nulls_last=True)
     )
-    language_col = potential_langauge_col.copy()
-    language_col[:] = "English"
-    language_code_col = potential_langauge_col.copy()
-    language_code_col[:] = "en"
-
-    for language_code in languages_present:
-        corrected_language_col[potential_langauge_col == language_code] = ""
-        language_code_col[potential_langauge_col == language_code] = language_code
-        language_col[potential_langauge_col == language_code] = langauge_names_by_code[
-            language_code
+
+
+def _rollup_cube(cube, every=None, dimensions=None):
+    """
+    Rolls a cube up to wider time buckets, fewer dimensions, or both.
+
+    Parameters
+    ----------
+    cube: polars.DataFrame
+        a cube from _build_cube
+    every: str, optional
+        width of the new time buckets, e.g. "1d" or "1mo". Must be a multiple of the cube's buckets
+    dimensions: list of str, optional
+        dimensions to keep. Defaults to all of them
+
+    Returns
+    -------
+    polars.DataFrame
+        the rolled up cube
+    """
+    if dimensions is None:
+        dimensions = [
+            col for col in cube.columns if col not in _cube_measures + ["datetime"]
         ]
+    if every is not None:
+        cube = cube.with_columns(pl.col("datetime").dt.truncate(every))
+    return _sum_cube(cube, ["datetime"] + list(dimensions))
 
-    df = df.with_columns(language_code=language_code_col)
-    df = df.with_columns(language=language_col)
-    df = df.with_columns(first=corrected_language_col)
 
-    df = df.with_columns(
-        erddap_request_type=pl.when(pl.col("rest_n").is_not_null())
-        .then(pl.lit("/") + pl.col("rest_n"))
-        .otherwise(pl.col("rest_n"))
-    )
+def _merge_cube(old, new, accumulate=False):
+    """
+    Merges a new cube into a stored one with the same time buckets.
+
+    By default the buckets present in new replace those in old, so that re-processing the same logs
+    does not count requests twice. With accumulate=True the measures are added instead, for cubes of
+    disjoint requests, e.g. from successive runs with a checkpoint manifest.
+    """
+    if not accumulate:
+        old = old.filter(~pl.col("datetime").is_in(new["datetime"].unique()))
+    return _rollup_cube(pl.concat([old, new], how="diagonal_relaxed"))
+
 
-    df = df.with_columns(
-        pl.concat_str(["blank", "root", "first", "rest_n"], ignore_nulls=True).alias(
-            "url"
-        )
+def _read_sketches(sketch_dir, every):
+    """Visitor sketches and a dict of heavy hitter sketches by column, from a directory of sketches."""
+    sketch_dir = Path(sketch_dir)
+    visitors = VisitorSketches.from_frame(
+        pl.read_parquet(sketch_dir / "visitors.parquet"), every=every
     )
+    heavy_hitters = {
+        col: HeavyHitters.from_bytes(data)
+        for col, data in pl.read_parquet(sketch_dir / "top.parquet").iter_rows()
+    }
+    return visitors, heavy_hitters
 
-    if "rest" in df.columns:
-        df = df.drop(["blank", "root", "first", "rest"])
-    if "rest_noslash" in df.columns:
-        df = df.drop(["blank_noslash", "root_noslash", "first_noslash", "rest_noslash"])
-    if "rest_n" in df.columns:
-        df = df.drop(["blank_n", "root_n", "first_n", "rest_n"])
-    return df
+
+def _contains_any(column, patterns, literal=False):
+    """
+    Expression that is True where a string column contains any of several patterns.
+
+    Literal patterns are matched together with str.contains_any (Aho-Corasick). Regex patterns are
+    joined into one alternation. Either way the column is scanned once, not once per pattern.
+    """
+    patterns = list(patterns)
+    if not patterns:
+        return pl.lit(False)
+    if literal:
+        return pl.col(column).str.contains_any(patterns)
+    return pl.col(column).str.contains("|".join(f"(?:{p})" for p in patterns))
 
 
 def _print_filter_stats(call_wrap):
@@ -510,9 +1573,14 @@ def _print_filter_stats(call_wrap):
     before and after filtering.
     """
 
-    def magic(self):
+    @functools.wraps(call_wrap)
+    def magic(self, *args, **kwargs):
+        if isinstance(self.df, pl.LazyFrame):
+            # filters are only added to the query plan, there is nothing to count yet
+            call_wrap(self, *args, **kwargs)
+            return
         len_before = len(self.df)
-        call_wrap(self)
+        call_wrap(self, *args, **kwargs)
         if self.verbose:
             print(
                 f"Filter {self.filter_name} dropped {len_before - len(self.df)} lines. Length of dataset is now "
@@ -528,30 +1596,55 @@ class ErddapLogParser:
         self.ip = pl.DataFrame()
         self.anonymized = pl.DataFrame()
         self.location = pl.DataFrame()
+        self.cube = pl.DataFrame()
+        self.visitor_sketches = None
+        self.heavy_hitters = {}
+        # heavy hitter counts added since the sketches were last written or loaded
+        self._unwritten_heavy_hitters = {}
         self.df_xml = pl.DataFrame()
         self.verbose = False
         self.original_total_requests = 0
         self.filter_name = None
         self.temporal_resolution = "month"
+        self.lazy = False
+        self.user_agent_cache = None
+        self.ip_key = None
+        self.compact = False
+        self.star_schema = False
+        self.filter_stats = pl.DataFrame()
+        self.user_agents = pl.DataFrame(schema=_user_agent_schema)
+        self._manifest_updates = {}
+        self._ip_id_offset = 0
+        # running-number ip ids of earlier exports, by time period and ip, see _export_incremental
+        self._known_ip_ids = {}
+        self._ip_ids = None
+        self._reset_filter_history()
 
     def _update_original_total_requests(self):
         """Update the number of requests in the DataFrame."""
+        self._reset_filter_history()
+        if isinstance(self.df, pl.LazyFrame):
+            return
         self.original_total_requests = len(self.df)
-        self.unfiltered_df = copy(self.df)
         if self.verbose:
             print(f"DataFrame now has {self.original_total_requests} lines")
 
     def subset_df(self, rows=1000):
-        if self.df.shape[0] < rows:
+        """
+        Subset the requests DataFrame. Default rows=1000.
+
+        In lazy mode this runs the query plan to count the requests, re-reading the logs.
+        """
+        total_rows = self.df.select(pl.len()).lazy().collect().item()
+        if total_rows < rows:
             print(
-                f"DataFrame length {self.df.shape[0]} lines is less than requested {rows} rows. Returning"
+                f"DataFrame length {total_rows} lines is less than requested {rows} rows. Returning"
             )
             return
-        """Subset the requests DataFrame. Default rows=1000."""
-        stride = int(self.df.shape[0] / rows)
+        stride = int(total_rows / rows)
         if self.verbose:
             print(
-                f"starting from DataFrame with {self.df.shape[0]} lines. Subsetting by a factor of {stride}"
+                f"starting from DataFrame with {total_rows} lines. Subsetting by a factor of {stride}"
             )
         self.df = self.df.gather_every(stride)
         if self.verbose:
@@ -560,93 +1653,698 @@ class ErddapLogParser:
             )
         self._update_original_total_requests()
 
-    def load_apache_logs(self, apache_logs_dir: str, wildcard_fname="*access.log*"):
-        """Parse apache logs."""
-        df_apache = _load_nginx_logs(apache_logs_dir, wildcard_fname)
+    def _add_logs(self, logs_dir, wildcard_fname, workers=1, manifest=None):
+        """Parse logs from logs_dir and combine them with any requests already loaded."""
+        if manifest is not None:
+            df_new, entries = _load_new_nginx_logs(
+                logs_dir, wildcard_fname, manifest, workers=workers
+            )
+            # several directories may be loaded before the manifest is saved
+            self._manifest_updates[str(manifest)] = _merge_manifest_entries(
+                self._manifest_updates.get(str(manifest), {}), entries, logs_dir
+            )
+            if self.verbose:
+                print(f"loaded {len(df_new)} new log lines from {logs_dir}")
+        elif self.lazy and workers == 1:
+            df_new = _scan_nginx_logs(logs_dir, wildcard_fname)
+            if self.verbose:
+                print(f"added logs from {logs_dir} to the query plan")
+        else:
+            df_new = _load_nginx_logs(logs_dir, wildcard_fname, workers=workers)
+            if self.verbose:
+                print(f"loaded {len(df_new)} log lines from {logs_dir}")
+        # the loaders sort the requests they parse, a query plan is not sorted yet
+        self._combine_requests(df_new, presorted=isinstance(df_new, pl.DataFrame))
+
+    def _combine_requests(self, df_new, deduplicate=True, presorted=False):
+        """
+        Add newly loaded requests to any already loaded, dropping duplicates.
+
+        If presorted, df_new is already sorted by datetime. It is then merged with the loaded
+        requests, which are always sorted, rather than sorting all of them again.
+        """
+        df_combi = df_new
+        if _column_names(self.df):
+            if presorted and self.df.collect_schema() == df_new.collect_schema():
+                df_combi = self.df.lazy().merge_sorted(df_new.lazy(), "datetime")
+            else:
+                # requests loaded with and without a server column are combined
+                df_combi = pl.concat(
+                    [self.df.lazy(), df_new.lazy()], how="diagonal_relaxed"
+                )
+                presorted = False
+        if deduplicate:
+            df_combi = df_combi.unique(maintain_order=True)
+        if presorted:
+            df_combi = df_combi.set_sorted("datetime")
+        if self.lazy:
+            self.df = df_combi if presorted else _ensure_sorted(df_combi)
+        else:
+            self.df = df_combi.lazy().collect()
+            if not presorted:
+                self.df = _ensure_sorted(self.df)
+        self._update_original_total_requests()
+
+    def load_apache_logs(
+        self,
+        apache_logs_dir: str,
+        wildcard_fname="*access.log*",
+        workers=1,
+        manifest=None,
+    ):
+        """
+        Parse apache logs.
+
+        Set workers > 1 to parse files in parallel processes. If a path to a checkpoint
+        manifest is given, only log lines not read in previous runs are loaded. The
+        manifest is updated by export_data or save_manifest.
+        """
+        self._add_logs(
+            apache_logs_dir, wildcard_fname, workers=workers, manifest=manifest
+        )
+
+    def load_nginx_logs(
+        self,
+        nginx_logs_dir: str,
+        wildcard_fname="*access.log*",
+        workers=1,
+        manifest=None,
+    ):
+        """
+        Parse nginx logs.
+
+        Set workers > 1 to parse files in parallel processes. If a path to a checkpoint
+        manifest is given, only log lines not read in previous runs are loaded. The
+        manifest is updated by export_data or save_manifest.
+        """
+        self._add_logs(
+            nginx_logs_dir, wildcard_fname, workers=workers, manifest=manifest
+        )
+
+    def load_servers(self, servers, workers=None):
+        """
+        Parse the logs of several ERDDAP servers and tag each request with its server.
+
+        servers maps a server name to the directory of its logs, or to a dict with keys logs_dir
+        and optionally format ("nginx" or "apache"), wildcard_fname and manifest. Servers are
+        parsed in parallel, one per process, and their requests merged by datetime. The server
+        column is kept in the exports and location counts. Use export_data(by_server=True) to
+        write each server's requests to its own directory.
+        """
+        df_new, self._manifest_updates = _load_servers(
+            servers, workers=workers, manifest_updates=self._manifest_updates
+        )
         if self.verbose:
-            print(f"loaded {len(df_apache)} log lines from {apache_logs_dir}")
-        df_combi = pl.concat(
-            [
-                self.df,
-                df_apache,
-            ],
-            how="vertical",
+            print(f"loaded {len(df_new)} log lines from {len(servers)} servers")
+        if self.lazy:
+            df_new = df_new.lazy()
+        self._combine_requests(df_new, presorted=True)
+
+    def write_store(self, store_dir):
+        """
+        Append the current requests to a Parquet store partitioned by temporal_resolution.
+
+        Intended for parsed requests before anonymization, so that they can be re-analysed with
+        load_store without parsing the raw logs again.
+        """
+        _write_parquet_store(
+            _collect_streaming(self.df),
+            store_dir,
+            self.temporal_resolution,
+            verbose=self.verbose,
         )
-        df_combi = df_combi.unique().sort("datetime")
-        self.df = df_combi
-        self._update_original_total_requests()
 
-    def load_nginx_logs(self, nginx_logs_dir: str, wildcard_fname="*access.log*"):
-        """Parse nginx logs."""
-        df_nginx = _load_nginx_logs(nginx_logs_dir, wildcard_fname)
+    def load_store(self, store_dir, start=None, end=None, columns=None):
+        """
+        Load requests from a Parquet store written by write_store.
+
+        Only the partitions between datetimes start and end, and the requested columns, are read.
+        The datetime column is always read, as the requests are kept sorted by it.
+        """
+        if columns is not None and "datetime" not in columns:
+            columns = ["datetime"] + list(columns)
+        df_new = _scan_parquet_store(store_dir, start=start, end=end, columns=columns)
+        if not self.lazy:
+            df_new = df_new.collect()
+        if self.verbose:
+            print(f"loaded requests from store {store_dir}")
+        # with a subset of columns, distinct requests can look like duplicates
+        self._combine_requests(df_new, deduplicate=columns is None)
+
+    def build_cube(self, dimensions=None, every="1h"):
+        """
+        Pre-aggregate the requests into a rollup cube, kept in self.cube.
+
+        The cube holds the number of requests and bytes sent per time bucket and combination of
+        dimensions, by default dataset, request type, file type, status code and location. It is
+        built in a single group_by pass, so call it once after filtering and parse_columns. The
+        plot functions accept the cube in place of the requests, rollup sums it to daily or monthly
+        buckets, and export_data takes the location counts from it.
+        """
+        if dimensions is None:
+            dimensions = _cube_dimensions
+        df = self.df
+        if self.star_schema and not self.ip.is_empty():
+            # count per ip first, then sum the counts of the ips sharing ip information
+            ip_dimension = self._ip_dimension()
+            ip_columns = [
+                col for col in dimensions if col in _column_names(ip_dimension)
+            ]
+            df = _build_cube(df, ["ip"] + dimensions, every=every).join(
+                ip_dimension.select(["ip"] + ip_columns), on="ip", how="left"
+            )
+            names = _column_names(df)
+            keys = ["datetime"] + [col for col in dimensions if col in names]
+            df = _sum_cube(df, keys)
+        else:
+            df = _build_cube(df, dimensions, every=every)
+        self.cube = _collect_streaming(df)
+        if self.verbose:
+            print(f"built cube of {len(self.cube)} rows")
+
+    def rollup(self, every="1d", dimensions=None):
+        """Sum the cube to wider time buckets, e.g. "1d" or "1mo", keeping only dimensions if given."""
+        return _rollup_cube(self.cube, every=every, dimensions=dimensions)
+
+    def write_cube(self, cube_file, accumulate=False):
+        """
+        Merge the cube into a Parquet file, which is replaced atomically.
+
+        Time buckets in the cube replace the same buckets in the file, so logs can be re-processed
+        without counting requests twice. With accumulate=True the counts are added instead. Use this
+        with a checkpoint manifest, where each run only holds new requests.
+        """
+        cube_file = Path(cube_file)
+        cube = self.cube
+        if cube_file.exists():
+            cube = _merge_cube(pl.read_parquet(cube_file), cube, accumulate=accumulate)
+        tmp = cube_file.with_name(f".{cube_file.name}.tmp")
+        cube.write_parquet(tmp)
+        os.replace(tmp, cube_file)
         if self.verbose:
-            print(f"loaded {len(df_nginx)} log lines from {nginx_logs_dir}")
-        df_combi = pl.concat(
-            [
-                self.df,
-                df_nginx,
+            print(f"write file {cube_file}")
+
+    def load_cube(self, cube_file):
+        """Load a cube written by write_cube into self.cube."""
+        self.cube = pl.read_parquet(cube_file)
+
+    def update_sketches(
+        self, by="dataset_id", every="1d", top_columns=("dataset_id", "ip")
+    ):
+        """
+        Add the requests to approximate sketches, for statistics over unbounded volumes of logs.
+
+        self.visitor_sketches estimates distinct visitors (ips) per time bucket and value of by,
+        see erddaplogs.sketches.VisitorSketches. self.heavy_hitters holds a HeavyHitters sketch of
+        the most frequent values of each of top_columns. Both are updated in a single pass over the
+        requests. The heavy hitters take constant memory, while the visitor sketches grow with the
+        number of time buckets times the number of values of by, but not with the number of
+        requests, see VisitorSketches. Call this after each batch of logs is loaded, e.g. by a
+        cron job with a checkpoint manifest, and keep the sketches between runs with write_sketches.
+        """
+        df = self.df
+        if self.star_schema and by not in _column_names(df):
+            df = self.materialize_df()
+        if df.collect_schema()["ip"].is_integer():
+            df = df.with_columns(_ipv4_from_int(pl.col("ip")))
+        if self.visitor_sketches is None:
+            self.visitor_sketches = VisitorSketches(by=by, every=every)
+        top_columns = list(top_columns)
+        results = pl.collect_all(
+            [self.visitor_sketches.distinct(df)]
+            + [
+                df.lazy().group_by(pl.col(col).cast(pl.String)).len()
+                for col in top_columns
             ],
-            how="vertical",
+            **_streaming_kwargs,
         )
-        df_combi = df_combi.unique().sort("datetime")
-        self.df = df_combi
-        self._update_original_total_requests()
+        self.visitor_sketches.update(results[0], distinct=True)
+        for col, counts in zip(top_columns, results[1:]):
+            for sketches in [self.heavy_hitters, self._unwritten_heavy_hitters]:
+                if col not in sketches:
+                    sketches[col] = HeavyHitters()
+                sketches[col].add(counts[col], counts["len"])
+
+    def unique_visitors(self, every=None):
+        """Estimated distinct visitors per time bucket and group, from update_sketches."""
+        return self.visitor_sketches.unique_visitors(every=every)
+
+    def top(self, col_name, rows=10):
+        """Estimated most frequent values of col_name and their counts, from update_sketches."""
+        return (
+            self.heavy_hitters[col_name]
+            .top(rows)
+            .rename({"value": col_name, "count": "counts"})
+        )
+
+    def write_sketches(self, sketch_dir):
+        """
+        Merge the sketches into those stored in sketch_dir, written as Parquet files.
+
+        Merging visitor sketches is idempotent, so re-processing logs does not inflate visitor
+        counts. The heavy hitter counts add up, so only the counts added by update_sketches since
+        the sketches were last written or loaded are merged into the stored ones. Each request
+        should still be added only once.
+        """
+        sketch_dir = Path(sketch_dir)
+        sketch_dir.mkdir(parents=True, exist_ok=True)
+        visitors = self.visitor_sketches
+        heavy_hitters = dict(self.heavy_hitters)
+        if (sketch_dir / "visitors.parquet").exists():
+            stored, stored_top = _read_sketches(sketch_dir, visitors.every)
+            visitors = stored.merge(visitors)
+            heavy_hitters = dict(self._unwritten_heavy_hitters)
+            for col, sketch in heavy_hitters.items():
+                if col in stored_top:
+                    heavy_hitters[col] = stored_top[col].merge(sketch)
+            heavy_hitters = {**stored_top, **heavy_hitters}
+        frames = {
+            "visitors.parquet": visitors.to_frame(),
+            "top.parquet": pl.DataFrame(
+                {
+                    "column": list(heavy_hitters.keys()),
+                    "sketch": [sketch.to_bytes() for sketch in heavy_hitters.values()],
+                },
+                schema={"column": pl.String, "sketch": pl.Binary},
+            ),
+        }
+        for name, frame in frames.items():
+            tmp = sketch_dir / f".{name}.tmp"
+            frame.write_parquet(tmp)
+            os.replace(tmp, sketch_dir / name)
+        self._unwritten_heavy_hitters = {}
+        if self.verbose:
+            print(f"write sketches to {sketch_dir}")
+
+    def load_sketches(self, sketch_dir, every="1d"):
+        """Load sketches written by write_sketches. every is the bucket width they were built with."""
+        self.visitor_sketches, self.heavy_hitters = _read_sketches(sketch_dir, every)
+        self._unwritten_heavy_hitters = {}
+
+    def save_manifest(self):
+        """Record the log lines loaded so far in their checkpoint manifests, so they are skipped next time."""
+        for manifest, entries in self._manifest_updates.items():
+            _write_manifest(manifest, entries)
+            if self.verbose:
+                print(f"updated checkpoint manifest {manifest}")
+        self._manifest_updates = {}
+
+    def get_ip_info(
+        self,
+        ip_info_csv="ip.csv",
+        download_new=True,
+        num_ips=60,
+        backend=None,
+        max_age=None,
+    ):
+        """
+        Get ip-derived information from requests ip addresses. backend defaults to an IpApiClient.
 
-    def get_ip_info(self, ip_info_csv="ip.csv", download_new=True, num_ips=60):
-        """Get ip-derived information from requests ip addresses."""
-        if "country" in self.df.columns:
+        If star_schema is True, the ip information is kept in self.ip, one row per ip address, and
+        not joined onto the requests. See materialize_df.
+
+        In lazy mode this runs the query plan up to this point to find the ip addresses present,
+        re-reading the logs. Only the ip column is kept in memory, and the requests stay lazy.
+        """
+        if "country" in _column_names(self.df):
             return
         df_ip = _get_ip_info(
-            self.df,
+            self.df.lazy().select("ip").collect(**_streaming_kwargs),
             ip_info_csv,
             download_new=download_new,
             verbose=self.verbose,
             num_new_ips=num_ips,
+            backend=backend,
+            max_age=max_age,
         )
+        if self.star_schema:
+            self.ip = df_ip.unique("query", keep="last", maintain_order=True)
+            return
         self.ip = df_ip
-        self.df = self.df.join(df_ip, left_on="ip", right_on="query", how="left").sort(
-            "datetime"
+        self.df = self.df.join(
+            df_ip.lazy() if isinstance(self.df, pl.LazyFrame) else df_ip,
+            left_on="ip",
+            right_on="query",
+            how="left",
+            **_left_join_kwargs,
+        ).pipe(_keep_sorted)
+
+    def _ip_dimension(self):
+        """The ip information table, keyed on an ip column of the same type as in the requests."""
+        dimension = self.ip.rename({"query": "ip"})
+        ip_dtype = (
+            self.df.collect_schema()
+            if isinstance(self.df, pl.LazyFrame)
+            else self.df.schema
+        )["ip"]
+        if ip_dtype.is_integer():
+            dimension = dimension.with_columns(
+                _ipv4_to_int(pl.col("ip")).cast(ip_dtype).alias("ip")
+            )
+        if isinstance(self.df, pl.LazyFrame):
+            return dimension.lazy()
+        return dimension
+
+    def materialize_df(self):
+        """Return the requests joined with their ip information. Only needed if star_schema is True."""
+        if not self.star_schema or self.ip.is_empty():
+            return self.df
+        return self.df.join(
+            self._ip_dimension(), on="ip", how="left", **_left_join_kwargs
+        ).pipe(_keep_sorted)
+
+    def _reset_filter_history(self):
+        """Start a new filter history, with the current requests as its unfiltered base."""
+        self._filter_base = self.df
+        self._filtered_df = self.df
+        self.filter_history = []
+        self._undone_filters = []
+
+    def _rule_base(self):
+        """The requests that filter rules are evaluated on, see _apply_rules."""
+        if self.df is not self._filtered_df:
+            return self.df
+        return self._filter_base
+
+    def _removed_mask(self, filters):
+        """Boolean Series over the unfiltered requests, True for those removed by any of filters."""
+        removed = pl.repeat(False, len(self._filter_base), eager=True)
+        for entry in filters:
+            removed = removed | entry["remove"]
+        return removed
+
+    def _refilter(self):
+        """Rebuild the requests from the unfiltered base and the enabled filters."""
+        enabled = self._enabled_filters()
+        if not enabled:
+            self.df = self._filter_base
+        elif isinstance(self._filter_base, pl.LazyFrame):
+            self.df = self._filter_base.filter(
+                ~pl.any_horizontal(*[entry["remove"] for entry in enabled])
+            )
+        else:
+            self.df = self._filter_base.filter(~self._removed_mask(enabled))
+        self._filtered_df = self.df
+
+    def _apply_rules(self, rules):
+        """
+        Remove the requests matched by any of the rules, evaluating all of them in one pass.
+
+        Rules that evaluate to null count as matches, as they did when each filter was applied on
+        its own. The number of requests each rule matches is stored in self.filter_stats.
+
+        The rules are evaluated on the unfiltered requests and the result is kept in
+        self.filter_history as a boolean mask, so that filters can later be undone, redone or
+        toggled without re-running the others. Changing the requests other than by filtering,
+        e.g. with get_ip_info, starts a new history.
+        """
+        rules = {name: rule.fill_null(True) for name, rule in rules.items()}
+        if self.df is not self._filtered_df:
+            self._reset_filter_history()
+        name = ", ".join(rules)
+        if isinstance(self.df, pl.LazyFrame):
+            remove = pl.any_horizontal(pl.lit(False), *rules.values())
+            self._record_filter(name, remove)
+            return
+        matches = self._filter_base.select(**rules)
+        # statistics count the requests that are still present
+        current = matches.filter(~self._removed_mask(self._enabled_filters()))
+        only_rule = pl.sum_horizontal(pl.all()) == 1
+        self.filter_stats = pl.DataFrame(
+            {
+                "rule": list(rules),
+                "matches": current.sum().row(0) if rules else [],
+                "unique_matches": (
+                    current.filter(only_rule).sum().row(0) if rules else []
+                ),
+            },
+            schema={
+                "rule": pl.String,
+                "matches": pl.UInt32,
+                "unique_matches": pl.UInt32,
+            },
         )
+        if self.verbose and len(rules) > 1:
+            for rule, count, unique_count in self.filter_stats.iter_rows():
+                print(
+                    f"Rule {rule} matches {count} lines, {unique_count} of them matched by no other rule"
+                )
+        remove = matches.select(pl.any_horizontal(pl.lit(False), pl.all())).to_series()
+        self._record_filter(name, remove)
+
+    def _record_filter(self, name, remove):
+        self.filter_history.append({"name": name, "remove": remove, "enabled": True})
+        self._undone_filters = []
+        self._refilter()
+
+    def _enabled_filters(self):
+        """The entries of filter_history that are currently applied."""
+        return [entry for entry in self.filter_history if entry["enabled"]]
+
+    def undo_last_filter(self):
+        """Remove the most recent filter from the history. It can be re-applied with redo_filter."""
+        if not self.filter_history:
+            raise ValueError("No filters to undo")
+        self._check_filter_history()
+        entry = self.filter_history.pop()
+        undone = self._undone_filters
+        self._refilter()
+        self._undone_filters = undone + [entry]
+        if self.verbose:
+            print(
+                f"Undid filter {entry['name']}. DataFrame now has {self._len_df()} lines"
+            )
+
+    def redo_filter(self):
+        """Re-apply the most recently undone filter."""
+        if not self._undone_filters:
+            raise ValueError("No filters to redo")
+        self._check_filter_history()
+        entry = self._undone_filters.pop()
+        undone = self._undone_filters
+        self.filter_history.append(entry)
+        self._refilter()
+        self._undone_filters = undone
+        if self.verbose:
+            print(
+                f"Redid filter {entry['name']}. DataFrame now has {self._len_df()} lines"
+            )
+
+    def toggle_filter(self, name, enabled=None):
+        """
+        Switch a filter in the history off or on, keeping the others.
+
+        Parameters
+        ----------
+        name: str
+            name of the filter, as in filter_history, e.g. "spam" or "user agents"
+        enabled: bool, default=None
+            if None, switch the filter to the opposite state
+        """
+        self._check_filter_history()
+        entries = [entry for entry in self.filter_history if entry["name"] == name]
+        if not entries:
+            raise ValueError(
+                f"No filter {name} in the history. Filters are {[entry['name'] for entry in self.filter_history]}"
+            )
+        entry = entries[-1]
+        entry["enabled"] = not entry["enabled"] if enabled is None else enabled
+        self._refilter()
+        if self.verbose:
+            state = "on" if entry["enabled"] else "off"
+            print(f"Filter {name} {state}. DataFrame now has {self._len_df()} lines")
+
+    def count_remaining(self, filters=None):
+        """
+        Number of requests that would remain with only some of the filters in the history applied.
+
+        Parameters
+        ----------
+        filters: list of str, default=None
+            names of the filters to apply. If None, the filters that are currently enabled
+
+        Returns
+        -------
+        int
+            number of requests
+        """
+        if isinstance(self._filter_base, pl.LazyFrame):
+            raise ValueError("count_remaining is not available in lazy mode")
+        if filters is None:
+            entries = self._enabled_filters()
+        else:
+            entries = [
+                entry for entry in self.filter_history if entry["name"] in filters
+            ]
+        return len(self._filter_base) - self._removed_mask(entries).sum()
+
+    def _check_filter_history(self):
+        if self.df is not self._filtered_df:
+            raise ValueError(
+                "The requests have changed since the last filter, so the filter history no longer applies"
+            )
+
+    def _len_df(self):
+        if isinstance(self.df, pl.LazyFrame):
+            return "an unknown number of"
+        return len(self.df)
+
+    @_print_filter_stats
+    def filter_rules(self, rules):
+        """
+        Apply several filter rules at once.
+
+        All of the rules are evaluated in a single pass over the requests, rather than one pass per
+        filter, and the number of requests that each rule matches is stored in self.filter_stats.
+
+        Parameters
+        ----------
+        rules: dict
+            rule names and polars boolean expressions that are True for the requests to remove. The
+            *_rule methods return the rules behind the filter_* methods, e.g.
+            {"spam": parser.spam_rule(), "bots": parser.user_agents_rule(), "docs": pl.col("url").str.contains("/docs/")}
+        """
+        self._apply_rules(rules)
+        self.filter_name = ", ".join(rules)
+
+    def non_erddap_rule(self):
+        """Rule matching non-genuine requests."""
+        return ~pl.col("url").str.contains("erddap")
 
     @_print_filter_stats
     def filter_non_erddap(self):
         """Filter out non-genuine requests."""
         self.filter_name = "non erddap"
-        self.df = self.df.filter(pl.col("url").str.contains("erddap"))
+        self._apply_rules({"non erddap": self.non_erddap_rule()})
+
+    def organisations_rule(self, organisations=("Google", "Crawlers", "SEMrush")):
+        """Rule matching requests from specific organizations, by their org or isp."""
+        pattern = "(?i)" + "|".join(f"(?:{org})" for org in organisations)
+        if self.star_schema and "org" in self.ip.columns:
+            # match organisations on the ip information table, then the requests by their ip
+            ips = self._ip_dimension()
+            if isinstance(ips, pl.LazyFrame):
+                ips = ips.collect()
+            is_org = pl.any_horizontal(
+                pl.col("org").fill_null("unknown").str.contains(pattern),
+                pl.col("isp").fill_null("unknown").str.contains(pattern),
+            )
+            if re.search(pattern, "unknown"):
+                # requests from ips without information count as organisation "unknown"
+                return ~pl.col("ip").is_in(ips.filter(~is_org)["ip"])
+            return pl.col("ip").is_in(ips.filter(is_org)["ip"])
+        if "org" not in _column_names(self.df):
+            raise ValueError(
+                "Organisation information not present in DataFrame. Try running get_ip_info first.",
+            )
+        return pl.col("org").fill_null("unknown").str.contains(pattern) | pl.col(
+            "isp"
+        ).fill_null("unknown").str.contains(pattern)
 
     @_print_filter_stats
     def filter_organisations(self, organisations=("Google", "Crawlers", "SEMrush")):
         """Filter out non-visitor requests from specific organizations."""
-        if "org" not in self.df.columns:
-            raise ValueError(
-                "Organisation information not present in DataFrame. Try running get_ip_info first.",
+        rule = self.organisations_rule(organisations)
+        if self.star_schema and "org" in self.ip.columns:
+            self.ip = self.ip.with_columns(
+                pl.col("org").fill_null("unknown"), pl.col("isp").fill_null("unknown")
+            )
+            self._apply_rules({"organisations": rule})
+        else:
+            self._apply_rules({"organisations": rule})
+            # the filled in values apply to the unfiltered requests too, keeping the history valid
+            fill = (
+                pl.col("org").fill_null("unknown"),
+                pl.col("isp").fill_null("unknown"),
             )
-        self.df = self.df.with_columns(pl.col("org").fill_null("unknown"))
-        self.df = self.df.with_columns(pl.col("isp").fill_null("unknown"))
-        for block_org in organisations:
-            self.df = self.df.filter(~pl.col("org").str.contains(f"(?i){block_org}"))
-            self.df = self.df.filter(~pl.col("isp").str.contains(f"(?i){block_org}"))
+            self._filter_base = self._filter_base.with_columns(*fill)
+            self.df = self._filtered_df = self.df.with_columns(*fill)
         self.filter_name = "organisations"
 
+    def _update_user_agents(self, df):
+        """
+        Classify any user agents in df that have not been seen before.
+
+        If df is lazy, its query plan is run to find the user agents present, re-reading the logs.
+        """
+        user_agents = (
+            df.lazy().select(pl.col("user_agent").unique()).collect(**_streaming_kwargs)
+        )
+        self.user_agents = _classify_user_agents(
+            user_agents["user_agent"],
+            known=self.user_agents,
+            cache_path=self.user_agent_cache,
+        )
+        return self.user_agents
+
+    def classify_user_agents(self):
+        """
+        Add columns is_bot, BrowserFamily, DeviceFamily and OS derived from the user agent.
+
+        In lazy mode this runs the query plan to find the user agents present, see _update_user_agents.
+        """
+        user_agents = self._update_user_agents(self.df)
+        if isinstance(self.df, pl.LazyFrame):
+            user_agents = user_agents.lazy()
+        self.df = self.df.drop(
+            [col for col in user_agents.columns[1:] if col in _column_names(self.df)]
+        ).join(user_agents, on="user_agent", how="left")
+
+    def user_agents_rule(self):
+        """
+        Rule matching requests from bots.
+
+        In lazy mode this runs the query plan to find the user agents present, see _update_user_agents.
+        """
+        # classify the user agents of all of the requests the rule is evaluated on, including
+        # those removed by filters that may later be toggled off
+        user_agents = self._update_user_agents(self._rule_base())
+        bots = user_agents.filter(pl.col("is_bot"))["user_agent"]
+        return pl.col("user_agent").is_in(bots)
+
     @_print_filter_stats
     def filter_user_agents(self):
         """Filter out requests from bots."""
         # Added by Samantha Ouertani at NOAA AOML Jan 2024
-        self.df = self.df.filter(
-            ~pl.col("user_agent").map_elements(
-                lambda ua: parse(ua).is_bot, return_dtype=pl.Boolean
-            )
-        )
+        self._apply_rules({"user agents": self.user_agents_rule()})
         self.filter_name = "user agents"
 
+    def locales_rule(self, locales=("zh-CN", "zh-TW", "ZH")):
+        """Rule matching requests from specific regions (locales)."""
+        return _contains_any("url", locales)
+
     @_print_filter_stats
     def filter_locales(self, locales=("zh-CN", "zh-TW", "ZH")):
         # Added by Samantha Ouertani at NOAA AOML Jan 2024
         """Filter out requests from specific regions (locales)."""
-        for locale in locales:
-            self.df = self.df.filter(~pl.col("url").str.contains(f"{locale}"))
+        self._apply_rules({"locales": self.locales_rule(locales)})
         self.filter_name = "locales"
 
+    def spam_rule(
+        self,
+        spam_strings=(
+            ".env",
+            "env.",
+            ".php",
+            ".git",
+            "robots.txt",
+            "phpinfo",
+            "/config",
+            "aws",
+            ".xml",
+        ),
+        regexes=(),
+        prefixes=(),
+        suffixes=(),
+    ):
+        """Rule matching requests from non-visitors, by strings, regexes, prefixes or suffixes of the url."""
+        return pl.any_horizontal(
+            _contains_any("url", spam_strings, literal=True),
+            _contains_any("url", regexes),
+            *[pl.col("url").str.starts_with(prefix) for prefix in prefixes],
+            *[pl.col("url").str.ends_with(suffix) for suffix in suffixes],
+        )
+
     @_print_filter_stats
     def filter_spam(
         self,
@@ -661,38 +2359,47 @@ class ErddapLogParser:
             "aws",
             ".xml",
         ),
+        regexes=(),
+        prefixes=(),
+        suffixes=(),
     ):
         """
         Filter out requests from non-visitors.
 
         Filter out requests from indexing webpages, services monitoring uptime,
-        requests for files that aren't on the server, etc
-        """
-        page_counts = Counter(
-            list(self.df.select("url").to_numpy()[:, 0])
-        ).most_common()
-        bad_pages = []
-        for page, count in page_counts:
-            for phrase in spam_strings:
-                if phrase in page:
-                    bad_pages.append(page)
-        self.df = self.df.filter(~pl.col("url").is_in(bad_pages))
+        requests for files that aren't on the server, etc. Requests are removed if
+        their url contains any of spam_strings, matches any of regexes, or starts
+        with any of prefixes or ends with any of suffixes. All of these are matched
+        in one pass over the urls.
+        """
+        self._apply_rules(
+            {"spam": self.spam_rule(spam_strings, regexes, prefixes, suffixes)}
+        )
         self.filter_name = "spam"
 
+    def files_rule(self):
+        """Rule matching requests for browsing erddap's virtual file system."""
+        return pl.col("url").str.contains("/files")
+
     @_print_filter_stats
     def filter_files(self):
         """Filter out requests for browsing erddap's virtual file system."""
         # Added by Samantha Ouertani at NOAA AOML Jan 2024
-        self.df = self.df.filter(~pl.col("url").str.contains("/files"))
+        self._apply_rules({"files": self.files_rule()})
         self.filter_name = "files"
 
+    def common_strings_rule(
+        self, strings=("/version", "favicon.ico", ".js", ".css", "/erddap/images")
+    ):
+        """Rule matching non-data requests - requests for version, images, etc"""
+        return _contains_any("url", strings)
+
     @_print_filter_stats
     def filter_common_strings(
         self, strings=("/version", "favicon.ico", ".js", ".css", "/erddap/images")
     ):
         """Filter out non-data requests - requests for version, images, etc"""
-        for string in strings:
-            self.df = self.df.filter(~pl.col("url").str.contains(string))
+        self._apply_rules({"common strings": self.common_strings_rule(strings)})
         self.filter_name = "common strings"
 
     def parse_datasets_xml(self, datasets_xml_path):
@@ -711,12 +2418,20 @@ class ErddapLogParser:
         )
 
     def parse_columns(self):
-        self.df = _parse_language_data(self.df)
         self.df = _parse_columns(self.df)
+        if self.star_schema and "country" in self.ip.columns:
+            self.ip = self.ip.with_columns(pl.col("country").fill_null("unknown"))
         if not self.df_xml.is_empty():
+            df_xml = self.df_xml
+            if isinstance(self.df, pl.LazyFrame):
+                df_xml = df_xml.lazy()
             self.df = self.df.join(
-                self.df_xml, left_on="dataset_id", right_on="dataset_id", how="left"
-            ).sort("datetime")
+                df_xml,
+                left_on="dataset_id",
+                right_on="dataset_id",
+                how="left",
+                **_left_join_kwargs,
+            ).pipe(_keep_sorted)
             self.df = self.df.with_columns(
                 dataset_id=pl.when(pl.col("dataset_type").is_null())
                 .then(None)
@@ -729,101 +2444,366 @@ class ErddapLogParser:
             .otherwise(pl.col(pl.String))
             .name.keep()
         )
+        if self.compact:
+            self.compact_columns()
+
+    def parse_query(self):
+        """
+        Parse the queries of tabledap and griddap requests into the variables requested, the
+        constraints and the time range requested. Run after parse_columns.
+
+        Adds the columns variables, constraints, time_min and time_max to self.df. Variables
+        can be counted with e.g. self.df.explode("variables")["variables"].value_counts()
+        """
+        self.df = _parse_query(self.df)
+        if self.verbose and isinstance(self.df, pl.DataFrame):
+            print(
+                f"Parsed queries of {self.df['variables'].is_not_null().sum()} data requests"
+            )
+
+    def compact_columns(self):
+        """Store repetitive columns as Categorical or Enum and ip addresses as integers. Run after filtering."""
+        if isinstance(self.df, pl.LazyFrame):
+            self.df = _compact_columns(self.df)
+            return
+        size_before = self.df.estimated_size("mb")
+        self.df = _compact_columns(self.df)
+        if self.verbose:
+            print(
+                f"Compacted DataFrame from {size_before:.1f} MB to {self.df.estimated_size('mb'):.1f} MB"
+            )
 
     def aggregate_location(self):
-        """Generates a dataframe that contains query counts by status code and location."""
+        """
+        Generates a dataframe that contains query counts by status code and location.
+
+        If a cube with the location columns has been built, the counts are summed from it rather than
+        from the requests, for the time periods present in the requests.
+        """
         df = self.df
+        # requests loaded with load_servers are counted per server
+        server = [col for col in ["server"] if col in _column_names(df)]
+        location_columns = ["countryCode", "regionName", "city"]
+        if set(location_columns).issubset(self.cube.columns):
+            server = [col for col in server if col in self.cube.columns]
+            present = df.lazy().select(
+                pl.col([self.temporal_resolution] + server).unique().implode()
+            )
+            present = present.collect().row(0)
+            df = self.cube.with_columns(
+                pl.col("datetime")
+                .dt.strftime(_date_format_dict[self.temporal_resolution])
+                .alias(self.temporal_resolution)
+            ).filter(
+                [
+                    pl.col(col).is_in(values)
+                    for col, values in zip([self.temporal_resolution] + server, present)
+                ]
+            )
+            length = pl.col("requests").sum()
+        elif self.star_schema and "countryCode" in self.ip.columns:
+            # count requests per ip, then sum the counts of the ips at each location
+            df = (
+                df.group_by(["ip", self.temporal_resolution] + server)
+                .len()
+                .join(self._ip_dimension(), on="ip", how="left")
+            )
+            length = pl.col("len").sum()
+        else:
+            length = pl.len()
         self.location = (
-            df.group_by(["countryCode", "regionName", "city", self.temporal_resolution])
-            .len()
+            df.group_by(location_columns + [self.temporal_resolution] + server)
+            .agg(length.alias("len"))
+            .cast({col: pl.String for col in location_columns})
             .fill_null("unknown")
             .rename({"len": "total_requests"})
         ).cast({"total_requests": pl.Int64})[
-            self.temporal_resolution,
-            "countryCode",
-            "regionName",
-            "city",
-            "total_requests",
+            [self.temporal_resolution] + server + location_columns + ["total_requests"]
         ]
 
     def anonymize_user_agent(self):
         """Modifies the anonymized dataframe to have browser, device, and os names instead of full user agent."""
         self.anonymized = self.anonymized.with_columns(
-            pl.col("user_agent")
-            .map_elements(lambda ua: parse(ua).browser.family, return_dtype=pl.String)
-            .alias("BrowserFamily")
+            pl.col("user_agent").cast(pl.String)
         )
-        self.anonymized = self.anonymized.with_columns(
-            pl.col("user_agent")
-            .map_elements(lambda ua: parse(ua).device.family, return_dtype=pl.String)
-            .alias("DeviceFamily")
-        )
-        self.anonymized = self.anonymized.with_columns(
-            pl.col("user_agent")
-            .map_elements(lambda ua: parse(ua).os.family, return_dtype=pl.String)
-            .alias("OS")
-        )
-        self.anonymized = self.anonymized.drop("user_agent")
+        user_agents = self._update_user_agents(self.anonymized)
+        self.anonymized = self.anonymized.join(
+            user_agents.drop("is_bot"), on="user_agent", how="left", **_left_join_kwargs
+        ).drop("user_agent")
 
     def anonymize_ip(self):
-        """Replaces the ip address with a unique number identifier."""
-        df = self.anonymized
-        df = df.with_columns(
-            (pl.col(self.temporal_resolution) + pl.col("ip")).alias("temporal_ip")
-        )
-        unique_df = (
-            pl.DataFrame({"temporal_ip": df.get_column("temporal_ip").unique()})
-            .with_row_index()
-            .with_columns(pl.col("index").cast(str))
-        )
-        date_length = len(df[self.temporal_resolution][0])
-        unique_df = unique_df.with_columns(
-            (
-                pl.col("temporal_ip").str.slice(0, date_length) + "_" + pl.col("index")
-            ).alias("temporal_ip_id"),
-            (pl.col("temporal_ip").str.slice(date_length)).alias("ip"),
-        )
-        df = df.with_columns(
-            pl.col("temporal_ip").map_elements(
-                lambda temporal_ip: unique_df.row(
-                    by_predicate=(pl.col("temporal_ip") == temporal_ip), named=True
-                )["temporal_ip_id"],
-                return_dtype=pl.String,
-            )
-        )
-        df = df.drop("ip").rename({"temporal_ip": "ip_id"})
-        self.anonymized = df
+        """
+        Replaces the ip address with an identifier unique to the ip and time period.
+
+        By default the identifier is a running number. If ip_key is set to a secret string, it is a
+        keyed hash (HMAC-SHA256) of the ip and time period instead, so the same visitor gets the same
+        identifier in every export without keeping a table of ip addresses.
+        """
+        time_unit = self.temporal_resolution
+        unique_df = self.anonymized.select(time_unit, "ip").unique(maintain_order=True)
+        ips = unique_df["ip"]
+        if ips.dtype.is_integer():
+            # compact mode stores ips as integers
+            ips = unique_df.select(_ipv4_from_int(pl.col("ip")))["ip"]
+        unique_df = unique_df.with_columns(address=ips)
+        if self.ip_key is None:
+            # ips given an id by an earlier export keep it, and new ones are numbered on from it
+            known = pl.DataFrame(
+                [
+                    (period, ip, ip_id)
+                    for period, ip_ids in self._known_ip_ids.items()
+                    for ip, ip_id in ip_ids.items()
+                ],
+                schema={time_unit: pl.String, "address": pl.String, "ip_id": pl.String},
+                orient="row",
+            )
+            unique_df = unique_df.join(
+                known, on=[time_unit, "address"], how="left", **_left_join_kwargs
+            )
+            new = unique_df["ip_id"].is_null()
+            unique_df = unique_df.with_columns(
+                ip_id=pl.coalesce(
+                    "ip_id",
+                    pl.col(time_unit)
+                    + "_"
+                    + (new.cum_sum() - 1 + self._ip_id_offset).cast(pl.String),
+                )
+            )
+        else:
+            key = self.ip_key
+            if isinstance(key, str):
+                key = key.encode()
+            ids = pl.Series(
+                [
+                    hmac.new(key, f"{date}{ip}".encode(), hashlib.sha256).hexdigest()[
+                        :16
+                    ]
+                    for date, ip in zip(unique_df[time_unit], ips)
+                ],
+                dtype=pl.String,
+            )
+            unique_df = unique_df.with_columns(
+                (pl.col(time_unit) + "_" + ids).alias("ip_id")
+            )
+        self._ip_ids = unique_df.select(time_unit, "address", "ip_id")
+        self.anonymized = self.anonymized.join(
+            unique_df.drop("address"),
+            on=[time_unit, "ip"],
+            how="left",
+            **_left_join_kwargs,
+        ).drop("ip")
 
     def anonymize_query(self):
-        """Remove email= and the address from queries."""
+        """Remove email= and the address from the url and request_kwargs of queries."""
+        columns = _column_names(self.anonymized)
         self.anonymized = self.anonymized.with_columns(
-            pl.col("url").map_elements(
-                lambda url: re.sub("email=.*?&", "", url),
-                return_dtype=pl.String,
-            )
+            _anonymize_query(col) for col in ["url", "request_kwargs"] if col in columns
+        )
+
+    def _anonymized_columns(self):
+        """Selector for the columns that are kept, after anonymization, in the shared requests table."""
+        return pl.selectors.matches(
+            f"^^ip$|^datetime$|^status_code$|^bytes_sent$|^erddap_request_type$|^dataset_type$|^dataset_id$|^file_type$|^url$|^user_agent$|^base_url$|request_kwargs$|^server$|{self.temporal_resolution}$"
         )
 
     def anonymize_requests(self):
         """Creates tables that are safe for sharing, including a query by location table and an anonymized table."""
         self.aggregate_location()
-        self.anonymized = self.df.select(
-            pl.selectors.matches(
-                f"^^ip$|^datetime$|^status_code$|^bytes_sent$|^erddap_request_type$|^dataset_type$|^dataset_id$|^file_type$|^url$|^user_agent$|^base_url$|request_kwargs$|{self.temporal_resolution}$"
-            )
-        )
+        self.anonymized = self.df.select(self._anonymized_columns())
         self.anonymize_user_agent()
         self.anonymize_ip()
         self.anonymize_query()
 
-    def export_data(self, output_dir=Path(os.getcwd()), export_all=False):
-        """Exports the anonymized data to csv files that can be shared."""
+    def _collect_for_export(self):
+        """Run the query plan, once, keeping only the columns needed for export."""
+        if isinstance(self.df, pl.LazyFrame):
+            location_columns = ["countryCode", "regionName", "city", "server"]
+            self.df = _collect_streaming(
+                self.df.select(
+                    self._anonymized_columns()
+                    | pl.selectors.by_name(location_columns, require_all=False)
+                )
+            )
+
+    def _export_incremental(
+        self, output_dir, export_all=False, export_format="csv", workers=4
+    ):
+        """Export only the requests after those already exported. See export_data."""
+        time_unit = self.temporal_resolution
+        state_file = output_dir / "export_state.json"
+        state = _read_export_state(None if export_all else state_file)
+        if state.setdefault("temporal_resolution", time_unit) != time_unit:
+            raise ValueError(
+                f"{output_dir} was exported with temporal_resolution {state['temporal_resolution']}"
+            )
+        # requests loaded through a checkpoint manifest are read for the first time, whatever their
+        # time. Otherwise requests loaded again are only told apart, by their digests, within
+        # _late_request_window of the last one exported, and older ones were exported before
+        new_lines = bool(self._manifest_updates)
+        last_exported = None
+        if state["last_exported"] is not None:
+            last_exported = datetime.fromisoformat(state["last_exported"])
+            if not new_lines:
+                self.df = self.df.filter(
+                    pl.col("datetime") >= last_exported - _late_request_window
+                )
+        self._collect_for_export()
+        recent = state.get("recent_requests", {})
+        if last_exported is not None and recent:
+            df = self.df.with_row_index("row")
+            window = df.filter(
+                pl.col("datetime").is_between(
+                    last_exported - _late_request_window, last_exported
+                )
+            )
+            exported = window.filter(
+                pl.Series(_request_digests(window)).is_in(list(recent))
+            )
+            self.df = df.filter(~pl.col("row").is_in(exported["row"])).drop("row")
+        if self.df.is_empty():
+            self.save_manifest()
+            return
+        # ip ids continue from those of previous exports, so they stay unique, and ips of the
+        # latest period exported keep theirs. Location counts are added to those stored, so they
+        # are counted from the new requests, not the cube
+        self._ip_id_offset = state["ip_ids"]
+        self._known_ip_ids = state.get("period_ip_ids", {})
+        cube, self.cube = self.cube, pl.DataFrame()
+        try:
+            self.anonymize_requests()
+        finally:
+            self._ip_id_offset = 0
+            self._known_ip_ids = {}
+            self.cube = cube
+        self.anonymized = _ensure_sorted(self.anonymized)
+        ip_ids = state.get("period_ip_ids", {})
+        known = [ip_id for ids in ip_ids.values() for ip_id in ids.values()]
+        state["ip_ids"] += len(self._ip_ids.filter(~pl.col("ip_id").is_in(known)))
+        if self.ip_key is None:
+            latest = max([*ip_ids, *self._ip_ids[self.temporal_resolution]])
+            ip_ids = ip_ids.get(latest, {})
+            ip_ids.update(
+                self._ip_ids.filter(pl.col(time_unit) == latest)
+                .select("address", "ip_id")
+                .iter_rows()
+            )
+            state["period_ip_ids"] = {latest: ip_ids}
+        _write_export_state(state_file, state)
+
+        requests = self.anonymized.partition_by(time_unit, as_dict=True)
+        # digests are only needed for the requests within the window of the last one exported
+        window = self.df.filter(
+            pl.col("datetime")
+            >= pl.col("datetime").max().over(time_unit) - _late_request_window
+        ).partition_by(time_unit, as_dict=True)
+        locations = self.location.partition_by(time_unit, as_dict=True)
+        periods = [period for (period,) in sorted(requests)]
+
+        def write(period):
+            """Write the updated files of a period to temporary files."""
+            fn = output_dir / f"{period}_anonymized_requests.{export_format}"
+            loc_fn = output_dir / f"{period}_aggregated_locations.{export_format}"
+            tmp_files = {
+                fn: _append_export(
+                    requests[(period,)], fn, export_format, append=not export_all
+                )
+            }
+            if (period,) in locations:
+                tmp_files[loc_fn] = _merge_location_counts(
+                    locations[(period,)], loc_fn, export_format, merge=not export_all
+                )
+            return tmp_files
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            updates = list(pool.map(write, periods))
+        # files are moved into place in time order, each period followed by its state
+        for period, tmp_files in zip(periods, updates):
+            df_sub = requests[(period,)]
+            for path, tmp in tmp_files.items():
+                os.replace(tmp, path)
+                if self.verbose:
+                    print(f"write file {path}")
+            bucket = state["buckets"].get(period, {"requests": 0, "bytes_sent": 0})
+            # late requests may be older than those exported before
+            last_request = df_sub["datetime"].max()
+            if state["last_exported"] is not None:
+                last_request = max(
+                    last_request, datetime.fromisoformat(state["last_exported"])
+                )
+            state["buckets"][period] = {
+                "requests": bucket["requests"] + len(df_sub),
+                "bytes_sent": bucket["bytes_sent"] + int(df_sub["bytes_sent"].sum()),
+                "last_request": max(
+                    bucket.get("last_request", ""),
+                    df_sub["datetime"].max().isoformat(),
+                ),
+            }
+            rows = window[(period,)]
+            recent.update(
+                zip(_request_digests(rows), rows["datetime"].dt.strftime("%FT%T"))
+            )
+            start = (last_request - _late_request_window).isoformat()
+            state["last_exported"] = last_request.isoformat()
+            state["recent_requests"] = {
+                digest: time for digest, time in sorted(recent.items()) if time >= start
+            }
+            _write_export_state(state_file, state)
+        self.save_manifest()
+
+    def export_data(
+        self,
+        output_dir=Path(os.getcwd()),
+        export_all=False,
+        by_server=False,
+        incremental=False,
+        export_format="csv",
+        workers=4,
+    ):
+        """
+        Exports the anonymized data to files that can be shared, one per time period.
+
+        export_format is one of "csv", "csv.gz", "parquet" or "ndjson". ERDDAP can serve csv and
+        gzipped csv files with EDDTableFromAsciiFiles, and parquet files with
+        EDDTableFromParquetFiles. Files are written concurrently by workers threads.
+
+        If by_server is True, the requests of each server loaded with load_servers are exported
+        to their own subdirectory of output_dir, named after the server.
+
+        If incremental is True, previous exports are not read back. A state file in output_dir,
+        export_state.json, records the last request exported and the totals of each time period.
+        Only new requests are anonymized, and only the files of the periods they fall in are
+        updated: their requests are appended and their location counts added. Requests loaded with
+        a checkpoint manifest are all new, whatever their time. Without one, requests are new if
+        they are after the last one exported, or up to 10 minutes before it and not exported yet.
+        Each file is replaced atomically and the state saved after each period, so an interrupted
+        export can be re-run. With incremental=True, export_all starts a new state and replaces the
+        files of the periods exported.
+        """
+        if by_server:
+            df_all = self.df
+            servers = df_all.lazy().select(pl.col("server").unique().sort()).collect()
+            for server in servers["server"].drop_nulls():
+                self.df = df_all.filter(pl.col("server") == server)
+                self.export_data(
+                    Path(output_dir) / server,
+                    export_all=export_all,
+                    incremental=incremental,
+                    export_format=export_format,
+                    workers=workers,
+                )
+            self.df = df_all
+            return
         if self.temporal_resolution not in _date_format_dict.keys():
             print(
                 f"self.temporal resolution must be one of {_date_format_dict.keys()}. Can not export data"
             )
             return
+        if export_format not in _export_formats:
+            raise ValueError(
+                f"export_format must be one of {_export_formats}, not {export_format}"
+            )
         self.df = self.df.with_columns(
-            self.df["datetime"]
+            pl.col("datetime")
             .dt.strftime(_date_format_dict[self.temporal_resolution])
             .alias(self.temporal_resolution)
         )
@@ -831,42 +2811,59 @@ class ErddapLogParser:
         time_unit = self.temporal_resolution
         if not output_dir.exists():
             output_dir.mkdir(parents=True)
-        previous_anon_files = list(output_dir.glob("*anonymized_requests.csv"))
+        if incremental:
+            self._export_incremental(
+                output_dir,
+                export_all=export_all,
+                export_format=export_format,
+                workers=workers,
+            )
+            return
+        previous_anon_files = list(
+            output_dir.glob(f"*anonymized_requests.{export_format}")
+        )
         if len(previous_anon_files) != 0 and not export_all:
             previous_anon_files.sort()
             most_recent_file = previous_anon_files[-1]
-            df_last = pl.read_csv(most_recent_file)
+            df_last = _read_exports([most_recent_file], export_format)
             if not df_last.is_empty():
                 last_request = df_last[self.temporal_resolution].max()
                 self.df = self.df.filter(
                     pl.col(self.temporal_resolution) >= last_request
                 )
+        self._collect_for_export()
 
         if not self.df.is_empty():
             self.anonymize_requests()
-            self.anonymized = self.anonymized.sort("datetime")
+            self.anonymized = _ensure_sorted(self.anonymized)
             if not self.anonymized.is_empty():
-                dates = self.anonymized[time_unit].unique().sort()
-                for date in dates:
-                    df_sub = self.anonymized.filter(pl.col(time_unit) == date).sort(
-                        "datetime"
-                    )
-                    fn = output_dir / f"{str(date)}_anonymized_requests.csv"
-                    df_sub.write_csv(fn)
-                    if self.verbose:
-                        print(f"write file {fn}")
-        existing_loc_files = list(output_dir.glob("*aggregated_locations.csv"))
+                _write_partitions(
+                    self.anonymized,
+                    time_unit,
+                    output_dir,
+                    "anonymized_requests",
+                    export_format=export_format,
+                    workers=workers,
+                    verbose=self.verbose,
+                )
+        existing_loc_files = list(
+            output_dir.glob(f"*aggregated_locations.{export_format}")
+        )
         if len(existing_loc_files) != 0:
-            old_locs = pl.read_csv(f"{str(output_dir)}/*aggregated_locations.csv")
+            old_locs = _read_exports(existing_loc_files, export_format).cast(
+                {"total_requests": pl.Int64}
+            )
             old_locs = old_locs.filter(
                 pl.col(self.temporal_resolution)
                 < self.df[self.temporal_resolution].min()
             )
+            server = [col for col in ["server"] if col in old_locs.columns]
             if not old_locs.is_empty():
                 old_locs = old_locs.with_columns(
                     old_locs.select(
                         pl.concat_str(
                             [pl.col(time_unit), pl.col("regionName"), pl.col("city")]
+                            + [pl.col(col) for col in server]
                         ).alias("month_region_city")
                     )
                 )
@@ -879,6 +2876,7 @@ class ErddapLogParser:
                                     pl.col("regionName"),
                                     pl.col("city"),
                                 ]
+                                + [pl.col(col) for col in server]
                             ).alias("month_region_city")
                         )
                     )
@@ -901,8 +2899,9 @@ class ErddapLogParser:
                     )
                     meta = meta.with_columns(total_requests=totals["total_requests"])
                     self.location = meta[
-                        [
-                            time_unit,
+                        [time_unit]
+                        + server
+                        + [
                             "countryCode",
                             "regionName",
                             "city",
@@ -910,19 +2909,20 @@ class ErddapLogParser:
                         ]
                     ]
         if not self.location.is_empty():
-            df = self.location.sort(time_unit)
-            dates = df[time_unit].unique().sort()
-
-            for date in dates:
-                df_sub = df.filter(pl.col(time_unit) == date)
-                fn = output_dir / f"{str(date)}_aggregated_locations.csv"
-                df_sub.write_csv(fn)
-                if self.verbose:
-                    print(f"write file {fn}")
+            _write_partitions(
+                self.location.sort(time_unit),
+                time_unit,
+                output_dir,
+                "aggregated_locations",
+                export_format=export_format,
+                workers=workers,
+                verbose=self.verbose,
+            )
+        self.save_manifest()
 
     def undo_filter(self):
-        """Reset to unfiltered DataFrame."""
+        """Reset to unfiltered DataFrame. To undo only some filters, see undo_last_filter and toggle_filter."""
         if self.verbose:
             print("Reset to unfiltered DataFrame")
-        self.df = self.unfiltered_df
+        self.df = self._filter_base
         self._update_original_total_requests()
@@ -16,7 +16,7 @@ def plot_daily_requests(df, num_days=7):
     Parameters
     ----------
     df: polars.DataFrame
-        DataFrame with requests information
+        DataFrame with requests information, or a cube from ErddapLogParser.build_cube
     num_days: int, default=7
         number of days to be plotted
     """
@@ -26,7 +26,9 @@ def plot_daily_requests(df, num_days=7):
     bins = np.arange(start, end, datetime.timedelta(days=num_days))
     fig, ax = plt.subplots(figsize=(12, 8))
 
-    ax.hist(df.select("datetime"), bins=bins)
+    # each row of a cube is a time bucket holding several requests
+    weights = df.select("requests") if "requests" in df.columns else None
+    ax.hist(df.select("datetime"), bins=bins, weights=weights)
 
     # shade weekends
     xmin, xmax = ax.get_xlim()
@@ -58,7 +60,7 @@ def _plot_popularity_bar(ax, df, col_name, rows):
     ax: Axes
         Axes for the plot
     df: polars.DataFrame
-        DataFrame with requests information
+        DataFrame with requests information, or a cube from ErddapLogParser.build_cube
     col_name: str
         repeated values column name
     rows: int
@@ -71,7 +73,16 @@ def _plot_popularity_bar(ax, df, col_name, rows):
     DataFrame
         subsetted DataFrame containing only the information to be plotted
     """
-    counts = Counter(df[col_name].drop_nulls().to_list()).most_common()
+    if "requests" in df.columns:
+        counts = (
+            df.group_by(col_name)
+            .agg(pl.col("requests").sum())
+            .drop_nulls(col_name)
+            .sort(["requests", col_name], descending=[True, False])
+            .rows()
+        )
+    else:
+        counts = Counter(df[col_name].drop_nulls().to_list()).most_common()
     if None in counts[0]:
         counts = counts[1:]
     names, counts = list(map(list, zip(*counts)))
@@ -97,7 +108,7 @@ def plot_most_popular(df, col_name="country", rows=10):
     Parameters
     ----------
     df: polars.DataFrame
-        DataFrame with requests information
+        DataFrame with requests information, or a cube from ErddapLogParser.build_cube
     col_name: str
         repeated values column name
     rows: int
@@ -162,7 +173,7 @@ def plot_bytes(df, days=3):
     Parameters
     ----------
     df: DataFrame
-        DataFrame to be plotted
+        DataFrame to be plotted, requests or a cube from ErddapLogParser.build_cube
     days: int, default = 3
         Number of days to sum over
 
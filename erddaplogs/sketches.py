@@ -0,0 +1,391 @@
+import hashlib
+import json
+import struct
+
+import numpy as np
+import polars as pl
+
+
+def _stable_hash(values):
+    """
+    64 bit hashes of strings that are the same on every machine and with every polars version.
+
+    Sketches are kept for years and merged across hosts, so the polars hash, which may change
+    between releases, can not be used. Nulls are dropped. Callers hash each distinct value once.
+    """
+    values = [value for value in values if value is not None]
+    return np.fromiter(
+        (
+            int.from_bytes(
+                hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "little"
+            )
+            for value in values
+        ),
+        dtype=np.uint64,
+        count=len(values),
+    )
+
+
+def _bit_length(x):
+    """Number of bits needed to represent each element of a uint64 array."""
+    x = x.copy()
+    length = np.zeros(x.shape, dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = x >= np.uint64(1 << shift)
+        length[high] += shift
+        x[high] >>= np.uint64(shift)
+    return length + (x > 0)
+
+
+class HyperLogLog:
+    """
+    Approximate count of distinct values in constant memory.
+
+    Uses 2**precision one byte registers. The relative standard error of count is about
+    1.04 / sqrt(2**precision), 1.6 % with the default precision of 12. Sketches of the same
+    precision are merged by taking the maximum of their registers, so adding the same values to
+    several sketches, or twice to one, does not change the count.
+
+    Parameters
+    ----------
+    precision: int, default=12
+        number of bits of the hash used to choose a register, between 4 and 16
+    """
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError(f"precision must be between 4 and 16, not {precision}")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        """Add values from their 64 bit hashes, see _stable_hash."""
+        index, rank = self._index_rank(hashes, self.precision)
+        np.maximum.at(self.registers, index, rank)
+
+    @staticmethod
+    def _index_rank(hashes, precision):
+        """Register index and rank (position of the first set bit) of each hash."""
+        width = 64 - precision
+        index = (hashes >> np.uint64(width)).astype(np.intp)
+        rest = hashes & np.uint64((1 << width) - 1)
+        rank = (width + 1 - _bit_length(rest)).astype(np.uint8)
+        return index, rank
+
+    def add(self, values):
+        """Add values, e.g. a polars Series of ip addresses."""
+        self.add_hashes(_stable_hash(pl.Series(values).unique()))
+
+    def merge(self, other):
+        """Add the values of another sketch of the same precision to this one."""
+        if other.precision != self.precision:
+            raise ValueError(
+                "can only merge HyperLogLog sketches of the same precision"
+            )
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        """Estimated number of distinct values added."""
+        return int(round(_hll_estimate(self.registers[np.newaxis, :])[0]))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls(data[0])
+        sketch.registers = np.frombuffer(data, dtype=np.uint8, offset=1).copy()
+        return sketch
+
+
+def _hll_estimate(registers):
+    """Distinct count estimates of the HyperLogLog registers in each row of a 2d array."""
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m**2 / np.sum(np.exp2(-registers.astype(np.float64)), axis=1)
+    zeros = np.sum(registers == 0, axis=1)
+    # linear counting is more accurate for small counts
+    small = (estimate <= 2.5 * m) & (zeros > 0)
+    estimate[small] = m * np.log(m / zeros[small])
+    return estimate
+
+
+class CountMinSketch:
+    """
+    Approximate counts of values in constant memory.
+
+    Counts are never underestimated. They are overestimated by at most e / width of the total
+    count, with probability 1 - exp(-depth). Sketches of the same size are merged by adding their
+    tables, so unlike HyperLogLog, adding the same requests twice doubles their counts.
+
+    Parameters
+    ----------
+    width: int, default=2048
+        counters per row
+    depth: int, default=5
+        number of rows, each with its own hash function
+    """
+
+    def __init__(self, width=2048, depth=5):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _columns(self, hashes):
+        """Counter of each hash in each row, by double hashing on the two halves of the hash."""
+        low = hashes & np.uint64(0xFFFFFFFF)
+        high = hashes >> np.uint64(32)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, np.newaxis]
+        return ((low + rows * high) % np.uint64(self.width)).astype(np.intp)
+
+    def add_hashes(self, hashes, counts):
+        columns = self._columns(hashes)
+        for row in range(self.depth):
+            np.add.at(self.table[row], columns[row], counts)
+
+    def estimate_hashes(self, hashes):
+        columns = self._columns(hashes)
+        return self.table[np.arange(self.depth)[:, np.newaxis], columns].min(axis=0)
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("can only merge CountMinSketch sketches of the same size")
+        self.table += other.table
+        return self
+
+    def to_bytes(self):
+        return struct.pack("<II", self.width, self.depth) + self.table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, depth = struct.unpack_from("<II", data)
+        sketch = cls(width, depth)
+        sketch.table = (
+            np.frombuffer(data, dtype=np.int64, offset=8).reshape(depth, width).copy()
+        )
+        return sketch
+
+
+class HeavyHitters:
+    """
+    The most frequent values of a stream, e.g. the busiest ips or most requested datasets.
+
+    Counts are kept in a CountMinSketch. Alongside it, the k values with the highest estimated
+    counts are kept as candidates. After each batch, the candidates are re-ranked together with
+    the values of the batch, so memory does not grow with the number of distinct values.
+
+    Parameters
+    ----------
+    k: int, default=100
+        number of candidates kept
+    width: int, default=2048
+        counters per row of the CountMinSketch
+    depth: int, default=5
+        rows of the CountMinSketch
+    """
+
+    def __init__(self, k=100, width=2048, depth=5):
+        self.k = k
+        self.counts = CountMinSketch(width, depth)
+        self.candidates = []
+
+    def add(self, values, counts=None):
+        """
+        Add values, or distinct values with their counts.
+
+        Parameters
+        ----------
+        values: polars.Series or list
+            values to count
+        counts: polars.Series or list, optional
+            number of times each value occurs. If given, values should be distinct
+        """
+        if counts is None:
+            df = pl.DataFrame({"value": pl.Series(values)}).group_by("value").len()
+        else:
+            df = pl.DataFrame({"value": pl.Series(values), "len": pl.Series(counts)})
+        df = df.drop_nulls("value").cast({"value": pl.String})
+        self.counts.add_hashes(
+            _stable_hash(df["value"]), df["len"].cast(pl.Int64).to_numpy()
+        )
+        self._rank(self.candidates + df["value"].to_list())
+
+    def _rank(self, values):
+        values = list(dict.fromkeys(values))
+        estimates = self.counts.estimate_hashes(_stable_hash(values))
+        order = np.argsort(-estimates, kind="stable")[: self.k]
+        self.candidates = [values[i] for i in order]
+
+    def merge(self, other):
+        self.counts.merge(other.counts)
+        self._rank(self.candidates + other.candidates)
+        return self
+
+    def top(self, n=10):
+        """The n most frequent values and their estimated counts, as a DataFrame."""
+        values = self.candidates[:n]
+        return pl.DataFrame(
+            {
+                "value": pl.Series(values, dtype=pl.String),
+                "count": self.counts.estimate_hashes(_stable_hash(values)),
+            }
+        )
+
+    def to_bytes(self):
+        header = json.dumps({"k": self.k, "candidates": self.candidates}).encode()
+        return struct.pack("<I", len(header)) + header + self.counts.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        (length,) = struct.unpack_from("<I", data)
+        header = json.loads(data[4 : 4 + length])
+        sketch = cls(header["k"])
+        sketch.counts = CountMinSketch.from_bytes(data[4 + length :])
+        sketch.candidates = header["candidates"]
+        return sketch
+
+
+class VisitorSketches:
+    """
+    Approximate distinct visitors (ip addresses) per time bucket and group, e.g. per dataset and day.
+
+    Holds one HyperLogLog per bucket and group. Requests can be added batch by batch, from eager or
+    lazy frames, and sketches built on different hosts or from different files are merged with
+    merge. Visitors over longer periods, up to years of logs, are estimated by merging the sketches
+    of their buckets, without keeping any requests.
+
+    Memory does not grow with the number of requests or visitors, but it does grow with the number
+    of buckets times the number of groups, as each pair takes 2**precision bytes. With the default
+    precision and daily buckets, 1000 datasets requested every day take about 1.5 GB per year. A
+    wider every or a lower precision keeps this down.
+
+    Parameters
+    ----------
+    by: str, default="dataset_id"
+        column to group visitors by
+    every: str, default="1d"
+        width of the time buckets, in the polars duration format
+    precision: int, default=12
+        precision of the HyperLogLog sketches. Each takes 2**precision bytes
+    """
+
+    def __init__(self, by="dataset_id", every="1d", precision=12):
+        self.by = by
+        self.every = every
+        self.precision = precision
+        self.sketches = {}
+
+    def distinct(self, df):
+        """Query plan for the distinct (bucket, group, ip) rows of df, all that update needs."""
+        return (
+            df.lazy()
+            .select(
+                pl.col("datetime").dt.truncate(self.every),
+                pl.col(self.by).cast(pl.String),
+                pl.col("ip").cast(pl.String),
+            )
+            .drop_nulls("ip")
+            .unique()
+        )
+
+    def update(self, df, distinct=False):
+        """
+        Add the requests of df, which needs datetime, ip and by columns.
+
+        With distinct=True, df is the already collected result of distinct, e.g. from a
+        polars.collect_all that also computes other aggregations in the same pass.
+        """
+        if not distinct:
+            df = self.distinct(df).collect()
+        ips = df.select(pl.col("ip").unique())
+        hashes = ips.with_columns(hash=pl.Series(_stable_hash(ips["ip"])))
+        df = df.join(hashes, on="ip")
+        for (bucket, group), df_group in df.partition_by(
+            ["datetime", self.by], as_dict=True
+        ).items():
+            key = (bucket, group)
+            if key not in self.sketches:
+                self.sketches[key] = HyperLogLog(self.precision)
+            self.sketches[key].add_hashes(df_group["hash"].to_numpy())
+
+    def merge(self, other):
+        """Add the sketches of another VisitorSketches with the same by, every and precision."""
+        if (other.by, other.every, other.precision) != (
+            self.by,
+            self.every,
+            self.precision,
+        ):
+            raise ValueError("can only merge VisitorSketches of the same settings")
+        for key, sketch in other.sketches.items():
+            if key in self.sketches:
+                self.sketches[key].merge(sketch)
+            else:
+                self.sketches[key] = HyperLogLog.from_bytes(sketch.to_bytes())
+        return self
+
+    def unique_visitors(self, every=None):
+        """
+        Estimated distinct visitors per time bucket and group.
+
+        Parameters
+        ----------
+        every: str, optional
+            wider time buckets to estimate over, e.g. "1mo" or "10y". Defaults to the sketch buckets
+
+        Returns
+        -------
+        polars.DataFrame
+            with columns datetime, by and visitors
+        """
+        keys = pl.DataFrame(
+            list(self.sketches.keys()),
+            schema={"datetime": pl.Datetime("us"), self.by: pl.String},
+            orient="row",
+        ).with_row_index("sketch")
+        if every is not None:
+            keys = keys.with_columns(pl.col("datetime").dt.truncate(every))
+        sketches = list(self.sketches.values())
+        groups = keys.group_by(["datetime", self.by], maintain_order=True).agg("sketch")
+        registers = (
+            np.stack(
+                [
+                    np.maximum.reduce([sketches[i].registers for i in members])
+                    for members in groups["sketch"]
+                ]
+            )
+            if len(groups)
+            else np.zeros((0, 1 << self.precision), dtype=np.uint8)
+        )
+        return (
+            groups.drop("sketch")
+            .with_columns(
+                visitors=pl.Series(np.round(_hll_estimate(registers)), dtype=pl.Int64)
+            )
+            .sort(["datetime", self.by], nulls_last=True)
+        )
+
+    def to_frame(self):
+        """The sketches as a DataFrame, one row per time bucket and group, e.g. to write to Parquet."""
+        return pl.DataFrame(
+            [
+                (bucket, group, sketch.to_bytes())
+                for (bucket, group), sketch in self.sketches.items()
+            ],
+            schema={
+                "datetime": pl.Datetime("us"),
+                self.by: pl.String,
+                "sketch": pl.Binary,
+            },
+            orient="row",
+        )
+
+    @classmethod
+    def from_frame(cls, df, every="1d"):
+        """Sketches from a DataFrame written by to_frame."""
+        by = df.columns[1]
+        sketches = cls(by=by, every=every)
+        for bucket, group, data in df.iter_rows():
+            sketches.sketches[(bucket, group)] = HyperLogLog.from_bytes(data)
+            sketches.precision = data[0]
+        return sketches
@@ -1,3 +1,4 @@
+import json
 import polars as pl
 from erddaplogs.logparse import ErddapLogParser
 import erddaplogs.plot_functions as plot_functions
@@ -119,3 +120,891 @@ def test_plots():
     for rank, ip in enumerate(dfa['ip'].to_list()):
         df_sub = df.filter(pl.col('ip') == ip)
         plot_functions.plot_for_single_ip(df_sub, f'visitor_rank_{rank}_ip_{ip}')
+
+
+def test_load_gzipped_logs(tmp_path):
+    import gzip
+    import pytest
+    for infile in Path("example_data/nginx_example_logs/").glob("*access*"):
+        with open(infile, "rb") as f_in, gzip.open(tmp_path / f"{infile.name}.gz", "wb") as f_out:
+            f_out.write(f_in.read())
+    parser_plain = ErddapLogParser()
+    parser_plain.load_nginx_logs("example_data/nginx_example_logs/")
+    parser_gz = ErddapLogParser()
+    parser_gz.load_nginx_logs(tmp_path)
+    assert parser_gz.df.shape == parser_plain.df.shape
+    assert parser_gz.df.schema == parser_plain.df.schema
+
+    # in lazy mode, gzipped logs are only decompressed when the requests are collected
+    truncated = (tmp_path / "tomcat-access.log.1.gz").read_bytes()[:1000]
+    (tmp_path / "tomcat-access.log.0.gz").write_bytes(truncated)
+    parser_lazy = ErddapLogParser()
+    parser_lazy.lazy = True
+    parser_lazy.load_nginx_logs(tmp_path)
+    with pytest.raises(Exception):
+        parser_lazy.df.collect()
+
+
+def test_read_log_lines_control_characters():
+    from erddaplogs.logparse import _load_log_file
+
+    with open("example_data/nginx_example_logs/tomcat-access.log.1", "rb") as f:
+        data = f.read()
+    df = _load_log_file(data)
+    weird = (b'171.177.25.126 - - [20/May/2024:00:00:19 +0000] "GET /erddap/index.html HTTP/1.1" 200 5'
+             b' "-" "Mozilla/5.0\x1f\x00;"\n')
+    df_weird = _load_log_file(data + weird)
+    assert len(df_weird) == len(df) + 1
+    assert df_weird["user_agent"][-1] == "Mozilla/5.0\x1f\x00;"
+
+
+def test_lazy_pipeline(tmp_path):
+    exports = {}
+    for lazy in (False, True):
+        parser = ErddapLogParser()
+        parser.lazy = lazy
+        parser.load_nginx_logs("example_data/nginx_example_logs/sub_1")
+        parser.filter_non_erddap()
+        parser.filter_spam()
+        parser.filter_locales()
+        parser.filter_common_strings()
+        parser.get_ip_info(ip_info_csv=tmp_path / "ip.csv", download_new=False)
+        parser.filter_organisations()
+        parser.parse_datasets_xml("example_data/datasets.xml")
+        parser.parse_columns()
+        assert isinstance(parser.df, pl.LazyFrame) == lazy
+        parser.export_data(output_dir=tmp_path / f"lazy_{lazy}")
+        exports[lazy] = parser
+    assert isinstance(exports[True].df, pl.DataFrame)
+    assert exports[True].anonymized.shape == exports[False].anonymized.shape
+    assert exports[True].location.sort("city").equals(exports[False].location.sort("city"))
+
+
+def test_parallel_load():
+    parser = ErddapLogParser()
+    parser.load_nginx_logs("example_data/nginx_example_logs/")
+    parser_parallel = ErddapLogParser()
+    parser_parallel.load_nginx_logs("example_data/nginx_example_logs/", workers=3)
+    assert parser_parallel.df.equals(parser.df)
+
+
+def test_incremental_load_manifest(tmp_path):
+    import gzip
+    lines = Path("example_data/nginx_example_logs/tomcat-access.log.8").read_bytes().splitlines(keepends=True)
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+    manifest = tmp_path / "manifest.json"
+    active_log = log_dir / "access.log"
+
+    def load_new():
+        parser = ErddapLogParser()
+        parser.load_nginx_logs(log_dir, manifest=manifest)
+        parser.save_manifest()
+        return parser.df
+
+    active_log.write_bytes(b"".join(lines[:1000]))
+    loaded = [load_new()]
+    # lines appended to the active log, the last one still being written
+    with open(active_log, "ab") as f:
+        f.write(b"".join(lines[1000:2000]) + lines[2000][:20])
+    loaded.append(load_new())
+    # finish the partial line, rotate and compress the log, then start a new one
+    with open(active_log, "ab") as f:
+        f.write(lines[2000][20:] + b"".join(lines[2001:3000]))
+    with open(active_log, "rb") as f_in, gzip.open(log_dir / "access.log.1.gz", "wb") as f_out:
+        f_out.write(f_in.read())
+    active_log.unlink()
+    active_log.write_bytes(b"".join(lines[3000:]))
+    loaded.append(load_new())
+    assert load_new().is_empty()
+
+    parser_all = ErddapLogParser()
+    parser_all.load_nginx_logs(log_dir)
+    df_incremental = pl.concat(loaded)
+    assert not any(df.is_empty() for df in loaded)
+    assert df_incremental.sort(df_incremental.columns).equals(parser_all.df.sort(parser_all.df.columns))
+
+
+def test_shared_manifest(tmp_path):
+    from erddaplogs.logparse import _read_manifest
+
+    manifest = tmp_path / "manifest.json"
+    for server, digits in [("north", "12"), ("south", "34")]:
+        (tmp_path / server).mkdir()
+        for digit in digits:
+            shutil.copy(f"example_data/nginx_example_logs/tomcat-access.log.{digit}", tmp_path / server)
+    # directories loaded one after the other, then as servers, before the manifest is saved
+    parser = ErddapLogParser()
+    parser.load_nginx_logs(tmp_path / "north", manifest=manifest)
+    parser.load_nginx_logs(tmp_path / "south", manifest=manifest)
+    parser.save_manifest()
+    assert len(_read_manifest(manifest)) == 4
+    servers = {server: {"logs_dir": tmp_path / server, "manifest": manifest} for server in ["north", "south"]}
+    shutil.copy("example_data/nginx_example_logs/tomcat-access.log.5", tmp_path / "north")
+    shutil.copy("example_data/nginx_example_logs/tomcat-access.log.6", tmp_path / "south")
+    parser = ErddapLogParser()
+    parser.load_servers(servers, workers=1)
+    parser.save_manifest()
+    assert len(_read_manifest(manifest)) == 6
+    parser = ErddapLogParser()
+    parser.load_servers(servers, workers=1)
+    assert parser.df.is_empty()
+
+
+def test_parquet_store(tmp_path):
+    import datetime
+    store = tmp_path / "store"
+    for sub_dir in ["sub_0", "sub_1"]:
+        parser = ErddapLogParser()
+        parser.temporal_resolution = "day"
+        parser.load_nginx_logs(f"example_data/nginx_example_logs/{sub_dir}")
+        parser.write_store(store)
+    assert len(list(store.glob("day=*/*.parquet"))) == 9
+    parser_store = ErddapLogParser()
+    parser_store.load_store(store)
+    assert parser_store.df.equals(parser.df)
+    start, end = datetime.datetime(2024, 5, 14, 12), datetime.datetime(2024, 5, 16)
+    parser_store = ErddapLogParser()
+    parser_store.load_store(store, start=start, end=end, columns=["datetime", "ip", "url"])
+    expected = parser.df.filter(pl.col("datetime") >= start, pl.col("datetime") < end)
+    assert parser_store.df.columns == ["datetime", "ip", "url"]
+    assert len(parser_store.df) == len(expected)
+    parser_store = ErddapLogParser()
+    parser_store.load_store(store, columns=["ip", "url"])
+    assert parser_store.df.columns == ["datetime", "ip", "url"]
+    assert parser_store.df["datetime"].is_sorted()
+    assert len(parser_store.df) == len(parser.df)
+
+
+def test_user_agent_cache(tmp_path):
+    cache = tmp_path / "user_agents.pqt"
+    parser = ErddapLogParser()
+    parser.user_agent_cache = cache
+    parser.load_nginx_logs("example_data/nginx_example_logs/sub_0")
+    parser.classify_user_agents()
+    for col in ["is_bot", "BrowserFamily", "DeviceFamily", "OS"]:
+        assert parser.df[col].null_count() == 0
+    assert cache.exists()
+    parser.filter_user_agents()
+    assert not parser.df["is_bot"].any()
+    # a fresh parser finds the user agents already classified in the cache
+    parser = ErddapLogParser()
+    parser.user_agent_cache = cache
+    parser.load_nginx_logs("example_data/nginx_example_logs/sub_1")
+    parser.filter_user_agents()
+    cached = pl.read_parquet(cache)
+    assert cached["user_agent"].is_unique().all()
+    assert set(parser.df["user_agent"]).issubset(set(cached["user_agent"]))
+
+
+def test_keyed_ip_ids():
+    ids = []
+    for sub_dir in ["sub_0", "sub_1"]:
+        parser = ErddapLogParser()
+        parser.ip_key = "not-a-real-secret"
+        parser.load_nginx_logs(f"example_data/nginx_example_logs/{sub_dir}")
+        parser.df = parser.df.with_columns(month=pl.col("datetime").dt.strftime("%Y-%m"))
+        parser.anonymized = parser.df.select("month", "ip", "url", "user_agent")
+        parser.anonymize_ip()
+        assert parser.anonymized["ip_id"].n_unique() == parser.df["ip"].n_unique()
+        ids.append(set(parser.anonymized["ip_id"]))
+    # sub_1 contains all of the logs in sub_0, the same ips get the same ids
+    assert ids[0].issubset(ids[1])
+
+
+def test_ip_api_client(tmp_path):
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from erddaplogs.ipinfo import IpApiClient
+
+    calls = []
+
+    class StubIpApi(BaseHTTPRequestHandler):
+        def _reply(self, status, payload, headers=()):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            ips = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            calls.append(len(ips))
+            if len(calls) == 1:
+                # rate limited on the first request, the client must wait and retry
+                return self._reply(429, {}, [("X-Rl", "0"), ("X-Ttl", "1")])
+            self._reply(200, [{"status": "success", "country": "Sweden", "org": "SMHI", "lat": 57.7, "lon": 12.0,
+                               "query": ip} for ip in ips], [("X-Rl", "14"), ("X-Ttl", "60")])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubIpApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = IpApiClient(base_url=f"http://127.0.0.1:{server.server_port}", batch_size=5, max_workers=2)
+        parser = ErddapLogParser()
+        parser.load_nginx_logs("example_data/nginx_example_logs/sub_0")
+        parser.get_ip_info(num_ips=12, ip_info_csv=tmp_path / "ip.csv", backend=client)
+    finally:
+        server.shutdown()
+    assert sorted(calls) == [2, 5, 5, 5]
+    assert parser.ip["country"].drop_nulls().to_list().count("Sweden") == 12
+    assert parser.df["country"].null_count() < len(parser.df)
+
+
+def test_ip_api_client_failed_batch():
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from erddaplogs.ipinfo import IpApiClient
+
+    class StubIpApi(BaseHTTPRequestHandler):
+        def do_POST(self):
+            ips = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if "bad" in ips:
+                status, payload = 400, {"message": "invalid query"}
+            else:
+                status, payload = 200, [{"status": "success", "country": "Sweden", "query": ip} for ip in ips]
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubIpApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = IpApiClient(base_url=f"http://127.0.0.1:{server.server_port}", batch_size=2, max_workers=1)
+        df = client.lookup(["1.1.1.1", "2.2.2.2", "bad", "3.3.3.3", "4.4.4.4"])
+    finally:
+        server.shutdown()
+    # the batch with the rejected ip is skipped, the batches around it are kept
+    assert sorted(df["query"]) == ["1.1.1.1", "2.2.2.2", "4.4.4.4"]
+
+
+def test_local_geoip_database(tmp_path):
+    from erddaplogs.ipinfo import GeoIpDatabase
+
+    ranges = tmp_path / "ranges.csv"
+    pl.DataFrame(
+        {
+            "network": ["0.0.0.0/1", "128.0.0.0/2", "2001:db8::/32"],
+            "country": ["Sweden", "Germany", "France"],
+            "countryCode": ["SE", "DE", "FR"],
+            "lat": [57.7, 52.5, 48.4],
+            "lon": [12.0, 13.4, -4.5],
+        }
+    ).write_csv(ranges)
+    parser = ErddapLogParser()
+    parser.load_nginx_logs("example_data/nginx_example_logs/sub_0")
+    parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=GeoIpDatabase(ranges))
+    first_octet = parser.df["ip"].str.split(".").list.first().cast(int)
+    expected = pl.when(first_octet < 128).then(pl.lit("Sweden")).when(first_octet < 192).then(pl.lit("Germany"))
+    assert parser.df.select(pl.col("country").eq_missing(expected).all()).item()
+    assert set(parser.df.filter(first_octet >= 192)["status"]) == {"fail"}
+
+
+def test_ip_info_cache(tmp_path):
+    import datetime
+    from erddaplogs.ipinfo import GeoIpDatabase
+
+    class CountingBackend(GeoIpDatabase):
+        looked_up = []
+
+        def lookup(self, ips):
+            self.looked_up.append(len(ips))
+            return super().lookup(ips)
+
+    backend = CountingBackend(pl.DataFrame({"network": ["0.0.0.0/0"], "country": ["Sweden"]}))
+    for ip_info in [tmp_path / "ip.csv", tmp_path / "ip.db"]:
+        for _ in range(2):
+            parser = ErddapLogParser()
+            parser.load_nginx_logs("example_data/nginx_example_logs/sub_0")
+            parser.get_ip_info(num_ips=5, ip_info_csv=ip_info, backend=backend)
+        # the second run only fetches ips that are not cached yet
+        assert parser.ip["query"].is_unique().all()
+        assert len(parser.ip) == 10
+        assert parser.df["country"].null_count() < len(parser.df)
+    assert pl.read_csv(tmp_path / "ip.csv")["query"].is_unique().all()
+    backend.looked_up.clear()
+    # all entries are stale. They are used until they are fetched again, after the unknown ips
+    for download_new, num_ips, cached in [(False, 5, 10), (True, 5, 15), (True, None, 646)]:
+        parser = ErddapLogParser()
+        parser.load_nginx_logs("example_data/nginx_example_logs/sub_0")
+        parser.get_ip_info(num_ips=num_ips, ip_info_csv=tmp_path / "ip.db", backend=backend,
+                           max_age=datetime.timedelta(0), download_new=download_new)
+        assert parser.df.filter(pl.col("ip").is_in(parser.ip["query"]))["country"].null_count() == 0
+        assert len(parser.ip) == cached
+    assert backend.looked_up == [5, 646]
+
+
+def test_parse_urls():
+    from erddaplogs.logparse import _parse_urls
+
+    df = _parse_urls(
+        pl.DataFrame(
+            {
+                "url": [
+                    "/erddap/de/tabledap/nrt_SEA067_M15.csv?time,latitude&time>=2024-05-01",
+                    "/erddap/griddap/bathymetry.nc",
+                    "/erddap/login.html",
+                    "/erddap/zh-CN/index.html",
+                ]
+            }
+        )
+    )
+    assert df["language"].to_list() == ["German", "English", "English", "Chinese-CN"]
+    assert df["url"][0] == "/erddap/tabledap/nrt_SEA067_M15.csv?time,latitude&time>=2024-05-01"
+    assert df["erddap_request_type"].to_list() == ["tabledap", "griddap", "login", "index"]
+    assert df["dataset_id"].to_list() == ["nrt_SEA067_M15", "bathymetry", None, None]
+    assert df["file_type"].to_list() == ["csv", "nc", None, None]
+    assert df["request_kwargs"].to_list() == ["time,latitude&time>=2024-05-01", None, None, None]
+
+
+def test_compact_mode(tmp_path):
+    from erddaplogs.ipinfo import GeoIpDatabase
+
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/1", "128.0.0.0/1"], "countryCode": ["SE", "DE"],
+                                          "city": ["Gothenburg", "Berlin"], "org": ["SMHI", "Google"]}))
+    sizes = []
+    for compact in [False, True]:
+        parser = ErddapLogParser()
+        parser.compact = compact
+        parser.ip_key = "not-a-real-secret"
+        parser.load_nginx_logs("example_data/nginx_example_logs/")
+        parser.filter_non_erddap()
+        parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / f"ip_{compact}.csv", backend=backend)
+        parser.filter_organisations()
+        parser.parse_datasets_xml("example_data/datasets.xml")
+        parser.parse_columns()
+        sizes.append(parser.df.estimated_size())
+        parser.export_data(output_dir=tmp_path / f"out_{compact}")
+    assert parser.df["ip"].dtype == pl.UInt32
+    assert parser.df["erddap_request_type"].dtype == pl.Enum
+    assert parser.df["dataset_id"].dtype == pl.Categorical
+    assert parser.df["url"].dtype == pl.String
+    assert sizes[1] < sizes[0] * 0.85
+    for fn in (tmp_path / "out_False").glob("*.csv"):
+        assert pl.read_csv(fn).equals(pl.read_csv(tmp_path / "out_True" / fn.name))
+
+
+def test_star_schema(tmp_path):
+    from erddaplogs.ipinfo import GeoIpDatabase
+
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/2", "64.0.0.0/2", "128.0.0.0/1"],
+                                          "countryCode": ["SE", "NO", "DE"], "regionName": ["Västra Götaland", "Oslo", "Berlin"],
+                                          "city": ["Gothenburg", "Oslo", "Berlin"], "org": ["SMHI", "Google", None]}))
+    requests = []
+    for star_schema in [False, True]:
+        parser = ErddapLogParser()
+        parser.star_schema = star_schema
+        parser.load_nginx_logs("example_data/nginx_example_logs/")
+        parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=backend)
+        parser.filter_organisations()
+        parser.parse_columns()
+        requests.append(parser.materialize_df())
+        parser.export_data(output_dir=tmp_path / f"out_{star_schema}")
+    assert "org" not in parser.df.columns
+    assert parser.ip["query"].is_unique().all()
+    assert set(parser.df["ip"]).issubset(set(parser.ip["query"]))
+    assert requests[1].select(requests[0].columns).drop("org", "isp").equals(requests[0].drop("org", "isp"))
+    for fn in (tmp_path / "out_False").glob("*.csv"):
+        assert pl.read_csv(fn).sort(pl.all()).equals(pl.read_csv(tmp_path / "out_True" / fn.name).sort(pl.all()))
+
+
+def test_filter_rules():
+    sequential = ErddapLogParser()
+    sequential.load_nginx_logs("example_data/nginx_example_logs/")
+    sequential.filter_spam()
+    sequential.filter_locales()
+    sequential.filter_common_strings()
+    sequential.filter_user_agents()
+    parser = ErddapLogParser()
+    parser.load_nginx_logs("example_data/nginx_example_logs/")
+    parser.filter_rules(
+        {
+            "spam": parser.spam_rule(),
+            "locales": parser.locales_rule(),
+            "common strings": parser.common_strings_rule(),
+            "bots": parser.user_agents_rule(),
+            "subscriptions": pl.col("url").str.contains("/erddap/subscriptions/", literal=True),
+        }
+    )
+    subscriptions = sequential.df.filter(pl.col("url").str.contains("/erddap/subscriptions/", literal=True))
+    assert parser.df.equals(sequential.df.filter(~pl.col("url").str.contains("/erddap/subscriptions/", literal=True)))
+    stats = {row["rule"]: row for row in parser.filter_stats.iter_rows(named=True)}
+    assert stats["subscriptions"]["unique_matches"] == len(subscriptions) > 0
+    assert stats["spam"]["matches"] >= stats["spam"]["unique_matches"] > 0
+    assert sum(row["unique_matches"] for row in stats.values()) <= 10241 - len(parser.df)
+
+
+def test_filter_spam_loop_equivalence():
+    from collections import Counter
+
+    spam_strings = (".env", "env.", ".php", ".git", "robots.txt", "phpinfo", "/config", "aws", ".xml")
+    parser = ErddapLogParser()
+    parser.load_nginx_logs("example_data/nginx_example_logs/")
+    df = parser.df.with_columns(url=pl.col("url") + "?page=" + pl.int_range(pl.len()).cast(pl.String))
+
+    # the previous implementation, a Python loop over every distinct url and phrase.
+    # benchmarks/bench_filter_spam.py compares their speed
+    bad_pages = []
+    for page, count in Counter(list(df.select("url").to_numpy()[:, 0])).most_common():
+        for phrase in spam_strings:
+            if phrase in page:
+                bad_pages.append(page)
+    expected = df.filter(~pl.col("url").is_in(bad_pages))
+
+    parser.df = df
+    parser.filter_spam(spam_strings)
+    assert parser.df.equals(expected)
+
+    parser.filter_spam((), regexes=[r"/tabledap/.*\.nc\?"], prefixes=["/erddap/info"], suffixes=["7"])
+    assert not parser.df["url"].str.contains(r"/tabledap/.*\.nc\?").any()
+    assert not parser.df["url"].str.starts_with("/erddap/info").any()
+    assert not parser.df["url"].str.ends_with("7").any()
+
+
+def test_filter_history():
+    parser = ErddapLogParser()
+    parser.load_nginx_logs("example_data/nginx_example_logs/")
+    # a bot seen only in a spam request
+    spam_bot = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html) spam"
+    parser.df = pl.concat([parser.df, parser.df.head(1).with_columns(
+        url=pl.lit("/.env"), user_agent=pl.lit(spam_bot))])
+    unfiltered = parser.df
+    parser.filter_spam()
+    after_spam = parser.df
+    parser.filter_user_agents()
+    parser.filter_files()
+    after_all = parser.df
+    assert [entry["name"] for entry in parser.filter_history] == ["spam", "user agents", "files"]
+    assert parser.count_remaining() == len(after_all)
+    assert parser.count_remaining(["spam"]) == len(after_spam)
+
+    parser.toggle_filter("user agents")
+    bots = parser.user_agents.filter(pl.col("is_bot"))["user_agent"]
+    assert parser.df["user_agent"].is_in(bots).any()
+    assert parser.df.equals(unfiltered.filter(~parser.spam_rule(), ~parser.files_rule()))
+    parser.toggle_filter("user agents")
+    assert parser.df.equals(after_all)
+
+    # the user agents filter removes the bot once the spam filter is toggled off
+    assert unfiltered.filter(parser.spam_rule())["user_agent"].is_in([spam_bot]).any()
+    parser.toggle_filter("spam")
+    assert not parser.df["user_agent"].is_in([spam_bot]).any()
+    parser.toggle_filter("spam")
+    assert parser.df.equals(after_all)
+
+    parser.undo_last_filter()
+    parser.undo_last_filter()
+    assert parser.df.equals(after_spam)
+    parser.redo_filter()
+    parser.redo_filter()
+    assert parser.df.equals(after_all)
+    parser.undo_filter()
+    assert parser.df.equals(unfiltered)
+
+
+def test_rollup_cube(tmp_path):
+    from erddaplogs.ipinfo import GeoIpDatabase
+
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/1", "128.0.0.0/1"], "countryCode": ["SE", "DE"],
+                                          "regionName": ["Västra Götaland", "Berlin"], "city": ["Gothenburg", "Berlin"]}))
+    outputs = []
+    for star_schema in [False, True]:
+        parser = ErddapLogParser()
+        parser.star_schema = star_schema
+        parser.load_nginx_logs("example_data/nginx_example_logs/")
+        parser.filter_spam()
+        parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=backend)
+        parser.parse_columns()
+        df = parser.materialize_df()
+        parser.export_data(output_dir=tmp_path / "raw")
+        parser.build_cube()
+        parser.export_data(output_dir=tmp_path / f"cube_{star_schema}", export_all=True)
+        outputs.append(parser.cube)
+        cube = parser.cube
+        assert cube["requests"].sum() == len(df)
+        assert cube["bytes_sent"].sum() == df["bytes_sent"].sum()
+        daily = parser.rollup("1d", dimensions=["dataset_id"])
+        expected = df.group_by(pl.col("datetime").dt.truncate("1d"), "dataset_id").len()
+        assert expected.sort(["datetime", "dataset_id"], nulls_last=True)["len"].to_list() == daily["requests"].to_list()
+        popular = plot_functions.plot_most_popular(cube, "dataset_id")
+        assert popular["counts"].equals(plot_functions.plot_most_popular(df, "dataset_id")["counts"])
+        assert len(plot_functions.plot_bytes(cube).patches) == len(plot_functions.plot_bytes(df).patches)
+        for fn in (tmp_path / "raw").glob("*aggregated_locations.csv"):
+            assert pl.read_csv(fn).sort(pl.all()).equals(pl.read_csv(tmp_path / f"cube_{star_schema}" / fn.name).sort(pl.all()))
+    assert outputs[0].equals(outputs[1].select(outputs[0].columns))
+
+    parser.write_cube(tmp_path / "cube.pqt")
+    parser.write_cube(tmp_path / "cube.pqt")
+    parser.load_cube(tmp_path / "cube.pqt")
+    assert parser.cube.equals(cube)
+    parser.write_cube(tmp_path / "cube.pqt", accumulate=True)
+    assert pl.read_parquet(tmp_path / "cube.pqt")["requests"].sum() == 2 * len(df)
+
+
+def test_sketches(tmp_path):
+    from erddaplogs.sketches import HyperLogLog
+
+    sketch = HyperLogLog()
+    sketch.add([f"10.0.{i // 256}.{i % 256}" for i in range(50000)])
+    assert abs(sketch.count() - 50000) < 0.05 * 50000
+    assert HyperLogLog.from_bytes(sketch.to_bytes()).merge(sketch).count() == sketch.count()
+
+    parser = ErddapLogParser()
+    parser.load_nginx_logs("example_data/nginx_example_logs/")
+    parser.parse_columns()
+    for wildcard in ["*access.log.[0-4]*", "*access.log.[5-9]*"]:
+        batch = ErddapLogParser()
+        batch.load_nginx_logs("example_data/nginx_example_logs/", wildcard_fname=wildcard)
+        batch.parse_columns()
+        batch.update_sketches()
+        batch.write_sketches(tmp_path / "sketches")
+    parser.load_sketches(tmp_path / "sketches")
+    exact = parser.df.group_by("dataset_id").agg(pl.col("ip").n_unique())
+    estimate = parser.unique_visitors(every="100y").join(exact, on="dataset_id")
+    assert len(estimate) == len(exact.drop_nulls())
+    assert (estimate["visitors"] - estimate["ip"]).abs().max() <= 0.05 * estimate["ip"].max()
+    top_ips = parser.df.group_by("ip").len().sort("len", descending=True).head(5)
+    assert parser.top("ip", rows=5)["ip"].to_list() == top_ips["ip"].to_list()
+    assert parser.top("ip", rows=5)["counts"].to_list() == top_ips["len"].to_list()
+    # writing again, or after loading, does not count the requests twice
+    batch.write_sketches(tmp_path / "sketches")
+    parser.write_sketches(tmp_path / "sketches")
+    parser.load_sketches(tmp_path / "sketches")
+    assert parser.top("ip", rows=5)["counts"].to_list() == top_ips["len"].to_list()
+
+
+
+def test_load_servers(tmp_path):
+    from erddaplogs.ipinfo import GeoIpDatabase
+
+    lengths = []
+    for server, digits in [("north", "1234"), ("south", "5678")]:
+        (tmp_path / server).mkdir()
+        for digit in digits:
+            shutil.copy(f"example_data/nginx_example_logs/tomcat-access.log.{digit}", tmp_path / server)
+        single = ErddapLogParser()
+        single.load_nginx_logs(tmp_path / server)
+        lengths.append(len(single.df))
+    single.load_nginx_logs(tmp_path / "north")
+    parser = ErddapLogParser()
+    parser.load_servers({"north": tmp_path / "north", "south": {"logs_dir": tmp_path / "south", "format": "apache"}},
+                        workers=2)
+    assert parser.df["datetime"].is_sorted()
+    assert parser.df.drop("server").sort(pl.all()).equals(single.df.sort(pl.all()))
+    assert parser.df.group_by("server").len().sort("server")["len"].to_list() == lengths
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/0"], "countryCode": ["SE"], "city": ["Gothenburg"]}))
+    parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=backend)
+    parser.parse_columns()
+    parser.export_data(output_dir=tmp_path / "combined")
+    parser.export_data(output_dir=tmp_path / "split", by_server=True)
+    for server in ["north", "south"]:
+        for fn in (tmp_path / "split" / server).glob("*.csv"):
+            combined = pl.read_csv(tmp_path / "combined" / fn.name).filter(pl.col("server") == server)
+            assert "server" in combined.columns
+            assert len(pl.read_csv(fn)) == len(combined)
+
+
+def test_sorted_requests(tmp_path):
+    from erddaplogs.ipinfo import GeoIpDatabase
+    from erddaplogs.logparse import _ensure_sorted
+
+    df = pl.DataFrame({"datetime": [3, 1, 2], "url": ["c", "a", "b"]})
+    assert _ensure_sorted(df)["url"].to_list() == ["a", "b", "c"]
+    in_order = _ensure_sorted(df.sort("datetime"))
+    assert in_order["datetime"].flags["SORTED_ASC"]
+
+    for digit in "12":
+        shutil.copy(f"example_data/nginx_example_logs/tomcat-access.log.{digit}", tmp_path)
+    parser = ErddapLogParser()
+    parser.load_nginx_logs(tmp_path)
+    parser.parse_datasets_xml("example_data/datasets.xml")
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/0"], "countryCode": ["SE"]}))
+    parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=backend)
+    parser.parse_columns()
+    assert parser.df["datetime"].flags["SORTED_ASC"]
+    assert parser.df["datetime"].to_list() == sorted(parser.df["datetime"].to_list())
+
+
+def test_incremental_export(tmp_path):
+    from datetime import datetime
+    from erddaplogs.ipinfo import GeoIpDatabase
+
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/1", "128.0.0.0/1"], "countryCode": ["SE", "NO"],
+                                          "city": ["Gothenburg", "Oslo"]}))
+    cutoff = datetime(2024, 5, 16, 12)
+    for run in ["before", "after", "after", "full"]:
+        parser = ErddapLogParser()
+        parser.temporal_resolution = "day"
+        parser.load_nginx_logs("example_data/nginx_example_logs/")
+        if run == "before":
+            parser.df = parser.df.filter(pl.col("datetime") < cutoff)
+        parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=backend)
+        parser.parse_columns()
+        if run == "full":
+            parser.export_data(output_dir=tmp_path / "full")
+        else:
+            parser.export_data(output_dir=tmp_path / "incremental", incremental=True)
+    state = json.loads((tmp_path / "incremental" / "export_state.json").read_text())
+    assert state["last_exported"] == parser.df["datetime"].max().isoformat()
+    assert sum(bucket["requests"] for bucket in state["buckets"].values()) == len(parser.df)
+    full_files = sorted(fn.name for fn in (tmp_path / "full").glob("*.csv"))
+    assert full_files == sorted(fn.name for fn in (tmp_path / "incremental").glob("*.csv"))
+    for name in full_files:
+        full = pl.read_csv(tmp_path / "full" / name)
+        incremental = pl.read_csv(tmp_path / "incremental" / name)
+        if "requests" in name:
+            assert full.drop("ip_id").equals(incremental.drop("ip_id"))
+            # an ip seen before and after the cutoff keeps its id
+            assert incremental["ip_id"].n_unique() == full["ip_id"].n_unique()
+            assert incremental.group_by("ip_id").len()["len"].sort().equals(full.group_by("ip_id").len()["len"].sort())
+        else:
+            assert full.sort(pl.all()).equals(incremental.sort(pl.all()))
+
+
+def test_incremental_export_same_second(tmp_path):
+    from datetime import datetime
+    from erddaplogs.ipinfo import GeoIpDatabase
+    from erddaplogs.logparse import _read_exports
+
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/0"], "countryCode": ["SE"], "city": ["Gothenburg"]}))
+    parser = ErddapLogParser()
+    parser.load_nginx_logs("example_data/nginx_example_logs/")
+    df_all = parser.df.with_row_index("row")
+    second = df_all.filter(pl.col("datetime") == datetime(2024, 5, 16, 18, 17, 57))
+    assert len(second) > 1
+    # the logs are split between two requests of the same second
+    split = second["row"][0]
+    parts = {"first": df_all.filter(pl.col("row") <= split), "rest": df_all.filter(pl.col("row") > split),
+             "all": df_all}
+    for second_run in ["rest", "all"]:
+        for part in ["first", second_run]:
+            parser = ErddapLogParser()
+            parser.temporal_resolution = "day"
+            parser.df = parts[part].drop("row")
+            parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=backend)
+            parser.parse_columns()
+            # location counts of the second run come from the new requests, not from the cube
+            parser.build_cube()
+            parser.export_data(output_dir=tmp_path / second_run, incremental=True)
+        exported = _read_exports(sorted((tmp_path / second_run).glob("*_anonymized_requests.csv")))
+        assert len(exported) == len(df_all)
+        locations = _read_exports(sorted((tmp_path / second_run).glob("*_aggregated_locations.csv")))
+        assert locations["total_requests"].cast(pl.Int64).sum() == len(df_all)
+
+
+def test_incremental_export_late_requests(tmp_path):
+    import re
+    from erddaplogs.ipinfo import GeoIpDatabase
+    from erddaplogs.logparse import _read_exports
+
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/0"], "countryCode": ["SE"], "city": ["Gothenburg"]}))
+    lines = Path("example_data/nginx_example_logs/tomcat-access.log.1").read_bytes().splitlines(keepends=True)
+    # lines logged after the first export, with the time of a request hours, or seconds, before
+    late = [re.sub(rb'"GET \S+', b'"GET /erddap/late.html', lines[100]),
+            re.sub(rb'"GET \S+', b'"GET /erddap/soon.html', lines[799])]
+    for manifest in [tmp_path / "manifest.json", None]:
+        log_dir = tmp_path / f"logs_{manifest is None}"
+        log_dir.mkdir()
+        output_dir = tmp_path / f"export_{manifest is None}"
+        (log_dir / "access.log").write_bytes(b"".join(lines[:800]))
+        for run in ["first", "second"]:
+            if run == "second":
+                with open(log_dir / "access.log", "ab") as f:
+                    f.write(b"".join(late + lines[800:]))
+            parser = ErddapLogParser()
+            parser.temporal_resolution = "day"
+            parser.load_nginx_logs(log_dir, manifest=manifest)
+            parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=backend)
+            parser.parse_columns()
+            parser.export_data(output_dir=output_dir, incremental=True)
+        urls = _read_exports(sorted(output_dir.glob("*_anonymized_requests.csv")))["url"]
+        # without a manifest, requests loaded again are only recognised within minutes of the last
+        # one exported, so older ones are taken to have been exported before
+        parser = ErddapLogParser()
+        parser.load_nginx_logs(log_dir)
+        assert len(urls) == len(parser.df) - (manifest is None)
+        assert (urls == "/erddap/late.html").any() == (manifest is not None)
+        assert (urls == "/erddap/soon.html").sum() == 1
+
+
+def test_export_formats(tmp_path):
+    from datetime import datetime
+    from erddaplogs.ipinfo import GeoIpDatabase
+    from erddaplogs.logparse import _read_exports
+
+    backend = GeoIpDatabase(pl.DataFrame({"network": ["0.0.0.0/0"], "countryCode": ["SE"], "city": ["Gothenburg"]}))
+    for export_format in ["csv", "csv.gz", "parquet", "ndjson"]:
+        for run in ["before", "after", "full"]:
+            parser = ErddapLogParser()
+            parser.temporal_resolution = "day"
+            parser.load_nginx_logs("example_data/nginx_example_logs/")
+            if run == "before":
+                parser.df = parser.df.filter(pl.col("datetime") < datetime(2024, 5, 16, 12))
+            parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip.csv", backend=backend)
+            parser.parse_columns()
+            if run == "full":
+                parser.export_data(output_dir=tmp_path / export_format, export_format=export_format, workers=3)
+            else:
+                parser.export_data(output_dir=tmp_path / f"incremental_{export_format}", incremental=True,
+                                   export_format=export_format)
+        for name in ["anonymized_requests", "aggregated_locations"]:
+            files = sorted((tmp_path / export_format).glob(f"*_{name}.{export_format}"))
+            assert len(files) == 9
+            df = _read_exports(files, export_format).cast(pl.String)
+            expected = _read_exports(sorted((tmp_path / "csv").glob(f"*_{name}.csv")))
+            if export_format in ["parquet", "ndjson"] and "datetime" in df.columns:
+                # datetimes are not written as text in the same format as in csv
+                df = df.drop("datetime")
+                expected = expected.drop("datetime")
+            assert df.select(expected.columns).equals(expected)
+            incremental = sorted((tmp_path / f"incremental_{export_format}").glob(f"*_{name}.{export_format}"))
+            assert [fn.name for fn in incremental] == [fn.name for fn in files]
+            assert len(_read_exports(incremental, export_format)) == len(_read_exports(files, export_format))
+    assert sum(fn.stat().st_size for fn in (tmp_path / "csv.gz").glob("*")) < 0.3 * sum(
+        fn.stat().st_size for fn in (tmp_path / "csv").glob("*"))
+
+
+def test_parse_query():
+    import re
+    from datetime import datetime
+
+    parser = ErddapLogParser()
+    parser.load_nginx_logs("example_data/nginx_example_logs/")
+    parser.parse_columns()
+    parser.compact_columns()
+    parser.parse_query()
+    df = parser.df
+    assert df.filter(pl.col("erddap_request_type").is_in(["tabledap", "griddap"]))["variables"].null_count() == 0
+    assert df.filter(~pl.col("erddap_request_type").is_in(["tabledap", "griddap"]))["variables"].null_count() == len(
+        df.filter(~pl.col("erddap_request_type").is_in(["tabledap", "griddap"])))
+    assert df.explode("variables")["variables"].value_counts().sort("count", descending=True)["variables"][1] == "profile_index"
+    ranges = df.filter(pl.col("time_min").is_not_null() & pl.col("time_max").is_not_null())
+    assert len(ranges) > 0
+    assert (ranges["time_min"] <= ranges["time_max"]).all()
+    query = pl.DataFrame({
+        "erddap_request_type": ["griddap", "tabledap", "search"],
+        "request_kwargs": ["sst[(2024-01-01T00:00:00Z):1:(2024-02-01)][(10):(20)],chl[(last)]",
+                           "temp,time&time%3E=2024-01-01&station=%22A1%22&time<now-1day&distinct()",
+                           "page=1&searchFor=glider"],
+    })
+    parser.df = query
+    parser.parse_query()
+    rows = parser.df.to_dicts()
+    assert rows[0]["variables"] == ["sst", "chl"]
+    assert (rows[0]["time_min"], rows[0]["time_max"]) == (datetime(2024, 1, 1), datetime(2024, 2, 1))
+    assert rows[1]["variables"] == ["temp", "time"]
+    assert rows[1]["constraints"] == [{"variable": "time", "operator": ">=", "value": "2024-01-01"},
+                                      {"variable": "station", "operator": "=", "value": "A1"},
+                                      {"variable": "time", "operator": "<", "value": "now-1day"}]
+    assert (rows[1]["time_min"], rows[1]["time_max"]) == (datetime(2024, 1, 1), None)
+    assert rows[2]["variables"] is None and rows[2]["constraints"] is None
+
+    urls = ["/erddap/subscriptions/add.html?datasetID=a&email=fake@example.com&emailIfAlreadyValid=false",
+            "/erddap/subscriptions/add.html?datasetID=a&email=fake%40example.com",
+            "/erddap/tabledap/a.csv?time,latitude"]
+    parser.anonymized = pl.DataFrame({"url": urls, "request_kwargs": [url.split("?")[1] for url in urls]})
+    parser.anonymize_query()
+    assert parser.anonymized["url"].to_list() == [re.sub("email=.*?&", "", urls[0]),
+                                                   "/erddap/subscriptions/add.html?datasetID=a&", urls[2]]
+    assert not parser.anonymized["request_kwargs"].str.contains("email=").any()
+
+
+def test_cli(tmp_path):
+    import pytest
+    from erddaplogs import cli
+    from erddaplogs.ipinfo import GeoIpDatabase
+    from erddaplogs.logparse import _read_exports
+
+    pl.DataFrame({"network": ["0.0.0.0/1", "128.0.0.0/1"], "countryCode": ["SE", "NO"], "city": ["Gothenburg", "Oslo"],
+                  "org": ["SMHI", "Google"]}).write_csv(tmp_path / "geo.csv")
+    filters = ["non_erddap", "locales", "user_agents", "common_strings", "organisations"]
+    config = {"logs_dir": str(Path("example_data/nginx_example_logs").absolute()), "output_dir": "cli",
+              "wildcard_fname": "tomcat-access.log.[5-9]", "geoip_database": "geo.csv", "ip_info_csv": "ip.csv",
+              "num_ips": None, "temporal_resolution": "day", "filters": filters, "files_per_chunk": 2}
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump(config, f)
+    # the oldest files are processed first, then the others are picked up where the first run stopped
+    assert cli.main([str(tmp_path / "config.json"), "--quiet"]) == 0
+    config["wildcard_fname"] = "tomcat-access.log.[1-9]"
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump(config, f)
+    totals = cli.run(cli._read_config(tmp_path / "config.json"), quiet=True)
+    assert totals["files"] == 9
+    assert cli.run(cli._read_config(tmp_path / "config.json"), quiet=True)["lines"] == 0
+
+    parser = ErddapLogParser()
+    parser.temporal_resolution = "day"
+    parser.load_nginx_logs("example_data/nginx_example_logs/", "tomcat-access.log.[1-9]")
+    for name in filters[:-1]:
+        getattr(parser, f"filter_{name}")()
+    parser.get_ip_info(num_ips=None, ip_info_csv=tmp_path / "ip_batch.csv", backend=GeoIpDatabase(tmp_path / "geo.csv"))
+    parser.filter_organisations()
+    parser.parse_columns()
+    parser.export_data(tmp_path / "batch")
+    for name in ["anonymized_requests", "aggregated_locations"]:
+        files = sorted((tmp_path / "cli").glob(f"*_{name}.csv"))
+        assert [fn.name for fn in files] == [fn.name for fn in sorted((tmp_path / "batch").glob(f"*_{name}.csv"))]
+        df = _read_exports(files).drop("ip_id", strict=False)
+        expected = _read_exports(sorted((tmp_path / "batch").glob(f"*_{name}.csv"))).drop("ip_id", strict=False)
+        assert df.sort(pl.all()).equals(expected.sort(pl.all()))
+
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump({**config, "unknown_option": 1}, f)
+    with pytest.raises(SystemExit):
+        cli.main([str(tmp_path / "config.json")])
+
+
+
+def test_cli_ip_info_max_age(tmp_path):
+    import pytest
+    from datetime import timedelta
+    from erddaplogs import cli
+
+    (tmp_path / "logs").mkdir()
+    shutil.copy("example_data/nginx_example_logs/tomcat-access.log.1", tmp_path / "logs")
+    pl.DataFrame({"network": ["0.0.0.0/0"], "countryCode": ["SE"], "city": ["Gothenburg"]}).write_csv(tmp_path / "geo.csv")
+    config = {"logs_dir": "logs", "output_dir": "out", "geoip_database": "geo.csv", "num_ips": None,
+              "ip_info_max_age": 86400}
+    for ip_info_csv, error in [(None, "SQLite"), ("ip.db", None)]:
+        with open(tmp_path / "config.json", "w") as f:
+            json.dump({**config, "ip_info_csv": ip_info_csv} if ip_info_csv else config, f)
+        if error:
+            with pytest.raises(ValueError, match=error):
+                cli._read_config(tmp_path / "config.json")
+            continue
+        options = cli._read_config(tmp_path / "config.json")
+        assert options["ip_info_max_age"] == timedelta(days=1)
+        assert cli.run(options, quiet=True)["kept"] > 0
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump({**config, "ip_info_max_age": "90 days"}, f)
+    with pytest.raises(ValueError, match="seconds"):
+        cli._read_config(tmp_path / "config.json")
+
+def test_cli_unordered_log(tmp_path):
+    from erddaplogs import cli
+    from erddaplogs.logparse import _load_log_file
+
+    lines = Path("example_data/nginx_example_logs/tomcat-access.log.1").read_bytes().splitlines(keepends=True)
+    # the last request is logged before the one preceding it
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "logs" / "access.log").write_bytes(b"".join(lines[:-2] + [lines[-1], lines[-2]]))
+    pl.DataFrame({"network": ["0.0.0.0/0"], "countryCode": ["SE"], "city": ["Gothenburg"]}).write_csv(tmp_path / "geo.csv")
+    config = {"logs_dir": "logs", "output_dir": "out", "geoip_database": "geo.csv", "num_ips": None, "filters": []}
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump(config, f)
+    cli.run(cli._read_config(tmp_path / "config.json"), quiet=True)
+    state = json.loads((tmp_path / "out" / "export_state.json").read_text())
+    assert state["last_exported"] == _load_log_file(b"".join(lines))["datetime"].max().isoformat()